@@ -0,0 +1,135 @@
+import asyncio
+import contextvars
+import threading
+import time
+
+from . import metrics
+
+# Most write requests a worker accepts at once, waiting or running; more are turned away with a 503
+DEFAULT_WRITE_QUEUE_DEPTH = 512
+# How long (seconds) a write may wait for its turn before it is given up on, unapplied
+DEFAULT_WRITE_DEADLINE = 10.0
+# Seconds clients are told to wait (Retry-After) before retrying a rejected write
+DEFAULT_WRITE_RETRY_AFTER = 1
+
+_deadline = contextvars.ContextVar('invoice_write_deadline', default=None)
+
+
+class WriteRejected(Exception):
+    """A write turned away because the worker is saturated; it was not applied."""
+
+    def __init__(self, reason):
+        super().__init__(f'Write rejected: {reason}')
+        self.reason = reason
+
+
+class WriteAdmission:
+    """Counts the write requests a worker is handling and turns new ones away past a limit.
+
+    Admission is decided up front, before the body is even parsed, so a
+    saturated worker rejects writes in O(1) and never queues more than
+    ``max_depth`` of them behind the store's single writer.
+    """
+
+    def __init__(self):
+        self._depth = 0
+        self._lock = threading.Lock()
+
+    @property
+    def depth(self):
+        return self._depth
+
+    def admit(self, max_depth):
+        """Count one more write in, unless ``max_depth`` are already in; returns whether it was admitted."""
+        with self._lock:
+            if self._depth >= max_depth:
+                REJECTIONS.inc(reason='queue_full')
+                return False
+            self._depth += 1
+            return True
+
+    def release(self):
+        with self._lock:
+            self._depth -= 1
+
+
+write_admission = WriteAdmission()
+
+QUEUE_DEPTH = metrics.REGISTRY.gauge(
+    'invoice_write_queue_depth', 'Write requests this worker has admitted and not yet answered.',
+    lambda: write_admission.depth)
+REJECTIONS = metrics.REGISTRY.counter(
+    'invoice_write_rejections_total',
+    'Write requests answered 503: the write queue was full, or the write waited past its deadline.',
+    ('reason',))
+
+
+def start_deadline(seconds):
+    """Give the writes made in the current context ``seconds`` to start; returns a token for end_deadline()."""
+    return _deadline.set(time.monotonic() + seconds)
+
+
+def end_deadline(token):
+    _deadline.reset(token)
+
+
+def current_deadline():
+    """The time.monotonic() deadline of the current request's writes, or None outside admitted requests."""
+    return _deadline.get()
+
+
+def check_deadline(deadline):
+    """Raise WriteRejected if ``deadline`` (from current_deadline(); None means no deadline) has passed."""
+    if deadline is not None and time.monotonic() > deadline:
+        raise deadline_passed()
+
+
+def deadline_passed():
+    """Count a write given up on at its deadline and return the WriteRejected to raise for it."""
+    REJECTIONS.inc(reason='deadline')
+    return WriteRejected('deadline')
+
+
+class WriteClaim:
+    """Settles, once, whether a queued write is started by the thread applying it or abandoned by its caller.
+
+    A caller that gives up at its deadline may only answer 503 if the write
+    never started, so that a 503 always means nothing was written.
+    """
+
+    def __init__(self):
+        self._owner = None
+        self._lock = threading.Lock()
+
+    @property
+    def abandoned(self):
+        return self._owner == 'caller'
+
+    def start(self):
+        """Called before applying the write; False if the caller already abandoned it."""
+        return self._take('writer')
+
+    def abandon(self):
+        """Called by a caller giving up; False if the write has already started."""
+        return self._take('caller')
+
+    def _take(self, owner):
+        with self._lock:
+            if self._owner is None:
+                self._owner = owner
+            return self._owner == owner
+
+
+async def await_write(future, claim, deadline):
+    """Await a queued write's ``future`` until ``deadline``, then abandon it if it has not started.
+
+    Raises WriteRejected for an abandoned write. One that has started is
+    awaited to the end, since by then it is (being) applied.
+    """
+    if deadline is not None:
+        try:
+            return await asyncio.wait_for(asyncio.shield(future), max(0.0, deadline - time.monotonic()))
+        except asyncio.TimeoutError:
+            if claim.abandon():
+                raise deadline_passed()
+    return await future
@@ -0,0 +1,387 @@
+"""Synthetic-load benchmark for the invoice API; run it with ``python manage.py benchmark``.
+
+Each store size is seeded into a throwaway directory (or SQLite database),
+then every endpoint is driven through Django's test client one request at
+a time, and optionally by many concurrent clients. Results are plain
+dicts, so the command can dump them as JSON and compare two runs.
+"""
+import asyncio
+import datetime
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.core.management import call_command
+from django.db import connections, transaction
+from django.test import AsyncClient, Client
+from django.test.utils import override_settings
+
+from . import encoding, store as store_module
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+try:
+    import psutil
+except ImportError:  # Optional; only needed for peak memory where the resource module is missing
+    psutil = None
+
+CUSTOMERS = ['Acme Corp', 'Globex', 'Initech', 'Umbrella', 'Stark Industries', 'Wayne Enterprises', 'Hooli',
+             'Vandelay Industries', 'Soylent', 'Tyrell Corp']
+PRODUCTS = ['blue widget', 'red widget', 'gadget', 'sprocket', 'gear', 'bolt pack', 'cable', 'adapter',
+            'service hour', 'support plan']
+
+SEQUENTIAL_OPS = ('list', 'get', 'create', 'update', 'delete')
+# Share of each request kind in the concurrent mix; deletes remove invoices the mix created
+CONCURRENT_MIX = (('list', 0.45), ('get', 0.35), ('create', 0.1), ('update', 0.07), ('delete', 0.03))
+
+
+def peak_rss_mb():
+    """Return this process's peak resident set size in MiB, or None if it cannot be measured."""
+    if resource is not None:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return round(peak / (1024 * 1024 if sys.platform == 'darwin' else 1024), 1)  # Bytes on macOS, KiB elsewhere
+    if psutil is not None:
+        info = psutil.Process().memory_info()
+        return round(getattr(info, 'peak_wset', info.rss) / (1024 * 1024), 1)
+    return None
+
+
+def summarize(latencies, elapsed, errors=0):
+    """Return count, throughput and latency percentiles (ms) for one kind of request."""
+    latencies = sorted(latencies)
+
+    def percentile(p):
+        return round(latencies[min(len(latencies) - 1, int(p * len(latencies)))] * 1000, 3) if latencies else None
+
+    return {
+        'requests': len(latencies),
+        'errors': errors,
+        'throughput': round(len(latencies) / elapsed, 1) if elapsed else None,
+        'p50_ms': percentile(0.50),
+        'p99_ms': percentile(0.99),
+        'max_ms': round(latencies[-1] * 1000, 3) if latencies else None,
+    }
+
+
+def synthetic_invoice(rng, max_details):
+    """Return the fields of a random invoice with 1..max_details line items (mostly few)."""
+    count = min(max_details, 1 + int(rng.expovariate(1 / 3)))
+    return {
+        'customer_name': rng.choice(CUSTOMERS),
+        'date': (datetime.date(2023, 1, 1) + datetime.timedelta(days=rng.randrange(730))).isoformat(),
+        'details': [
+            {'description': rng.choice(PRODUCTS), 'quantity': rng.randint(1, 20),
+             'unit_price': rng.randrange(100, 100000) / 100}
+            for _ in range(count)
+        ],
+    }
+
+
+def seeded_invoices(size, max_details, seed):
+    """Yield ``size`` invoices with ids 1..size, totals filled in, the same for the same seed."""
+    rng = random.Random(seed)
+    for invoice_id in range(1, size + 1):
+        fields = synthetic_invoice(rng, max_details)
+        total = 0.0
+        for detail_id, detail in enumerate(fields['details'], 1):
+            detail['id'] = detail_id
+            detail['line_total'] = round(detail['quantity'] * detail['unit_price'], 2)
+            total += detail['line_total']
+        yield {'id': invoice_id, 'invoice_number': invoice_id, **fields, 'total_amount': round(total, 2)}
+
+
+class Workload:
+    """Builds benchmark requests and tracks which invoice ids exist, shared by all clients."""
+
+    def __init__(self, size, max_details, seed, page_size):
+        self.size = size
+        self.max_details = max_details
+        self.page_size = page_size
+        self._rng = random.Random(seed + 1)
+        self._lock = threading.Lock()
+        self._created = []
+
+    def created(self, response_body):
+        invoice_id = json.loads(response_body).get('data', {}).get('id')
+        if invoice_id is not None:
+            with self._lock:
+                self._created.append(invoice_id)
+
+    def request(self, op):
+        """Return ``(method, path, body)`` for one request of the given kind."""
+        with self._lock:
+            rng = self._rng
+            if op == 'list':
+                cursor = rng.randrange(self.size)
+                return 'GET', f'/api/invoices/?limit={self.page_size}&cursor={cursor}', None
+            if op == 'get':
+                return 'GET', f'/api/invoices/{rng.randint(1, self.size)}/', None
+            if op == 'create':
+                return 'POST', '/api/invoices/create/', synthetic_invoice(rng, self.max_details)
+            if op == 'update':
+                # Seeded invoices are never deleted, so the id always exists
+                return 'PUT', '/api/invoices/update/', {'id': rng.randint(1, self.size),
+                                                         **synthetic_invoice(rng, self.max_details)}
+            if op == 'delete':
+                if not self._created:
+                    return None
+                return 'DELETE', '/api/invoices/delete/', {'invoice_id': self._created.pop()}
+        raise ValueError(f'Unknown benchmark operation: {op}')
+
+    def pick(self):
+        """Pick a request kind for the concurrent mix."""
+        with self._lock:
+            roll = self._rng.random()
+        for op, share in CONCURRENT_MIX:
+            if roll < share:
+                return op
+            roll -= share
+        return CONCURRENT_MIX[-1][0]
+
+
+def _send(client, op, request, workload):
+    method, path, body = request
+    data = json.dumps(body) if body is not None else ''
+    start = time.perf_counter()
+    response = client.generic(method, path, data, content_type='application/json')
+    content = b''.join(response.streaming_content) if response.streaming else response.content
+    elapsed = time.perf_counter() - start
+    if op == 'create' and response.status_code == 200:
+        workload.created(content)
+    return elapsed, response.status_code < 400
+
+
+async def _asend(client, op, request, workload):
+    method, path, body = request
+    data = json.dumps(body) if body is not None else ''
+    start = time.perf_counter()
+    response = await client.generic(method, path, data, content_type='application/json')
+    elapsed = time.perf_counter() - start
+    if op == 'create' and response.status_code == 200:
+        workload.created(response.content)
+    return elapsed, response.status_code < 400
+
+
+class _HttpClient:
+    """The tiny part of the test client interface used here, over HTTP to a running server."""
+
+    def __init__(self, base_url):
+        self.base_url = base_url.rstrip('/')
+
+    def generic(self, method, path, data='', content_type='application/json'):
+        request = urllib.request.Request(self.base_url + path, data=data.encode() or None, method=method,
+                                         headers={'Content-Type': content_type})
+        try:
+            with urllib.request.urlopen(request) as response:
+                return _HttpResponse(response.status, response.read())
+        except urllib.error.HTTPError as e:
+            return _HttpResponse(e.code, e.read())
+
+
+class _HttpResponse:
+    streaming = False
+
+    def __init__(self, status_code, content):
+        self.status_code = status_code
+        self.content = content
+
+
+def run_sequential(workload, requests):
+    """Send ``requests`` requests of each kind, one at a time, through the test client."""
+    client = Client()
+    results = {}
+    for op in SEQUENTIAL_OPS:
+        latencies, errors = [], 0
+        started = time.perf_counter()
+        for _ in range(requests):
+            request = workload.request(op)
+            if request is None:
+                break
+            elapsed, ok = _send(client, op, request, workload)
+            latencies.append(elapsed)
+            errors += not ok
+        results[op] = summarize(latencies, time.perf_counter() - started, errors)
+    return results
+
+
+def _collect(samples, elapsed):
+    by_op = {}
+    for op, latency, ok in samples:
+        entry = by_op.setdefault(op, ([], [0]))
+        entry[0].append(latency)
+        entry[1][0] += not ok
+    results = {op: summarize(latencies, elapsed, errors[0]) for op, (latencies, errors) in by_op.items()}
+    results['all'] = summarize([latency for _, latency, _ in samples], elapsed,
+                               sum(not ok for _, _, ok in samples))
+    return results
+
+
+def run_concurrent(workload, requests, concurrency, mode, url=None):
+    """Send ``requests`` requests of the mixed workload from ``concurrency`` clients at once.
+
+    ``mode`` 'wsgi' runs one test Client per thread, 'asgi' one AsyncClient
+    per task on a single event loop (so the async views overlap on it),
+    and 'http' one urllib client per thread against ``url``.
+    """
+    if mode == 'asgi':
+        return asyncio.run(_run_concurrent_async(workload, requests, concurrency))
+
+    counter = iter(range(requests))
+    counter_lock = threading.Lock()
+    samples = []
+
+    def client_loop():
+        client = _HttpClient(url) if mode == 'http' else Client()
+        local = []
+        while True:
+            with counter_lock:
+                if next(counter, None) is None:
+                    break
+            op = workload.pick()
+            request = workload.request(op)
+            if request is None:  # Nothing left to delete yet
+                op = 'get'
+                request = workload.request(op)
+            elapsed, ok = _send(client, op, request, workload)
+            local.append((op, elapsed, ok))
+        return local
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as executor:
+        for local in executor.map(lambda _: client_loop(), range(concurrency)):
+            samples.extend(local)
+    return _collect(samples, time.perf_counter() - started)
+
+
+async def _run_concurrent_async(workload, requests, concurrency):
+    remaining = [requests]
+    samples = []
+
+    async def client_loop():
+        client = AsyncClient()
+        while remaining[0] > 0:
+            remaining[0] -= 1
+            op = workload.pick()
+            request = workload.request(op)
+            if request is None:  # Nothing left to delete yet
+                op = 'get'
+                request = workload.request(op)
+            elapsed, ok = await _asend(client, op, request, workload)
+            samples.append((op, elapsed, ok))
+
+    started = time.perf_counter()
+    await asyncio.gather(*(client_loop() for _ in range(concurrency)))
+    return _collect(samples, time.perf_counter() - started)
+
+
+def _seed_json(path, size, max_details, seed):
+    with open(path, 'wb') as f:
+        f.write(encoding.dumps(list(seeded_invoices(size, max_details, seed))))
+
+
+def _seed_sqlite(size, max_details, seed, batch_size=1000):
+    from .sqlite_store import SqliteInvoiceStore  # Models can only be imported once apps are loaded
+    call_command('migrate', verbosity=0)
+    store = SqliteInvoiceStore()
+    batch = []
+    with transaction.atomic():
+        for invoice in seeded_invoices(size, max_details, seed):
+            batch.append(invoice)
+            if len(batch) == batch_size:
+                store.insert(batch)
+                batch = []
+        if batch:
+            store.insert(batch)
+
+
+def run_size(size, backend='json', requests=200, max_details=10, seed=0, page_size=50,
+             concurrency=0, mode='wsgi', url=None, extra_settings=None):
+    """Seed a store of ``size`` invoices in a temp directory, benchmark it and return the results.
+
+    ``extra_settings`` are applied on top for the run, e.g.
+    ``{'INVOICE_STORE_JOURNAL': True}`` to compare storage configurations.
+    """
+    directory = tempfile.mkdtemp(prefix='invoice-benchmark-')
+    connection = connections['default']
+    original_db = connection.settings_dict['NAME']
+    overrides = {
+        'INVOICE_STORAGE_BACKEND': backend,
+        'INVOICE_FILE_PATH': os.path.join(directory, 'invoices.json'),
+        'ALLOWED_HOSTS': [*settings.ALLOWED_HOSTS, 'testserver'],
+        **(extra_settings or {}),
+    }
+    try:
+        with override_settings(**overrides):
+            # A fresh store instance for the temp files, however many sizes ran before
+            store_module._stores.clear()
+            started = time.perf_counter()
+            if backend == 'sqlite':
+                connection.close()
+                connection.settings_dict['NAME'] = os.path.join(directory, 'db.sqlite3')
+                _seed_sqlite(size, max_details, seed)
+            else:
+                _seed_json(overrides['INVOICE_FILE_PATH'], size, max_details, seed)
+            seed_seconds = time.perf_counter() - started
+
+            started = time.perf_counter()
+            len(store_module.get_store())  # Loads (and indexes) the JSON store
+            load_seconds = time.perf_counter() - started
+
+            workload = Workload(size, max_details, seed, page_size)
+            result = {
+                'size': size,
+                'backend': backend,
+                'settings': extra_settings or {},
+                'seed_seconds': round(seed_seconds, 3),
+                'load_seconds': round(load_seconds, 3),
+                'rss_after_load_mb': peak_rss_mb(),
+                'sequential': run_sequential(workload, requests),
+            }
+            if concurrency:
+                result['concurrent'] = {
+                    'mode': mode,
+                    'clients': concurrency,
+                    **run_concurrent(workload, requests * len(SEQUENTIAL_OPS), concurrency, mode, url),
+                }
+            result['peak_rss_mb'] = peak_rss_mb()
+            return result
+    finally:
+        store_module._stores.clear()
+        if backend == 'sqlite':
+            connection.close()
+            connection.settings_dict['NAME'] = original_db
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+def compare(results, baseline):
+    """Return ``{size: {section: {op: throughput and p99 ratios}}}`` of results against a baseline run."""
+    baseline_by_size = {entry['size']: entry for entry in baseline.get('results', [])}
+    comparison = {}
+    for entry in results:
+        base = baseline_by_size.get(entry['size'])
+        if base is None:
+            continue
+        sizes = comparison[entry['size']] = {}
+        for section in ('sequential', 'concurrent'):
+            for op, stats in (entry.get(section) or {}).items():
+                old = (base.get(section) or {}).get(op)
+                if not isinstance(stats, dict) or not isinstance(old, dict):
+                    continue
+                sizes.setdefault(section, {})[op] = {
+                    'throughput_ratio': round(stats['throughput'] / old['throughput'], 3)
+                    if stats['throughput'] and old['throughput'] else None,
+                    'p99_ratio': round(stats['p99_ms'] / old['p99_ms'], 3) if stats['p99_ms'] and old['p99_ms'] else None,
+                }
+    return comparison
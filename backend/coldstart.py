@@ -0,0 +1,141 @@
+"""Cold-start report for the WSGI entry points; run it with ``python manage.py coldstart``.
+
+Each entry point is imported in a fresh interpreter and sent one request,
+which is what a new serverless instance pays before it can answer. One more
+cold start under ``python -X importtime`` shows what each module cost; that
+one runs with the preload thread off, since the interpreter's import timer
+cannot attribute two threads' imports. Results are plain dicts, so the
+command can print them or dump them as JSON to track over time.
+"""
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+from collections import defaultdict
+
+from django.conf import settings
+
+ENTRY_POINTS = ('backend.wsgi', 'backend.wsgi_api')
+
+# Runs in the fresh interpreter: import the entry point, answer one GET, print the timings as JSON
+_CHILD = '''
+import json, sys, time
+from wsgiref.util import setup_testing_defaults
+started = time.perf_counter()
+module = __import__(sys.argv[1], fromlist=['application'])
+imported = time.perf_counter()
+path, _, query = sys.argv[2].partition('?')
+environ = {'REQUEST_METHOD': 'GET', 'PATH_INFO': path, 'QUERY_STRING': query}
+setup_testing_defaults(environ)
+statuses = []
+response = module.application(environ, lambda status, headers, exc_info=None: statuses.append(status))
+size = sum(len(chunk) for chunk in response)
+response.close()
+answered = time.perf_counter()
+print(json.dumps({
+    'import_ms': (imported - started) * 1000,
+    'first_request_ms': (answered - imported) * 1000,
+    'status': int(statuses[0].split()[0]),
+    'response_bytes': size,
+}))
+'''
+
+
+def parse_importtime(output):
+    """Parse ``-X importtime`` lines into ``{module: (self microseconds, cumulative microseconds)}``."""
+    modules = {}
+    for line in output.splitlines():
+        if not line.startswith('import time:'):
+            continue
+        fields = line[len('import time:'):].split('|')
+        if len(fields) != 3 or not fields[0].strip().isdigit():
+            continue  # The header line
+        modules[fields[2].strip()] = (int(fields[0]), int(fields[1]))
+    return modules
+
+
+def package_of(module):
+    """Group modules for the report: django.contrib.<app>, django.<sub>, backend.<module>, else the top package."""
+    parts = module.split('.')
+    if parts[:2] == ['django', 'contrib']:
+        return '.'.join(parts[:3])
+    if parts[0] in ('django', 'backend'):
+        return '.'.join(parts[:2])
+    return parts[0]
+
+
+def run_once(entry, path, importtime=False):
+    """Import ``entry`` and request ``path`` in a fresh interpreter; return its timings and import times.
+
+    The import times are only collected with ``importtime``, which also
+    turns the preload thread off (INVOICE_PRELOAD=0).
+    """
+    env = dict(os.environ)
+    env.pop('DJANGO_SETTINGS_MODULE', None)  # Each entry point picks its own settings
+    if importtime:
+        env['INVOICE_PRELOAD'] = '0'
+    started = time.perf_counter()
+    child = subprocess.run(
+        [sys.executable, *(['-X', 'importtime'] if importtime else []), '-c', _CHILD, entry, path],
+        cwd=settings.BASE_DIR, env=env, capture_output=True, text=True,
+    )
+    process_ms = (time.perf_counter() - started) * 1000
+    if child.returncode != 0:
+        errors = [line for line in child.stderr.splitlines() if not line.startswith('import time:')]
+        raise RuntimeError(f'{entry} failed: ' + '\n'.join(errors[-20:]))
+    result = json.loads(child.stdout.strip().splitlines()[-1])
+    result['process_ms'] = process_ms
+    return result, parse_importtime(child.stderr)
+
+
+def report(entry, path='/api/invoices/?limit=1', runs=3, top=20):
+    """Cold-start ``entry`` ``runs`` times and summarize: median timings, slowest modules and packages."""
+    timings = defaultdict(list)
+    status = None
+    for _ in range(runs):
+        result, _ = run_once(entry, path)
+        status = result['status']
+        for key in ('process_ms', 'import_ms', 'first_request_ms'):
+            timings[key].append(result[key])
+    _, import_times = run_once(entry, path, importtime=True)
+
+    modules = {name: (own / 1000, cumulative / 1000) for name, (own, cumulative) in import_times.items()}
+    packages = defaultdict(float)
+    for name, (own, _) in modules.items():
+        packages[package_of(name)] += own
+    slowest = sorted(modules.items(), key=lambda item: item[1][0], reverse=True)[:top]
+    return {
+        'entry': entry,
+        'path': path,
+        'runs': runs,
+        'status': status,
+        **{key: round(statistics.median(values), 1) for key, values in timings.items()},
+        'modules_imported': len(modules),
+        'import_self_ms': round(sum(own for own, _ in modules.values()), 1),
+        'slowest_modules': [
+            {'module': name, 'self_ms': round(own, 2), 'cumulative_ms': round(cumulative, 2)}
+            for name, (own, cumulative) in slowest
+        ],
+        'packages': [
+            {'package': name, 'self_ms': round(own, 2)}
+            for name, own in sorted(packages.items(), key=lambda item: item[1], reverse=True)[:top]
+        ],
+    }
+
+
+def format_report(result):
+    """Render one report() result as a plain-text table."""
+    lines = [
+        f"{result['entry']}: {result['modules_imported']} modules, import {result['import_ms']} ms, "
+        f"first request {result['first_request_ms']} ms ({result['status']} {result['path']}), "
+        f"whole process {result['process_ms']} ms (median of {result['runs']})",
+        '',
+        f"  {'slowest modules':<48} {'self ms':>9} {'cumul. ms':>10}",
+    ]
+    lines += [f"  {row['module']:<48} {row['self_ms']:>9.2f} {row['cumulative_ms']:>10.2f}"
+              for row in result['slowest_modules']]
+    lines += ['', f"  {'by package':<48} {'self ms':>9}"]
+    lines += [f"  {row['package']:<48} {row['self_ms']:>9.2f}" for row in result['packages']]
+    return '\n'.join(lines)
@@ -0,0 +1,377 @@
+import bisect
+import datetime
+import logging
+import mmap
+import os
+import struct
+import threading
+import time
+from array import array
+
+from . import encoding
+from .store import REPORT_GROUPS, version_token
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b'INVCOLS1'
+_HEADER_LENGTH = struct.Struct('<Q')
+
+# Typecodes of the fixed-width sections; rows are stored in id order
+_COLUMNS = {
+    'id': 'q',
+    'total': 'd',  # NaN when total_amount is not numeric
+    'date': 'i',  # YYYYMMDD, 0 when there is no date
+    'record_offsets': 'q',
+    'number_offsets': 'q',
+    'customer_offsets': 'q',
+    'by_customer': 'i',  # Row numbers sorted by casefolded customer name
+    'by_date': 'i',
+    'by_total': 'i',
+}
+_BLOBS = ('records', 'numbers', 'customers', 'rollup_data')
+
+
+def _date_value(date):
+    """YYYY-MM-DD -> YYYYMMDD, which orders the same way as the string does."""
+    if len(date) != 10:
+        raise ValueError(date)
+    return int(datetime.date.fromisoformat(date).strftime('%Y%m%d'))
+
+
+def encode_columnar(tag, invoices, encoded, by_customer, by_date, by_total, rollups):
+    """Encode a columnar snapshot of invoices (sorted by id) and return its bytes.
+
+    ``encoded`` holds each invoice's JSON bytes; ``by_customer``,
+    ``by_date`` and ``by_total`` are invoice ids in the order of the
+    matching store index; ``rollups`` maps each report grouping to its
+    ``[(key, count, cents)]``; ``tag`` identifies the store state the
+    snapshot was taken from. Raises ValueError for a date that is not
+    YYYY-MM-DD, which the date column cannot represent.
+    """
+    row_of = {invoice['id']: row for row, invoice in enumerate(invoices)}
+    sections = {
+        'id': array('q', (invoice['id'] for invoice in invoices)),
+        'total': array('d'),
+        'date': array('i'),
+        'by_customer': array('i', (row_of[invoice_id] for invoice_id in by_customer)),
+        'by_date': array('i', (row_of[invoice_id] for invoice_id in by_date)),
+        'by_total': array('i', (row_of[invoice_id] for invoice_id in by_total)),
+    }
+    numbers = []
+    customers = []
+    for invoice in invoices:
+        try:
+            sections['total'].append(float(invoice.get('total_amount')))
+        except (TypeError, ValueError):
+            sections['total'].append(float('nan'))
+        date = invoice.get('date')
+        sections['date'].append(_date_value(date) if isinstance(date, str) and date else 0)
+        numbers.append(encoding.dumps(invoice.get('invoice_number')))
+        name = invoice.get('customer_name')
+        customers.append(name.encode('utf-8') if isinstance(name, str) else b'')
+
+    for name, items in (('record', encoded), ('number', numbers), ('customer', customers)):
+        offsets = array('q', [0])
+        position = 0
+        for item in items:
+            position += len(item)
+            offsets.append(position)
+        sections[name + '_offsets'] = offsets
+        sections[name + 's'] = b''.join(items)
+    sections['rollup_data'] = encoding.dumps(rollups)
+
+    # Lay the sections out 8-byte aligned after the header
+    layout = {}
+    chunks = []
+    position = 0
+    for name in (*_COLUMNS, *_BLOBS):
+        data = sections[name]
+        data = data.tobytes() if isinstance(data, array) else data
+        layout[name] = [position, len(data)]
+        chunks.append(data)
+        padding = -len(data) % 8
+        chunks.append(b'\0' * padding)
+        position += len(data) + padding
+
+    header = encoding.dumps({'tag': tag, 'count': len(invoices), 'sections': layout})
+    header += b' ' * (-(len(MAGIC) + _HEADER_LENGTH.size + len(header)) % 8)
+    return b''.join([MAGIC, _HEADER_LENGTH.pack(len(header)), header, *chunks])
+
+
+class ColumnarSnapshot:
+    """Read-only view of a columnar snapshot file through mmap.
+
+    Opening it costs a header parse, not a parse of the invoices, and every
+    worker that maps the same file shares one copy in the page cache.
+    Columns are exposed as typed memoryviews; range and prefix lookups are
+    a bisect over the presorted row orders, like backend.indexes.SortedIndex.
+    """
+
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        buffer = memoryview(self._mmap)
+        if bytes(buffer[:len(MAGIC)]) != MAGIC:
+            raise ValueError(f'{path} is not a columnar invoice snapshot')
+        (length,) = _HEADER_LENGTH.unpack_from(buffer, len(MAGIC))
+        start = len(MAGIC) + _HEADER_LENGTH.size
+        header = encoding.loads(bytes(buffer[start:start + length]))
+        base = start + length
+
+        self.tag = header['tag']
+        self.count = header['count']
+        for name, (offset, size) in header['sections'].items():
+            section = buffer[base + offset:base + offset + size]
+            setattr(self, '_' + name, section.cast(_COLUMNS[name]) if name in _COLUMNS else section)
+        self._rollups = None
+        self._rows_by_number = None
+        self._number_lock = threading.Lock()
+
+    def __len__(self):
+        return self.count
+
+    # ------------------------------------------------------------------
+    # Row access
+    # ------------------------------------------------------------------
+
+    def record(self, row):
+        """Return the JSON bytes of the invoice in the given row."""
+        return bytes(self._records[self._record_offsets[row]:self._record_offsets[row + 1]])
+
+    def invoice(self, row):
+        return encoding.loads(self.record(row))
+
+    def _customer(self, row):
+        return str(self._customers[self._customer_offsets[row]:self._customer_offsets[row + 1]], 'utf-8')
+
+    def row_of_id(self, invoice_id):
+        """Return the row of the invoice with the given id, or None."""
+        if not isinstance(invoice_id, int):
+            return None
+        row = bisect.bisect_left(self._id, invoice_id)
+        return row if row < self.count and self._id[row] == invoice_id else None
+
+    def row_of_number(self, invoice_number):
+        """Return the row of the first invoice with the given invoice_number, or None.
+
+        The number -> row map is built on first use, since most lookups are by id.
+        """
+        if self._rows_by_number is None:
+            with self._number_lock:
+                if self._rows_by_number is None:
+                    rows = {}
+                    offsets = self._number_offsets
+                    for row in range(self.count):
+                        rows.setdefault(bytes(self._numbers[offsets[row]:offsets[row + 1]]), row)
+                    self._rows_by_number = rows
+        try:
+            key = encoding.dumps(invoice_number)
+        except TypeError:
+            return None
+        return self._rows_by_number.get(key)
+
+    # ------------------------------------------------------------------
+    # Queries
+    # ------------------------------------------------------------------
+
+    def filter_rows(self, filters):
+        """Return the sorted rows matching every filter (same filters as InvoiceStore.page())."""
+        candidates = []
+        if filters.get('customer') is not None:
+            name = filters['customer']
+            rows = self._customer_rows(name.casefold(), prefix=False)
+            candidates.append([row for row in rows if self._customer(row) == name])
+        if filters.get('customer_prefix') is not None:
+            candidates.append(self._customer_rows(filters['customer_prefix'].casefold(), prefix=True))
+        if filters.get('date_from') is not None or filters.get('date_to') is not None:
+            lo = filters.get('date_from')
+            hi = filters.get('date_to')
+            candidates.append(self._range(
+                self._by_date, self._date,
+                None if lo is None else _date_value(lo), None if hi is None else _date_value(hi),
+            ))
+        if filters.get('min_total') is not None or filters.get('max_total') is not None:
+            candidates.append(self._range(self._by_total, self._total, filters.get('min_total'),
+                                          filters.get('max_total')))
+        if not candidates:
+            return range(self.count)
+
+        candidates.sort(key=len)
+        rows = set(candidates[0])
+        for other in candidates[1:]:
+            if not rows:
+                break
+            rows.intersection_update(other)
+        return sorted(rows)
+
+    def _range(self, order, column, lo, hi):
+        start = 0 if lo is None else bisect.bisect_left(order, lo, key=column.__getitem__)
+        end = len(order) if hi is None else bisect.bisect_right(order, hi, key=column.__getitem__)
+        return order[start:end].tolist()
+
+    def _customer_rows(self, value, prefix):
+        """Rows whose casefolded customer name equals (or starts with) value."""
+        key = lambda row: self._customer(row).casefold()
+        start = bisect.bisect_left(self._by_customer, value, key=key)
+        if prefix:
+            end = bisect.bisect_left(self._by_customer, value + '\U0010ffff', lo=start, key=key)
+        else:
+            end = bisect.bisect_right(self._by_customer, value, lo=start, key=key)
+        return self._by_customer[start:end].tolist()
+
+    def page(self, after=None, limit=None, filters=None):
+        """Return ``(JSON bytes of each invoice, next_cursor)`` like InvoiceStore.page_encoded()."""
+        rows = self.filter_rows(filters) if filters else range(self.count)
+        ids = self._id
+        start = 0 if after is None else bisect.bisect_right(rows, after, key=ids.__getitem__)
+        end = len(rows) if limit is None else min(start + limit, len(rows))
+        encoded = [self.record(row) for row in rows[start:end]]
+        next_cursor = ids[rows[end - 1]] if end < len(rows) and encoded else None
+        return encoded, next_cursor
+
+    def rollups(self):
+        """Return ``{group: [(key, invoice count, revenue in cents)]}`` as exported."""
+        if self._rollups is None:
+            self._rollups = encoding.loads(bytes(self._rollup_data))
+        return self._rollups
+
+
+class MappedInvoiceStore:
+    """Serves reads from an InvoiceStore's columnar snapshot while it is current.
+
+    The snapshot is tagged with the state of the JSON files it was exported
+    from. Each read stats those files; while they still match, lists,
+    filters, lookups by id and reports come from the shared mapping and the
+    JSON is never parsed in this process. Otherwise, e.g. after another
+    worker appended to the journal, the read falls through to the wrapped
+    InvoiceStore, which loads the JSON as usual. Writes and full-text search
+    always go to the InvoiceStore.
+    """
+
+    def __init__(self, store):
+        self.store = store
+        self._snapshot = None
+        self._snapshot_stamp = None
+        self._current_snapshot = None
+        self._seen_generation = None
+        self._next_stat = 0.0
+        self._lock = threading.Lock()
+
+    def __getattr__(self, name):
+        return getattr(self.store, name)
+
+    def _current(self):
+        """Return the mapped snapshot if it matches the JSON files on disk, else None.
+
+        Like InvoiceStore._revalidate(), the files are only stat()ed when the
+        shared generation counter moved or the stat interval elapsed.
+        """
+        generation = self.store._read_generation()
+        now = time.monotonic()
+        with self._lock:
+            if generation is not None and generation == self._seen_generation and now < self._next_stat:
+                return self._current_snapshot
+        current = self._check_files()
+        with self._lock:
+            self._seen_generation = generation
+            self._next_stat = now + self.store.stat_interval
+            self._current_snapshot = current
+        return current
+
+    def _check_files(self):
+        state = self.store._disk_state()
+        try:
+            st = os.stat(self.store.columnar_path)
+        except FileNotFoundError:
+            return None
+        stamp = (st.st_mtime_ns, st.st_size, st.st_ino)
+        with self._lock:
+            if stamp != self._snapshot_stamp:
+                try:
+                    self._snapshot = ColumnarSnapshot(self.store.columnar_path)
+                except (OSError, ValueError, struct.error):
+                    logger.warning('Ignoring unreadable columnar snapshot %s', self.store.columnar_path)
+                    self._snapshot = None
+                self._snapshot_stamp = stamp
+            snapshot = self._snapshot
+        return snapshot if snapshot is not None and snapshot.tag == state else None
+
+    def __len__(self):
+        snapshot = self._current()
+        return len(snapshot) if snapshot is not None else len(self.store)
+
+    def version(self):
+        snapshot = self._current()
+        return version_token(*snapshot.tag) if snapshot is not None else self.store.version()
+
+    def all(self):
+        snapshot = self._current()
+        if snapshot is None:
+            return self.store.all()
+        return [snapshot.invoice(row) for row in range(len(snapshot))]
+
+    def get(self, invoice_id):
+        snapshot = self._current()
+        if snapshot is None:
+            return self.store.get(invoice_id)
+        row = snapshot.row_of_id(invoice_id)
+        return snapshot.invoice(row) if row is not None else None
+
+    def get_by_number(self, invoice_number):
+        snapshot = self._current()
+        if snapshot is None:
+            return self.store.get_by_number(invoice_number)
+        row = self._row_of_number(snapshot, invoice_number)
+        return snapshot.invoice(row) if row is not None else None
+
+    def _row_of_number(self, snapshot, invoice_number):
+        row = snapshot.row_of_number(invoice_number)
+        if row is None and isinstance(invoice_number, str) and invoice_number.isdigit():
+            row = snapshot.row_of_number(int(invoice_number))  # Same fallback as InvoiceStore._lookup_number()
+        return row
+
+    def _rows(self, snapshot, invoice_ids, invoice_numbers):
+        rows = {}
+        for invoice_id in invoice_ids:
+            rows[snapshot.row_of_id(invoice_id)] = None
+        for invoice_number in invoice_numbers:
+            rows[self._row_of_number(snapshot, invoice_number)] = None
+        rows.pop(None, None)
+        return list(rows)
+
+    def get_many(self, invoice_ids=(), invoice_numbers=()):
+        snapshot = self._current()
+        if snapshot is None:
+            return self.store.get_many(invoice_ids, invoice_numbers)
+        return [snapshot.invoice(row) for row in self._rows(snapshot, invoice_ids, invoice_numbers)]
+
+    def get_many_encoded(self, invoice_ids=(), invoice_numbers=()):
+        snapshot = self._current()
+        if snapshot is None:
+            return self.store.get_many_encoded(invoice_ids, invoice_numbers)
+        return [snapshot.record(row) for row in self._rows(snapshot, invoice_ids, invoice_numbers)]
+
+    def page(self, after=None, limit=None, filters=None):
+        snapshot = self._current()
+        if snapshot is None:
+            return self.store.page(after, limit, filters)
+        encoded, next_cursor = snapshot.page(after, limit, filters)
+        return [encoding.loads(data) for data in encoded], next_cursor
+
+    def page_encoded(self, after=None, limit=None, filters=None):
+        snapshot = self._current()
+        if snapshot is None:
+            return self.store.page_encoded(after, limit, filters)
+        return snapshot.page(after, limit, filters)
+
+    def report(self, group_by=REPORT_GROUPS):
+        snapshot = self._current()
+        if snapshot is None:
+            return self.store.report(group_by)
+        rollups = snapshot.rollups()
+        return {
+            group: [
+                {'key': k, 'invoice_count': count, 'revenue': cents / 100} for k, count, cents in rollups[group]
+            ]
+            for group in group_by
+        }
@@ -0,0 +1,61 @@
+import json
+import threading
+from collections import OrderedDict
+
+from django.core.serializers.json import DjangoJSONEncoder
+
+try:
+    import orjson
+except ImportError:  # Optional; the standard library encoder is used instead
+    orjson = None
+
+
+def _default(obj):
+    # Dates and Decimals, as DjangoJSONEncoder would encode them
+    return DjangoJSONEncoder().default(obj)
+
+
+if orjson is not None:
+    def dumps(obj):
+        """Encode obj as compact JSON bytes."""
+        return orjson.dumps(obj, default=_default)
+
+    loads = orjson.loads
+else:
+    _encoder = DjangoJSONEncoder(separators=(',', ':'), ensure_ascii=False)
+
+    def dumps(obj):
+        """Encode obj as compact JSON bytes."""
+        return _encoder.encode(obj).encode('utf-8')
+
+    loads = json.loads
+
+
+class ResponseCache:
+    """LRU of encoded response bodies, each tagged with the store version it was built from.
+
+    An entry is only returned while the store is still at that version, so
+    a mutation invalidates every entry without having to find them.
+    """
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, version):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] != version:
+                return None
+            self._entries.move_to_end(key)
+            return entry[1]
+
+    def set(self, key, version, body):
+        if self.maxsize <= 0:
+            return
+        with self._lock:
+            self._entries[key] = (version, body)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
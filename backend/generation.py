@@ -0,0 +1,33 @@
+import mmap
+import os
+import struct
+
+_COUNTER = struct.Struct('<Q')
+
+
+class GenerationCounter:
+    """A 64-bit counter in a small memory-mapped file, shared by every process that opens it.
+
+    Writers bump it after each commit; readers compare it with the value
+    they last saw, which is a read from shared memory rather than a
+    syscall, and only look at the invoice files when it has moved.
+    ``bump`` is a read-modify-write, so callers hold the store's FileLock.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            if os.fstat(fd).st_size < _COUNTER.size:
+                os.ftruncate(fd, _COUNTER.size)
+            self._mmap = mmap.mmap(fd, _COUNTER.size, access=mmap.ACCESS_WRITE)
+        finally:
+            os.close(fd)  # The mapping stays valid after the descriptor is closed
+
+    def read(self):
+        return _COUNTER.unpack_from(self._mmap)[0]
+
+    def bump(self):
+        generation = self.read() + 1
+        _COUNTER.pack_into(self._mmap, 0, generation)
+        return generation
@@ -0,0 +1,223 @@
+import os
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from django.db import connections
+
+from . import encoding, metrics
+from .filelock import FileLock
+from .store import DEFAULT_INVOICE_FILE_PATH
+
+DEFAULT_IDEMPOTENCY_CACHE_SIZE = 10000
+DEFAULT_IDEMPOTENCY_TTL = 24 * 60 * 60  # seconds
+# How long a key stays claimed by a request that never finished (its worker died), in seconds
+DEFAULT_IDEMPOTENCY_PENDING_TTL = 5 * 60
+
+# Longest Idempotency-Key accepted, so a key can never bloat the cache file
+MAX_KEY_LENGTH = 255
+
+REPLAYS = metrics.REGISTRY.counter(
+    'invoice_idempotent_replays_total', 'Write requests answered from the Idempotency-Key cache.', ('view',))
+
+
+def _encode_line(key, entry):
+    expires, fingerprint, status, content_type, body = entry
+    return encoding.dumps([key, expires, fingerprint, status, content_type, body.decode('utf-8')]) + b'\n'
+
+
+def _pending(fingerprint, expires):
+    """Entry marking a key as claimed by a request still being processed (its status is None)."""
+    return (expires, fingerprint, None, None, b'')
+
+
+class IdempotencyCache:
+    """Completed write responses by Idempotency-Key: an LRU with a TTL, shared through an append-only file.
+
+    Every saved response is appended to ``path`` as one JSON line, and each
+    worker reads the lines other workers appended since its last look before
+    answering a lookup, so a retry that lands on another worker is still
+    recognised. A lookup is a dict access plus a stat() of the file. Once
+    the file holds twice ``maxsize`` lines it is rewritten with just the
+    live entries.
+
+    A request claims its key before it runs by appending a pending entry
+    under the file lock, so a retry that arrives while the original is
+    still running, on this worker or any other, finds the key taken and is
+    refused instead of executed twice. The claim is replaced by the saved
+    response, or withdrawn if there is none to save; one left behind by a
+    worker that died lapses after ``pending_ttl`` seconds.
+    """
+
+    def __init__(self, path, maxsize=DEFAULT_IDEMPOTENCY_CACHE_SIZE, ttl=DEFAULT_IDEMPOTENCY_TTL, fsync=True,
+                 pending_ttl=DEFAULT_IDEMPOTENCY_PENDING_TTL):
+        self.path = path
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.pending_ttl = pending_ttl
+        self.fsync = fsync
+        self._file_lock = FileLock(path + '.lock')
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # key -> (expires, fingerprint, status, content_type, body)
+        self._in_flight = set()  # Keys claimed by this process and not yet saved or withdrawn
+        self._ino = None
+        self._offset = 0
+        self._lines = 0
+
+    def get(self, key):
+        """Return ``(fingerprint, status, content_type, body)`` saved for ``key``, or None.
+
+        ``status`` is None while the request that claimed the key is still
+        being processed.
+        """
+        with self._lock:
+            self._refresh()
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if entry[0] <= time.time():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return entry[1:]
+
+    def begin(self, key, fingerprint):
+        """Claim ``key`` for a request about to be processed, in every worker's view.
+
+        Returns None once the key is claimed, or, if another request got to
+        it first, what get() would return for it.
+        """
+        with self._lock, self._file_lock:
+            self._refresh()
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] > time.time():
+                return entry[1:]
+            self._append(key, _pending(fingerprint, time.time() + self.pending_ttl))
+            self._in_flight.add(key)
+            return None
+
+    def end(self, key):
+        """Withdraw this process's claim on ``key`` if set() did not replace it, so the key can be retried."""
+        with self._lock, self._file_lock:
+            if key not in self._in_flight:
+                return
+            self._in_flight.discard(key)
+            self._refresh()
+            self._append(key, _pending(None, 0))  # Already expired, so every reader drops the key
+
+    def set(self, key, fingerprint, status, content_type, body):
+        """Save the response to ``key`` and append it to the file for the other workers."""
+        entry = (time.time() + self.ttl, fingerprint, status, content_type, body)
+        with self._lock, self._file_lock:
+            self._refresh()
+            self._append(key, entry)
+            self._in_flight.discard(key)
+
+    def _append(self, key, entry):
+        """Record ``entry`` here and append it to the file; called with both locks held."""
+        line = _encode_line(key, entry)
+        if entry[0] > time.time():
+            self._remember(key, entry)
+        else:
+            self._entries.pop(key, None)
+        with open(self.path, 'ab') as f:
+            f.write(line)
+            f.flush()
+            if self.fsync:
+                os.fsync(f.fileno())
+            st = os.fstat(f.fileno())
+        if self._ino in (None, st.st_ino) and st.st_size == self._offset + len(line):
+            self._ino = st.st_ino
+            self._offset = st.st_size
+            self._lines += 1
+        if self._lines > 2 * self.maxsize:
+            self._compact()
+
+    def _remember(self, key, entry):
+        self._entries[key] = entry
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def _refresh(self):
+        """Pick up lines appended by other workers; start over if the file was compacted."""
+        try:
+            st = os.stat(self.path)
+        except FileNotFoundError:
+            self._ino, self._offset, self._lines = None, 0, 0
+            return
+        if st.st_ino != self._ino or st.st_size < self._offset:
+            self._entries.clear()
+            self._ino, self._offset, self._lines = st.st_ino, 0, 0
+        if st.st_size == self._offset:
+            return
+        with open(self.path, 'rb') as f:
+            f.seek(self._offset)
+            chunk = f.read(st.st_size - self._offset)
+        end = chunk.rfind(b'\n') + 1  # A partial last line is still being written
+        now = time.time()
+        for line in chunk[:end].splitlines():
+            try:
+                key, expires, fingerprint, status, content_type, body = encoding.loads(line)
+            except ValueError:
+                continue
+            self._lines += 1
+            if expires > now:
+                self._remember(key, (expires, fingerprint, status, content_type, body.encode('utf-8')))
+            else:
+                self._entries.pop(key, None)  # Expired, or a withdrawn claim
+        self._offset += end
+
+    def _compact(self):
+        """Rewrite the file with only the live entries; called with both locks held."""
+        now = time.time()
+        live = [(key, entry) for key, entry in self._entries.items() if entry[0] > now]
+        data = b''.join(_encode_line(key, entry) for key, entry in live)
+        directory = os.path.dirname(os.path.abspath(self.path))
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.' + os.path.basename(self.path) + '.', suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+                f.flush()
+                if self.fsync:
+                    os.fsync(f.fileno())
+            os.replace(tmp_path, self.path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        self._entries = OrderedDict(live)
+        self._ino = os.stat(self.path).st_ino
+        self._offset = len(data)
+        self._lines = len(live)
+
+
+_caches = {}
+_caches_lock = threading.Lock()
+
+
+def default_path():
+    """'<INVOICE_FILE_PATH>.idempotency', or next to the database on the SQLite backend."""
+    if getattr(settings, 'INVOICE_STORAGE_BACKEND', 'json') == 'sqlite':
+        return str(connections['default'].settings_dict['NAME']) + '.idempotency'
+    return str(getattr(settings, 'INVOICE_FILE_PATH', DEFAULT_INVOICE_FILE_PATH)) + '.idempotency'
+
+
+def get_idempotency_cache():
+    """Return the shared IdempotencyCache for the configured store."""
+    path = str(getattr(settings, 'INVOICE_IDEMPOTENCY_PATH', None) or default_path())
+    cache = _caches.get(path)
+    if cache is None:
+        with _caches_lock:
+            cache = _caches.get(path)
+            if cache is None:
+                cache = _caches[path] = IdempotencyCache(
+                    path,
+                    maxsize=getattr(settings, 'INVOICE_IDEMPOTENCY_CACHE_SIZE', DEFAULT_IDEMPOTENCY_CACHE_SIZE),
+                    ttl=getattr(settings, 'INVOICE_IDEMPOTENCY_TTL', DEFAULT_IDEMPOTENCY_TTL),
+                    fsync=getattr(settings, 'INVOICE_STORE_FSYNC', True),
+                    pending_ttl=getattr(settings, 'INVOICE_IDEMPOTENCY_PENDING_TTL', DEFAULT_IDEMPOTENCY_PENDING_TTL),
+                )
+    return cache
@@ -0,0 +1,133 @@
+import bisect
+
+
+class HashIndex:
+    """Maps a key extracted from each invoice to the set of invoice ids that have it.
+
+    ``key`` returns the value to index, or None to leave the invoice out.
+    """
+
+    def __init__(self, key):
+        self.key = key
+        self._ids = {}
+
+    def rebuild(self, invoices):
+        self._ids = {}
+        for invoice in invoices:
+            self.add(invoice)
+
+    def add(self, invoice):
+        k = self.key(invoice)
+        if k is not None:
+            self._ids.setdefault(k, set()).add(invoice['id'])
+
+    def remove(self, invoice):
+        k = self.key(invoice)
+        ids = self._ids.get(k)
+        if ids is not None:
+            ids.discard(invoice['id'])
+            if not ids:
+                del self._ids[k]
+
+    def lookup(self, k):
+        """Return the ids of invoices whose key equals k."""
+        return self._ids.get(k, set())
+
+
+class SortedIndex:
+    """Keeps (key, invoice id) pairs sorted by key for range and prefix queries.
+
+    Keys and ids live in two parallel lists, so lookups are a bisect on the
+    keys plus a slice of the ids: O(log n + k).
+    """
+
+    def __init__(self, key):
+        self.key = key
+        self._keys = []
+        self._ids = []
+
+    def rebuild(self, invoices):
+        pairs = []
+        for invoice in invoices:
+            k = self.key(invoice)
+            if k is not None:
+                pairs.append((k, invoice['id']))
+        pairs.sort()
+        self._keys = [k for k, _ in pairs]
+        self._ids = [invoice_id for _, invoice_id in pairs]
+
+    def add(self, invoice):
+        k = self.key(invoice)
+        if k is not None:
+            i = bisect.bisect_right(self._keys, k)
+            self._keys.insert(i, k)
+            self._ids.insert(i, invoice['id'])
+
+    def remove(self, invoice):
+        k = self.key(invoice)
+        if k is None:
+            return
+        lo = bisect.bisect_left(self._keys, k)
+        hi = bisect.bisect_right(self._keys, k, lo)
+        try:
+            i = self._ids.index(invoice['id'], lo, hi)
+        except ValueError:
+            return
+        del self._keys[i]
+        del self._ids[i]
+
+    def range(self, lo=None, hi=None):
+        """Return the ids of invoices with lo <= key <= hi (either bound may be None)."""
+        start = 0 if lo is None else bisect.bisect_left(self._keys, lo)
+        end = len(self._keys) if hi is None else bisect.bisect_right(self._keys, hi)
+        return self._ids[start:end]
+
+    def prefix(self, p):
+        """Return the ids of invoices whose (string) key starts with p."""
+        start = bisect.bisect_left(self._keys, p)
+        end = bisect.bisect_left(self._keys, p + '\U0010ffff', start)
+        return self._ids[start:end]
+
+
+class RollupIndex:
+    """Invoice count and revenue per group, such as per customer or per month.
+
+    ``key`` returns an invoice's group (or None to leave it out) and
+    ``amount`` its revenue in integer cents. ``add`` and ``remove`` apply
+    one invoice as a delta, so an update (remove old, add new) costs O(1)
+    and reading the rollup costs O(groups) rather than O(invoices).
+    """
+
+    def __init__(self, key, amount):
+        self.key = key
+        self.amount = amount
+        self._groups = {}
+
+    def __len__(self):
+        return len(self._groups)
+
+    def rebuild(self, invoices):
+        self._groups = {}
+        for invoice in invoices:
+            self.add(invoice)
+
+    def add(self, invoice):
+        self._apply(invoice, 1)
+
+    def remove(self, invoice):
+        self._apply(invoice, -1)
+
+    def _apply(self, invoice, sign):
+        k = self.key(invoice)
+        if k is None:
+            return
+        count, cents = self._groups.get(k, (0, 0))
+        count += sign
+        if count > 0:
+            self._groups[k] = (count, cents + sign * self.amount(invoice))
+        else:
+            self._groups.pop(k, None)
+
+    def groups(self):
+        """Return ``[(group, invoice count, revenue in cents)]`` sorted by group."""
+        return [(k, count, cents) for k, (count, cents) in sorted(self._groups.items())]
@@ -0,0 +1,24 @@
+import random
+
+from django.conf import settings
+
+# Fraction of calls log_sampled() lets through, unless INVOICE_LOG_SAMPLE_RATE says otherwise
+DEFAULT_LOG_SAMPLE_RATE = 0.01
+
+
+def log_sampled(logger, level, event, **fields):
+    """Log ``event`` with ``fields`` as key=value pairs, for a sample of the calls.
+
+    The level is checked first, so while it is disabled (DEBUG by default)
+    a call costs one comparison and the fields are never formatted. Of the
+    enabled calls only INVOICE_LOG_SAMPLE_RATE (0..1) are logged. The
+    fields are also attached to the record as ``record.fields`` for
+    structured (e.g. JSON) formatters.
+    """
+    if not logger.isEnabledFor(level):
+        return
+    rate = getattr(settings, 'INVOICE_LOG_SAMPLE_RATE', DEFAULT_LOG_SAMPLE_RATE)
+    if rate < 1 and random.random() >= rate:
+        return
+    pairs = ' '.join(f'{key}={value!r}' for key, value in fields.items())
+    logger.log(level, '%s %s', event, pairs, extra={'fields': fields})
@@ -0,0 +1,117 @@
+import json
+import multiprocessing
+import platform
+import sys
+import time
+
+import django
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+
+from backend import benchmark
+
+
+def _run_in_child(queue, kwargs):
+    try:
+        queue.put(('ok', benchmark.run_size(**kwargs)))
+    except Exception as e:
+        queue.put(('error', f'{type(e).__name__}: {e}'))
+
+
+class Command(BaseCommand):
+    help = ('Seed synthetic stores of the given sizes and benchmark the list, get, create, update and delete '
+            'endpoints; prints throughput, p50/p99 latency and peak RSS as JSON.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sizes', default='1000,100000,1000000',
+                            help='Comma-separated numbers of invoices to seed (default: 1000,100000,1000000).')
+        parser.add_argument('--backend', choices=('json', 'sqlite'), default='json', help='Storage backend to seed.')
+        parser.add_argument('--requests', type=int, default=200, help='Requests per endpoint in the sequential run.')
+        parser.add_argument('--max-details', type=int, default=10, help='Most line items per synthetic invoice.')
+        parser.add_argument('--seed', type=int, default=0, help='Random seed, so runs are repeatable.')
+        parser.add_argument('--page-size', type=int, default=50, help='limit= of the list requests.')
+        parser.add_argument('--concurrency', type=int, default=0,
+                            help='Also run a mixed workload from this many concurrent clients.')
+        parser.add_argument('--mode', choices=('wsgi', 'asgi', 'http'), default='wsgi',
+                            help='Concurrent clients: threads on the WSGI handler, tasks on the ASGI handler, '
+                                 'or threads sending HTTP to --url.')
+        parser.add_argument('--url', help='Base URL of a running server for --mode http.')
+        parser.add_argument('--set', action='append', default=[], metavar='NAME=VALUE',
+                            help='Override a setting for the run, e.g. --set INVOICE_STORE_JOURNAL=true '
+                                 '(VALUE is parsed as JSON when it can be).')
+        parser.add_argument('--output', help='Write the JSON results to this file instead of stdout.')
+        parser.add_argument('--baseline', help='Results file of an earlier run to compare against.')
+        parser.add_argument('--in-process', action='store_true',
+                            help='Run every size in this process instead of a fresh one each (peak RSS then '
+                                 'accumulates across sizes).')
+
+    def handle(self, *args, **options):
+        try:
+            sizes = [int(size) for size in options['sizes'].split(',') if size.strip()]
+        except ValueError:
+            raise CommandError('--sizes must be comma-separated integers.')
+        if options['mode'] == 'http' and not options['url']:
+            raise CommandError('--mode http needs --url.')
+        extra_settings = {}
+        for item in options['set']:
+            name, sep, value = item.partition('=')
+            if not sep:
+                raise CommandError(f'--set expects NAME=VALUE, got {item!r}.')
+            try:
+                extra_settings[name] = json.loads(value)
+            except ValueError:
+                extra_settings[name] = value
+
+        results = []
+        for size in sizes:
+            kwargs = {
+                'size': size,
+                'backend': options['backend'],
+                'requests': options['requests'],
+                'max_details': options['max_details'],
+                'seed': options['seed'],
+                'page_size': options['page_size'],
+                'concurrency': options['concurrency'],
+                'mode': options['mode'],
+                'url': options['url'],
+                'extra_settings': extra_settings,
+            }
+            self.stderr.write(f'Benchmarking {size} invoices...')
+            results.append(self._run(kwargs, options['in_process']))
+
+        report = {
+            'meta': {
+                'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+                'python': platform.python_version(),
+                'django': django.get_version(),
+                'platform': platform.platform(),
+                'argv': sys.argv[1:],
+            },
+            'results': results,
+        }
+        if options['baseline']:
+            with open(options['baseline']) as f:
+                report['comparison'] = benchmark.compare(results, json.load(f))
+
+        output = json.dumps(report, indent=2)
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                f.write(output + '\n')
+            self.stderr.write(self.style.SUCCESS(f'Wrote {options["output"]}.'))
+        else:
+            self.stdout.write(output)
+
+    def _run(self, kwargs, in_process):
+        """Run one size, in a forked child where possible so its peak RSS is its own."""
+        if in_process or 'fork' not in multiprocessing.get_all_start_methods():
+            return benchmark.run_size(**kwargs)
+        connections.close_all()  # The child must not share the parent's database connections
+        context = multiprocessing.get_context('fork')
+        queue = context.Queue()
+        child = context.Process(target=_run_in_child, args=(queue, kwargs))
+        child.start()
+        status, value = queue.get()
+        child.join()
+        if status == 'error':
+            raise CommandError(f'Benchmark of {kwargs["size"]} invoices failed: {value}')
+        return value
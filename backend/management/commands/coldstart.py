@@ -0,0 +1,35 @@
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+
+from backend import coldstart
+
+
+class Command(BaseCommand):
+    help = ('Import each WSGI entry point in a fresh interpreter, send it one request, and report the '
+            'cold-start time and what each imported module cost.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--entry', action='append', default=[],
+                            help='Entry point module to measure; repeatable (default: '
+                                 + ' and '.join(coldstart.ENTRY_POINTS) + ').')
+        parser.add_argument('--path', default='/api/invoices/?limit=1', help='Path of the first request.')
+        parser.add_argument('--runs', type=int, default=3, help='Cold starts per entry point; medians are reported.')
+        parser.add_argument('--top', type=int, default=20, help='Number of modules and packages to list.')
+        parser.add_argument('--json', action='store_true', help='Print the results as JSON instead of tables.')
+
+    def handle(self, *args, **options):
+        if options['runs'] < 1:
+            raise CommandError('--runs must be at least 1.')
+        results = []
+        for entry in options['entry'] or coldstart.ENTRY_POINTS:
+            self.stderr.write(f'Cold-starting {entry}...')
+            try:
+                results.append(coldstart.report(entry, options['path'], options['runs'], options['top']))
+            except RuntimeError as e:
+                raise CommandError(str(e))
+
+        if options['json']:
+            self.stdout.write(json.dumps(results, indent=2))
+        else:
+            self.stdout.write('\n\n'.join(coldstart.format_report(result) for result in results))
@@ -0,0 +1,15 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from backend.store import get_json_store
+
+
+class Command(BaseCommand):
+    help = 'Write the memory-mapped columnar snapshot of the JSON store (INVOICE_COLUMNAR_SNAPSHOT).'
+
+    def handle(self, *args, **options):
+        if not getattr(settings, 'INVOICE_COLUMNAR_SNAPSHOT', False):
+            raise CommandError('Set INVOICE_COLUMNAR_SNAPSHOT = True in settings.py first.')
+        store = get_json_store()
+        store.export_columns()
+        self.stdout.write(self.style.SUCCESS(f'Exported {len(store)} invoices to {store.columnar_path}.'))
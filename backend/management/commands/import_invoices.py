@@ -0,0 +1,29 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from backend.models import Invoice, RevenueRollup, StoreVersion
+from backend.sqlite_store import SqliteInvoiceStore
+from backend.store import get_json_store
+
+
+class Command(BaseCommand):
+    help = 'Copy invoices from the JSON store (invoices.json and its journal) into the SQLite tables.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--clear', action='store_true', help='Delete existing invoices from the database first.')
+        parser.add_argument('--batch-size', type=int, default=1000, help='Invoices inserted per batch.')
+
+    def handle(self, *args, **options):
+        invoices = get_json_store().all()
+        store = SqliteInvoiceStore()
+        batch_size = options['batch_size']
+
+        with transaction.atomic():
+            if options['clear']:
+                Invoice.objects.all().delete()
+                RevenueRollup.objects.all().delete()
+                StoreVersion.objects.bump()
+            for start in range(0, len(invoices), batch_size):
+                store.insert(invoices[start:start + batch_size])
+
+        self.stdout.write(self.style.SUCCESS(f'Imported {len(invoices)} invoices.'))
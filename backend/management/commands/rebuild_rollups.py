@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+
+from backend.store import get_store
+
+
+class Command(BaseCommand):
+    help = 'Recompute the revenue rollups behind /api/invoices/reports/ from the stored invoices.'
+
+    def handle(self, *args, **options):
+        groups = get_store().rebuild_rollups()
+        self.stdout.write(self.style.SUCCESS(f'Rebuilt {groups} rollup groups.'))
@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+
+from backend.store import get_store
+
+
+class Command(BaseCommand):
+    help = 'Recompute every line total and invoice total from quantity * unit_price in integer cents.'
+
+    def handle(self, *args, **options):
+        summary = get_store().recompute_totals()
+        self.stdout.write(self.style.SUCCESS(
+            f"Checked {summary['checked']} invoices: {summary['changed']} corrected, "
+            f"{summary['skipped']} skipped (unparseable details)."
+        ))
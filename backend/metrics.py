@@ -0,0 +1,182 @@
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+
+# Upper bounds (seconds) of the latency histograms, as in the Prometheus client libraries
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_labels(names, values, extra=()):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in (*zip(names, values), *extra)]
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    """A monotonically increasing total per combination of label values."""
+
+    kind = 'counter'
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(labels[name] for name in self.labelnames)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def samples(self):
+        with self._lock:
+            values = sorted(self._values.items())
+        for key, value in values:
+            yield self.name, _format_labels(self.labelnames, key), value
+
+
+class Histogram:
+    """Counts of observations per bucket, plus their sum, per combination of label values."""
+
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets))
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(labels[name] for name in self.labelnames)
+        index = bisect.bisect_left(self.buckets, value)  # Buckets are upper bounds, inclusive
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                entry = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0]
+            entry[0][index] += 1
+            entry[1] += value
+
+    @contextmanager
+    def time(self, **labels):
+        """Observe how long the ``with`` block took, in seconds."""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def samples(self):
+        with self._lock:
+            values = sorted((key, list(counts), total) for key, (counts, total) in self._values.items())
+        for key, counts, total in values:
+            cumulative = 0
+            for bound, count in zip((*self.buckets, float('inf')), counts):
+                cumulative += count
+                labels = _format_labels(self.labelnames, key, [('le', _format_value(bound))])
+                yield self.name + '_bucket', labels, cumulative
+            yield self.name + '_sum', _format_labels(self.labelnames, key), total
+            yield self.name + '_count', _format_labels(self.labelnames, key), cumulative
+
+
+class Gauge:
+    """A value read from ``function`` whenever the metrics are rendered."""
+
+    kind = 'gauge'
+
+    def __init__(self, name, documentation, function):
+        self.name = name
+        self.documentation = documentation
+        self.function = function
+
+    def samples(self):
+        yield self.name, '', self.function()
+
+
+class Registry:
+    """The metrics of this process, rendered in the Prometheus text exposition format."""
+
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def _register(self, metric):
+        with self._lock:
+            return self._metrics.setdefault(metric.name, metric)
+
+    def counter(self, name, documentation, labelnames=()):
+        return self._register(Counter(name, documentation, labelnames))
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self._register(Histogram(name, documentation, labelnames, buckets))
+
+    def gauge(self, name, documentation, function):
+        return self._register(Gauge(name, documentation, function))
+
+    def render(self):
+        """Return every metric as Prometheus text, skipping gauges whose function fails."""
+        lines = []
+        with self._lock:
+            metrics = sorted(self._metrics.values(), key=lambda metric: metric.name)
+        for metric in metrics:
+            try:
+                samples = list(metric.samples())
+            except Exception:
+                continue
+            lines.append(f'# HELP {metric.name} {metric.documentation}')
+            lines.append(f'# TYPE {metric.name} {metric.kind}')
+            lines.extend(f'{name}{labels} {_format_value(value)}' for name, labels, value in samples)
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+# Filled in by backend.middleware.MetricsMiddleware
+REQUEST_DURATION = REGISTRY.histogram(
+    'invoice_http_request_duration_seconds',
+    'Time from the request reaching Django to the response being returned (excluding any streamed content).',
+    ('method', 'view', 'status'),
+)
+
+# Filled in by the JSON store (backend.store)
+FILE_READ_BYTES = REGISTRY.counter(
+    'invoice_store_file_read_bytes_total', 'Bytes read from the invoice files.', ('file',))
+FILE_READ_DURATION = REGISTRY.histogram(
+    'invoice_store_file_read_duration_seconds', 'Time spent reading the invoice files.', ('file',))
+FILE_WRITE_BYTES = REGISTRY.counter(
+    'invoice_store_file_write_bytes_total', 'Bytes written to the invoice files.', ('file',))
+FILE_WRITE_DURATION = REGISTRY.histogram(
+    'invoice_store_file_write_duration_seconds', 'Time spent writing (and fsyncing) the invoice files.', ('file',))
+JSON_DURATION = REGISTRY.histogram(
+    'invoice_store_json_duration_seconds', 'Time spent parsing and encoding invoice JSON.', ('op', 'source'))
+LOCK_WAIT = REGISTRY.histogram(
+    'invoice_store_lock_wait_seconds',
+    "Time writers waited for the store's thread lock and the lock file shared by all workers.",
+    ('lock',),
+)
+
+
+def record_read(file, seconds, size):
+    """Record one read of ``size`` bytes from one of the invoice files ('snapshot', 'journal', ...)."""
+    FILE_READ_DURATION.observe(seconds, file=file)
+    FILE_READ_BYTES.inc(size, file=file)
+
+
+def record_write(file, seconds, size):
+    """Record one write of ``size`` bytes to one of the invoice files."""
+    FILE_WRITE_DURATION.observe(seconds, file=file)
+    FILE_WRITE_BYTES.inc(size, file=file)
@@ -0,0 +1,44 @@
+import time
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+
+from . import metrics
+
+
+class MetricsMiddleware:
+    """Record every request's latency in the invoice_http_request_duration_seconds histogram.
+
+    Requests are labelled with the name of the URL pattern that served them
+    rather than the path, so ids in URLs do not create a series each. Works
+    both under WSGI and ASGI; under ASGI it stays async, so the async views
+    are not pushed onto a thread. Streaming responses are timed up to the
+    view returning them, before any of their content is produced.
+    """
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.async_mode = iscoroutinefunction(get_response)
+        if self.async_mode:
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if self.async_mode:
+            return self.__acall__(request)
+        started = time.perf_counter()
+        response = self.get_response(request)
+        self._record(request, response, time.perf_counter() - started)
+        return response
+
+    async def __acall__(self, request):
+        started = time.perf_counter()
+        response = await self.get_response(request)
+        self._record(request, response, time.perf_counter() - started)
+        return response
+
+    def _record(self, request, response, seconds):
+        match = getattr(request, 'resolver_match', None)
+        view = (match.url_name or match.view_name) if match else 'unmatched'
+        metrics.REQUEST_DURATION.observe(seconds, method=request.method, view=view, status=response.status_code)
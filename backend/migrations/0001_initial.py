@@ -0,0 +1,46 @@
+# Generated by Django 5.1.3 on 2026-10-18 13:00
+
+import django.core.validators
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = [
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Invoice',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('invoice_number', models.CharField(max_length=50, unique=True)),
+                ('customer_name', models.CharField(max_length=100)),
+                ('date', models.DateField(blank=True, null=True)),
+                ('total_amount', models.DecimalField(decimal_places=2, default=0.0, max_digits=10)),
+            ],
+            options={
+                'db_table': 'invoice',
+                'indexes': [models.Index(fields=['customer_name'], name='invoice_customer_name_idx'), models.Index(fields=['date'], name='invoice_date_idx'), models.Index(fields=['total_amount'], name='invoice_total_amount_idx')],
+            },
+        ),
+        migrations.CreateModel(
+            name='InvoiceDetail',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('line_number', models.PositiveIntegerField(default=1)),
+                ('description', models.CharField(max_length=255)),
+                ('quantity', models.PositiveIntegerField(validators=[django.core.validators.MinValueValidator(1)])),
+                ('unit_price', models.DecimalField(decimal_places=2, max_digits=10)),
+                ('line_total', models.DecimalField(decimal_places=2, default=0.0, max_digits=10)),
+                ('invoice', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='details', to='backend.invoice')),
+            ],
+            options={
+                'ordering': ['line_number'],
+                'constraints': [models.UniqueConstraint(fields=('invoice', 'line_number'), name='invoice_detail_line_number_unique')],
+            },
+        ),
+    ]
@@ -0,0 +1,36 @@
+# Generated by Django 5.1.3 on 2026-10-18 13:05
+
+from django.db import migrations, models
+
+from backend.models.revenueRollup import rebuild_rollups
+
+
+def populate_rollups(apps, schema_editor):
+    rebuild_rollups(apps.get_model('backend', 'Invoice'), apps.get_model('backend', 'RevenueRollup'),
+                    using=schema_editor.connection.alias)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('backend', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RevenueRollup',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('dimension', models.CharField(choices=[('customer', 'Customer'), ('day', 'Day'), ('month', 'Month')], max_length=10)),
+                ('key', models.CharField(max_length=100)),
+                ('invoice_count', models.PositiveIntegerField(default=0)),
+                ('revenue', models.DecimalField(decimal_places=2, default=0, max_digits=14)),
+            ],
+            options={
+                'db_table': 'revenue_rollup',
+                'ordering': ['dimension', 'key'],
+                'constraints': [models.UniqueConstraint(fields=('dimension', 'key'), name='revenue_rollup_dimension_key_uniq')],
+            },
+        ),
+        migrations.RunPython(populate_rollups, migrations.RunPython.noop),
+    ]
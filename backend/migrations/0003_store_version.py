@@ -0,0 +1,23 @@
+# Generated by Django 5.1.3 on 2026-10-18 13:07
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('backend', '0002_revenue_rollup'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StoreVersion',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('version', models.PositiveBigIntegerField(default=0)),
+            ],
+            options={
+                'db_table': 'store_version',
+            },
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 5.1.3 on 2026-10-18 13:28
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('backend', '0003_store_version'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='IdSequence',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('last_id', models.PositiveBigIntegerField(default=0)),
+            ],
+            options={
+                'db_table': 'id_sequence',
+            },
+        ),
+    ]
@@ -0,0 +1,19 @@
+# Generated by Django 5.1.3 on 2026-10-18 13:58
+
+import backend.models.storeVersion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('backend', '0004_idsequence'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='storeversion',
+            name='epoch',
+            field=models.CharField(default=backend.models.storeVersion.new_epoch, max_length=32),
+        ),
+    ]
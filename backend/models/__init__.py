@@ -1,2 +1,5 @@
+from .idSequence import IdSequence
 from .invoice import Invoice
 from .invoiceDetail import InvoiceDetail
+from .revenueRollup import RevenueRollup
+from .storeVersion import StoreVersion
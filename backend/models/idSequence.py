@@ -0,0 +1,37 @@
+from django.db import models, transaction
+
+
+class IdSequenceQuerySet(models.QuerySet):
+    def lease(self, count, floor=0):
+        """Reserve ``count`` consecutive invoice ids above both the sequence and ``floor``; return the first.
+
+        The read and the write share one IMMEDIATE transaction, so concurrent
+        workers are serialized by SQLite's write lock.
+        """
+        with transaction.atomic(using=self.db):
+            last = self.filter(pk=IdSequence.SINGLETON_ID).values_list('last_id', flat=True).first()
+            start = max(last or 0, floor) + 1
+            if not self.filter(pk=IdSequence.SINGLETON_ID).update(last_id=start + count - 1):
+                self.create(pk=IdSequence.SINGLETON_ID, last_id=start + count - 1)
+        return start
+
+
+class IdSequence(models.Model):
+    """A single row holding the last invoice id leased to any worker.
+
+    SqliteInvoiceStore leases blocks of ids from it (see
+    backend.sequence.BlockAllocator), so deleted ids are never handed out
+    again and concurrent workers never collide.
+    """
+
+    SINGLETON_ID = 1
+
+    last_id = models.PositiveBigIntegerField(default=0)
+
+    objects = IdSequenceQuerySet.as_manager()
+
+    def __str__(self):
+        return str(self.last_id)
+
+    class Meta:
+        db_table = 'id_sequence'
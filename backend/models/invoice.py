@@ -1,19 +1,63 @@
+from decimal import Decimal
+
 from django.db import models
+from django.db.models import OuterRef, Subquery, Sum, Value
+from django.db.models.functions import Coalesce
 from django.core.validators import MinValueValidator
 
+
+class InvoiceQuerySet(models.QuerySet):
+    def recalculate_totals(self):
+        """Recompute total_amount from the details of every invoice in the queryset.
+
+        Runs as a single UPDATE ... SET total_amount = (SELECT SUM(line_total) ...),
+        so no detail rows are loaded into Python.
+        """
+        detail_model = self.model._meta.get_field('details').related_model
+        line_totals = (
+            detail_model.objects.filter(invoice=OuterRef('pk'))
+            .order_by()
+            .values('invoice')
+            .annotate(total=Sum('line_total'))
+            .values('total')
+        )
+        return self.update(total_amount=Coalesce(
+            Subquery(line_totals), Value(Decimal(0)), output_field=models.DecimalField(max_digits=10, decimal_places=2)
+        ))
+
+
 class Invoice(models.Model):
     invoice_number = models.CharField(max_length=50, unique=True)  # Unique invoice number
     customer_name = models.CharField(max_length=100)  # Customer name
-    date = models.DateField()  # Date of the invoice
-    total_amount = models.DecimalField(max_digits=10, decimal_places=2, default=0.00)  # Total amount of the invoice
+    date = models.DateField(null=True, blank=True)  # Date of the invoice (optional, as in the JSON store)
+    # Total amount of the invoice, kept up to date in the database by InvoiceDetail saves and deletes
+    total_amount = models.DecimalField(max_digits=10, decimal_places=2, default=0.00)
+
+    objects = InvoiceQuerySet.as_manager()
 
     def __str__(self):
         return self.invoice_number
 
     def save(self, *args, **kwargs):
-        # Calculate total amount by summing the line_total of each related InvoiceDetail
-        self.total_amount = sum(detail.line_total for detail in self.details.all())
+        # Details adjust total_amount with F() expressions, so an invoice loaded earlier may hold a
+        # stale total; don't write it back when saving other changes to an existing invoice
+        if not self._state.adding and kwargs.get('update_fields') is None and not kwargs.get('force_insert'):
+            deferred = self.get_deferred_fields()
+            kwargs['update_fields'] = [
+                field.name for field in self._meta.concrete_fields
+                if not field.primary_key and field.name != 'total_amount' and field.attname not in deferred
+            ]
         super().save(*args, **kwargs)
 
+    def recalculate_total(self):
+        """Recompute total_amount from the details with one aggregate query and refresh it."""
+        Invoice.objects.filter(pk=self.pk).recalculate_totals()
+        self.refresh_from_db(fields=['total_amount'])
+
     class Meta:
         db_table = 'invoice'  # Explicitly set the table name to 'invoice'
+        indexes = [
+            models.Index(fields=['customer_name'], name='invoice_customer_name_idx'),
+            models.Index(fields=['date'], name='invoice_date_idx'),
+            models.Index(fields=['total_amount'], name='invoice_total_amount_idx'),
+        ]
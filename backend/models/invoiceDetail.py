@@ -1,15 +1,111 @@
-from django.db import models
+from decimal import Decimal
+
+from django.db import models, transaction
+from django.db.models import F, Sum
 from django.core.validators import MinValueValidator
+from .. import money
 from .invoice import Invoice  # Import the Invoice model
 
+
+def calculate_line_total(quantity, unit_price):
+    """quantity * unit_price as a two-place Decimal, computed in integer cents."""
+    return money.to_decimal(money.line_total(quantity or 0, unit_price or 0))
+
+
+def _add_to_invoice_total(invoice_id, delta, using=None):
+    """Adjust an invoice's stored total by delta in one UPDATE, without loading its details."""
+    if invoice_id is not None and delta:
+        Invoice.objects.using(using).filter(pk=invoice_id).update(total_amount=F('total_amount') + delta)
+
+
+class InvoiceDetailQuerySet(models.QuerySet):
+    def bulk_create_for(self, invoice, details, batch_size=None):
+        """Insert many details of one invoice with bulk_create and a single total update.
+
+        Saving details one by one costs an INSERT and an UPDATE each; this
+        costs one INSERT per batch plus one UPDATE for the whole invoice.
+        """
+        added = Decimal(0)
+        for detail in details:
+            detail.invoice = invoice
+            detail.line_total = calculate_line_total(detail.quantity, detail.unit_price)
+            added += detail.line_total
+        with transaction.atomic(using=self.db):
+            created = self.bulk_create(details, batch_size=batch_size)
+            _add_to_invoice_total(invoice.pk, added, using=self.db)
+        invoice.total_amount = Decimal(str(invoice.total_amount)) + added
+        return created
+
+    def delete(self):
+        """Delete the details and subtract their line totals from each affected invoice."""
+        with transaction.atomic(using=self.db):
+            removed = list(self.order_by().values('invoice_id').annotate(total=Sum('line_total')))
+            result = super().delete()
+            for row in removed:
+                _add_to_invoice_total(row['invoice_id'], -row['total'], using=self.db)
+        return result
+
+    delete.alters_data = True
+    delete.queryset_only = True
+
+
 class InvoiceDetail(models.Model):
     invoice = models.ForeignKey(Invoice, related_name='details', on_delete=models.CASCADE)  # ForeignKey to the Invoice model
+    line_number = models.PositiveIntegerField(default=1)  # Detail id within its invoice (the 'id' of a detail in the API)
     description = models.CharField(max_length=255)  # Description of the product
     quantity = models.PositiveIntegerField(validators=[MinValueValidator(1)])  # Quantity of the product
     unit_price = models.DecimalField(max_digits=10, decimal_places=2)  # Unit price of the product
     line_total = models.DecimalField(max_digits=10, decimal_places=2, default=0.00)  # Line total, calculated as quantity * unit_price
 
+    objects = InvoiceDetailQuerySet.as_manager()
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance._remember_saved_state()
+        return instance
+
+    def _remember_saved_state(self):
+        # What the database currently counts towards the invoice total for this row
+        self._saved_invoice_id = self.__dict__.get('invoice_id')
+        self._saved_line_total = self.__dict__.get('line_total')
+
     def save(self, *args, **kwargs):
         # Automatically calculate line_total before saving the detail
-        self.line_total = self.quantity * self.unit_price
-        super().save(*args, **kwargs)
+        self.line_total = calculate_line_total(self.quantity, self.unit_price)
+        using = kwargs.get('using') or self._state.db
+
+        if self._state.adding:
+            old_invoice_id, old_line_total = None, Decimal(0)
+        elif getattr(self, '_saved_line_total', None) is not None:
+            old_invoice_id, old_line_total = self._saved_invoice_id, Decimal(str(self._saved_line_total))
+        else:
+            # Deferred or never loaded: ask the database what it had
+            old = InvoiceDetail.objects.using(using).filter(pk=self.pk).values('invoice_id', 'line_total').first()
+            old_invoice_id, old_line_total = (old['invoice_id'], old['line_total']) if old else (None, Decimal(0))
+
+        # Apply the change to the invoice total as a delta instead of re-summing every detail
+        with transaction.atomic(using=using):
+            super().save(*args, **kwargs)
+            if old_invoice_id == self.invoice_id:
+                _add_to_invoice_total(self.invoice_id, self.line_total - old_line_total, using=using)
+            else:
+                _add_to_invoice_total(old_invoice_id, -old_line_total, using=using)
+                _add_to_invoice_total(self.invoice_id, self.line_total, using=using)
+        self._remember_saved_state()
+
+    def delete(self, *args, **kwargs):
+        using = kwargs.get('using') or self._state.db
+        line_total = getattr(self, '_saved_line_total', None)
+        invoice_id = getattr(self, '_saved_invoice_id', self.invoice_id)
+        with transaction.atomic(using=using):
+            result = super().delete(*args, **kwargs)
+            _add_to_invoice_total(invoice_id, -Decimal(str(line_total if line_total is not None else self.line_total)),
+                                  using=using)
+        return result
+
+    class Meta:
+        ordering = ['line_number']
+        constraints = [
+            models.UniqueConstraint(fields=['invoice', 'line_number'], name='invoice_detail_line_number_unique'),
+        ]
@@ -0,0 +1,119 @@
+from decimal import Decimal
+
+from django.db import models, transaction
+from django.db.models import Count, Sum
+
+CUSTOMER = 'customer'
+DAY = 'day'
+MONTH = 'month'
+
+
+def rollup_groups(invoice):
+    """Return the (dimension, key) rollup groups an Invoice row counts towards."""
+    groups = [(CUSTOMER, invoice.customer_name)]
+    if invoice.date is not None:
+        groups.append((DAY, invoice.date.isoformat()))
+        groups.append((MONTH, invoice.date.strftime('%Y-%m')))
+    return groups
+
+
+def rebuild_rollups(invoice_model, rollup_model, using='default'):
+    """Recompute every rollup row with GROUP BY queries and return the number of rows.
+
+    Takes the models as arguments so the migration that creates the table can
+    run it against the historical models.
+    """
+    invoices = invoice_model.objects.using(using).order_by()
+    rows = []
+    for row in invoices.values('customer_name').annotate(count=Count('id'), revenue=Sum('total_amount')):
+        rows.append(rollup_model(dimension=CUSTOMER, key=row['customer_name'],
+                                 invoice_count=row['count'], revenue=row['revenue']))
+
+    months = {}
+    days = invoices.filter(date__isnull=False).values('date').annotate(count=Count('id'), revenue=Sum('total_amount'))
+    for row in days:
+        rows.append(rollup_model(dimension=DAY, key=row['date'].isoformat(),
+                                 invoice_count=row['count'], revenue=row['revenue']))
+        count, revenue = months.get(row['date'].strftime('%Y-%m'), (0, Decimal(0)))
+        months[row['date'].strftime('%Y-%m')] = (count + row['count'], revenue + row['revenue'])
+    for month, (count, revenue) in months.items():
+        rows.append(rollup_model(dimension=MONTH, key=month, invoice_count=count, revenue=revenue))
+
+    with transaction.atomic(using=using):
+        rollup_model.objects.using(using).all().delete()
+        rollup_model.objects.using(using).bulk_create(rows, batch_size=500)
+    return len(rows)
+
+
+class RevenueRollupQuerySet(models.QuerySet):
+    def apply(self, removed=(), added=()):
+        """Subtract the removed Invoice rows from their groups and add the added ones.
+
+        Pass the old and new rows of an update to apply just the difference.
+        Costs a few queries per call however many invoices are passed, so
+        bulk imports keep their rollups current too. Run inside the
+        transaction that writes the invoices.
+        """
+        deltas = {}
+        for sign, invoices in ((-1, removed), (1, added)):
+            for invoice in invoices:
+                for group in rollup_groups(invoice):
+                    count, revenue = deltas.get(group, (0, Decimal(0)))
+                    deltas[group] = (count + sign, revenue + sign * Decimal(str(invoice.total_amount)))
+        deltas = {group: delta for group, delta in deltas.items() if delta != (0, 0)}
+        if not deltas:
+            return
+
+        existing = {}
+        for dimension in {dimension for dimension, _ in deltas}:
+            keys = [key for d, key in deltas if d == dimension]
+            for start in range(0, len(keys), 500):  # Stay under SQLite's bound-parameter limit
+                for row in self.filter(dimension=dimension, key__in=keys[start:start + 500]):
+                    existing[(dimension, row.key)] = row
+
+        changed, emptied, created = [], [], []
+        for (dimension, key), (count, revenue) in deltas.items():
+            row = existing.get((dimension, key))
+            if row is None:
+                created.append(self.model(dimension=dimension, key=key, invoice_count=count, revenue=revenue))
+                continue
+            row.invoice_count += count
+            row.revenue += revenue
+            (changed if row.invoice_count > 0 else emptied).append(row)
+
+        self.filter(pk__in=[row.pk for row in emptied]).delete()
+        self.bulk_update(changed, ['invoice_count', 'revenue'], batch_size=500)
+        self.bulk_create(created, batch_size=500)
+
+    def rebuild(self):
+        """Recompute all rollups from the invoice table; see rebuild_rollups()."""
+        from .invoice import Invoice
+        return rebuild_rollups(Invoice, self.model, using=self.db)
+
+
+class RevenueRollup(models.Model):
+    """Invoice count and revenue for one customer, day or month.
+
+    Kept current by SqliteInvoiceStore, which applies each write's old and
+    new totals as a delta, so reports read one row per group instead of
+    aggregating the invoice table.
+    """
+
+    DIMENSION_CHOICES = [(CUSTOMER, 'Customer'), (DAY, 'Day'), (MONTH, 'Month')]
+
+    dimension = models.CharField(max_length=10, choices=DIMENSION_CHOICES)  # What the invoices are grouped by
+    key = models.CharField(max_length=100)  # Customer name, YYYY-MM-DD or YYYY-MM
+    invoice_count = models.PositiveIntegerField(default=0)
+    revenue = models.DecimalField(max_digits=14, decimal_places=2, default=0)
+
+    objects = RevenueRollupQuerySet.as_manager()
+
+    def __str__(self):
+        return f'{self.dimension} {self.key}'
+
+    class Meta:
+        db_table = 'revenue_rollup'
+        ordering = ['dimension', 'key']
+        constraints = [
+            models.UniqueConstraint(fields=['dimension', 'key'], name='revenue_rollup_dimension_key_uniq'),
+        ]
@@ -0,0 +1,51 @@
+import uuid
+
+from django.db import models
+from django.db.models import F
+
+
+def new_epoch():
+    return uuid.uuid4().hex
+
+
+class StoreVersionQuerySet(models.QuerySet):
+    def bump(self):
+        """Increment the version; call inside the transaction that changes invoice data."""
+        if not self.filter(pk=StoreVersion.SINGLETON_ID).update(version=F('version') + 1):
+            self.create(pk=StoreVersion.SINGLETON_ID, version=1)
+
+    def current(self):
+        """Return the current version with a single primary-key lookup."""
+        return self.filter(pk=StoreVersion.SINGLETON_ID).values_list('version', flat=True).first() or 0
+
+    def token(self):
+        """Return 'epoch.version' with a single primary-key lookup, or '0' before the first write.
+
+        Every database counts its versions from 1, so the epoch keeps a
+        recreated or swapped database from matching ETags and cached bodies
+        of the one it replaced.
+        """
+        row = self.filter(pk=StoreVersion.SINGLETON_ID).values_list('epoch', 'version').first()
+        return '%s.%d' % row if row else '0'
+
+
+class StoreVersion(models.Model):
+    """A single row counting committed changes to the invoice tables.
+
+    SqliteInvoiceStore bumps it in every write transaction, so ETags can be
+    checked with one primary-key read instead of looking at invoice rows.
+    """
+
+    SINGLETON_ID = 1
+
+    version = models.PositiveBigIntegerField(default=0)
+    # Random, set when the row is created with the database's first write
+    epoch = models.CharField(max_length=32, default=new_epoch)
+
+    objects = StoreVersionQuerySet.as_manager()
+
+    def __str__(self):
+        return str(self.version)
+
+    class Meta:
+        db_table = 'store_version'
@@ -0,0 +1,137 @@
+import re
+from decimal import ROUND_HALF_UP, Decimal, InvalidOperation
+
+try:
+    import numpy
+except ImportError:  # Optional; batch_totals() falls back to a plain loop
+    numpy = None
+
+CENTS = 100
+
+# Largest quantity and amount (in cents) every store can hold: the SQLite columns are a
+# PositiveIntegerField and DecimalField(max_digits=10, decimal_places=2)
+MAX_QUANTITY = 2 ** 31 - 1
+MAX_CENTS = 10 ** 10 - 1
+
+
+class OutOfRange(ValueError):
+    """A quantity or amount that is a number, but too large (or negative) for the stores to hold."""
+
+_AMOUNT_RE = re.compile(r'\s*([+-]?)(\d*)(?:\.(\d*))?\s*')
+
+
+def to_cents(value):
+    """Parse a money amount (int, float, numeric string or Decimal) into integer cents.
+
+    Amounts with more than two decimals are rounded half up, as the
+    DecimalFields do. Floats are parsed from their shortest repr, so 1.005
+    is 101 cents rather than float(1.005) * 100 = 100.49999... Raises
+    ValueError for anything that is not a finite number.
+    """
+    if isinstance(value, bool):
+        raise ValueError(f'Invalid amount: {value!r}')
+    if isinstance(value, int):
+        return value * CENTS
+    if isinstance(value, float):
+        if -1e7 < value < 1e7:
+            # Prices with at most two decimals land within rounding error of a whole cent
+            cents = value * CENTS
+            nearest = round(cents)
+            if abs(cents - nearest) < 1e-6:
+                return nearest
+        value = repr(value)
+    if isinstance(value, str):
+        match = _AMOUNT_RE.fullmatch(value)
+        if match and (match.group(2) or match.group(3)):
+            sign, units, fraction = match.group(1), match.group(2), match.group(3) or ''
+            cents = int(units or 0) * CENTS + int(fraction[:2].ljust(2, '0'))
+            if fraction[2:3] >= '5':
+                cents += 1
+            return -cents if sign == '-' else cents
+    # Exponents, Decimals and anything unusual take the slow path
+    try:
+        amount = Decimal(str(value)).scaleb(2).quantize(Decimal(1), rounding=ROUND_HALF_UP)
+    except (InvalidOperation, ValueError):
+        raise ValueError(f'Invalid amount: {value!r}')
+    if not amount.is_finite():
+        raise ValueError(f'Invalid amount: {value!r}')
+    return int(amount)
+
+
+def to_quantity(value):
+    """Parse a line-item quantity the way the views always have: int(value)."""
+    if isinstance(value, bool):
+        raise ValueError(f'Invalid quantity: {value!r}')
+    return int(value)
+
+
+def from_cents(cents):
+    """Cents -> the float amount stored in invoices.json and returned by the API."""
+    return cents / CENTS
+
+
+def to_decimal(cents):
+    """Cents -> a two-place Decimal, for DecimalFields."""
+    return Decimal(cents).scaleb(-2)
+
+
+def line_total(quantity, unit_price):
+    """Return quantity * unit_price in cents."""
+    return to_quantity(quantity) * to_cents(unit_price)
+
+
+def detail_total(detail):
+    """Return a detail's quantity * unit_price in cents; missing or empty values count as 0."""
+    quantity = detail.get('quantity', 0)
+    unit_price = detail.get('unit_price', 0)
+    return line_total(quantity if quantity != '' else 0, unit_price if unit_price != '' else 0)
+
+
+def check_quantity(quantity):
+    """Return ``quantity``, or raise OutOfRange if it is negative or above MAX_QUANTITY."""
+    if not 0 <= quantity <= MAX_QUANTITY:
+        raise OutOfRange(f'Quantity must be between 0 and {MAX_QUANTITY}.')
+    return quantity
+
+
+def check_cents(cents):
+    """Return ``cents``, or raise OutOfRange if the amount is beyond +/- MAX_CENTS."""
+    if abs(cents) > MAX_CENTS:
+        raise OutOfRange(f'Amounts must be between -{to_decimal(MAX_CENTS)} and {to_decimal(MAX_CENTS)}.')
+    return cents
+
+
+def check_detail(detail, cents):
+    """Raise OutOfRange if a detail's quantity, unit price or line total (``cents``, from detail_total()) is too large.
+
+    Call it after detail_total(), which has already rejected non-numeric values.
+    """
+    quantity = detail.get('quantity', 0)
+    unit_price = detail.get('unit_price', 0)
+    check_quantity(to_quantity(quantity if quantity != '' else 0))
+    check_cents(to_cents(unit_price if unit_price != '' else 0))
+    check_cents(cents)
+
+
+def batch_totals(quantities, unit_cents, counts):
+    """Multiply and sum many invoices' line items at once.
+
+    ``quantities`` and ``unit_cents`` hold every line item of every invoice
+    back to back, ``counts`` how many belong to each invoice. Returns
+    ``(line totals, invoice totals)`` in cents, as lists. Uses NumPy int64
+    arrays when it is installed.
+    """
+    if numpy is not None:
+        lines = numpy.asarray(quantities, dtype=numpy.int64) * numpy.asarray(unit_cents, dtype=numpy.int64)
+        counts = numpy.asarray(counts, dtype=numpy.int64)
+        running = numpy.concatenate(([0], numpy.cumsum(lines)))
+        ends = numpy.cumsum(counts)
+        return lines.tolist(), (running[ends] - running[ends - counts]).tolist()
+
+    lines = [quantity * unit for quantity, unit in zip(quantities, unit_cents)]
+    totals = []
+    start = 0
+    for count in counts:
+        totals.append(sum(lines[start:start + count]))
+        start += count
+    return lines, totals
@@ -0,0 +1,125 @@
+import heapq
+import math
+import re
+from collections import Counter
+
+TOKEN_RE = re.compile(r'\w+')
+
+
+def tokenize(text):
+    """Split text into casefolded word tokens."""
+    if not isinstance(text, str):
+        return []
+    return [token.casefold() for token in TOKEN_RE.findall(text)]
+
+
+def invoice_tokens(invoice):
+    """Count the searchable tokens of an invoice: its customer name and detail descriptions."""
+    tokens = Counter(tokenize(invoice.get('customer_name')))
+    for detail in invoice.get('details') or []:
+        if isinstance(detail, dict):
+            tokens.update(tokenize(detail.get('description')))
+    return tokens
+
+
+class InvertedIndex:
+    """Token -> {invoice id: term frequency} postings for full-text search.
+
+    Has the same add/remove/rebuild interface as the indexes in
+    backend.indexes, so the store keeps it up to date with every mutation.
+    Queries match invoices containing every query token and rank them by
+    TF-IDF.
+
+    Tokenizing every line item is the slowest part of loading the store, so
+    ``rebuild`` only remembers the invoices and the postings are built on
+    the first search. ``invoices`` must therefore be a live view (such as
+    ``dict.values()``) that keeps reflecting later changes.
+    """
+
+    def __init__(self):
+        self._postings = {}
+        self._doc_count = 0
+        self._pending = None
+
+    def rebuild(self, invoices):
+        self._postings = {}
+        self._doc_count = 0
+        self._pending = invoices
+
+    def _build(self):
+        pending, self._pending = self._pending, None
+        for invoice in pending:
+            self.add(invoice)
+
+    def add(self, invoice):
+        if self._pending is not None:
+            return  # Picked up from the live view when the index is built
+        invoice_id = invoice['id']
+        for token, count in invoice_tokens(invoice).items():
+            self._postings.setdefault(token, {})[invoice_id] = count
+        self._doc_count += 1
+
+    def remove(self, invoice):
+        if self._pending is not None:
+            return
+        invoice_id = invoice['id']
+        for token in invoice_tokens(invoice):
+            postings = self._postings.get(token)
+            if postings is not None:
+                postings.pop(invoice_id, None)
+                if not postings:
+                    del self._postings[token]
+        self._doc_count -= 1
+
+    def update_details(self, invoice_id, removed, added):
+        """Swap some of an invoice's details for others without re-tokenizing the rest of it."""
+        if self._pending is not None:
+            return
+        delta = Counter()
+        for detail in removed:
+            if isinstance(detail, dict):
+                delta.subtract(tokenize(detail.get('description')))
+        for detail in added:
+            if isinstance(detail, dict):
+                delta.update(tokenize(detail.get('description')))
+        for token, change in delta.items():
+            if not change:
+                continue
+            postings = self._postings.setdefault(token, {})
+            count = postings.get(invoice_id, 0) + change
+            if count > 0:
+                postings[invoice_id] = count
+            else:
+                postings.pop(invoice_id, None)
+                if not postings:
+                    del self._postings[token]
+
+    def search(self, query, limit=None):
+        """Return ``(ranked [(invoice id, score)], total matches)`` for a text query.
+
+        Only the top ``limit`` results are sorted; the rest are just counted.
+        """
+        if self._pending is not None:
+            self._build()
+        tokens = set(tokenize(query))
+        if not tokens:
+            return [], 0
+        postings = [self._postings.get(token) for token in tokens]
+        if not all(postings):
+            return [], 0
+
+        # Intersect starting from the rarest token so the candidate set only shrinks
+        postings.sort(key=len)
+        matches = set(postings[0])
+        for other in postings[1:]:
+            matches.intersection_update(other)
+            if not matches:
+                return [], 0
+
+        idfs = [(p, math.log(1 + self._doc_count / len(p))) for p in postings]
+        scored = [(sum(p[invoice_id] * idf for p, idf in idfs), invoice_id) for invoice_id in matches]
+        if limit is None:
+            top = sorted(scored, key=lambda item: (-item[0], item[1]))
+        else:
+            top = heapq.nsmallest(limit, scored, key=lambda item: (-item[0], item[1]))
+        return [(invoice_id, score) for score, invoice_id in top], len(scored)
@@ -0,0 +1,87 @@
+import os
+import struct
+import threading
+
+from .filelock import FileLock
+
+# How many ids each worker reserves from the shared sequence at a time
+DEFAULT_ID_BLOCK_SIZE = 64
+
+_COUNTER = struct.Struct('<Q')
+
+
+def format_invoice_number(number_format, invoice_id):
+    """Return the invoice_number for a new invoice, e.g. 'INV{id:06d}' -> 'INV000123'.
+
+    Without a format the number is the id itself, as the store used to assign it.
+    """
+    return number_format.format(id=invoice_id) if number_format else invoice_id
+
+
+class FileSequence:
+    """The last leased invoice id, kept in a small file shared by every worker.
+
+    ``lease`` is a read-modify-write under its own FileLock. Nothing is
+    fsync'd: the ids already saved in the store are passed back as ``floor``
+    on every lease, so a lost update can only re-issue ids nobody used.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._file_lock = FileLock(path + '.lock')
+
+    def lease(self, count, floor=0):
+        """Reserve ``count`` consecutive ids above both the sequence and ``floor``; return the first."""
+        with self._file_lock:
+            fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+            try:
+                data = os.read(fd, _COUNTER.size)
+                last = _COUNTER.unpack(data)[0] if len(data) == _COUNTER.size else 0
+                start = max(last, floor) + 1
+                os.lseek(fd, 0, os.SEEK_SET)
+                os.write(fd, _COUNTER.pack(start + count - 1))
+            finally:
+                os.close(fd)
+        return start
+
+
+class BlockAllocator:
+    """Hands out new invoice ids from blocks leased from a shared sequence.
+
+    Each worker leases ``block_size`` ids at a time and allocates from its
+    block without touching the sequence, so an allocation is O(1) and two
+    workers can never hand out the same id. Ids of a block a worker never
+    used (e.g. it restarted) are skipped, never reused, so ids are unique
+    but not gapless, and only increase within one worker.
+
+    ``sequence`` has a ``lease(count, floor)`` method: FileSequence for the
+    JSON store, the IdSequence table for SQLite.
+    """
+
+    def __init__(self, sequence, block_size=DEFAULT_ID_BLOCK_SIZE):
+        self.sequence = sequence
+        self.block_size = block_size
+        self._lock = threading.Lock()
+        self._next = 0
+        self._end = 0
+
+    def allocate(self, count=1, floor=lambda: 0):
+        """Return the first of ``count`` consecutive new ids.
+
+        ``floor`` returns the highest id already stored; it is only called
+        when a new block is leased, which then starts above it.
+        """
+        with self._lock:
+            if self._end - self._next < count:
+                if count > self.block_size:
+                    return self.sequence.lease(count, floor())  # A large bulk insert gets its own block
+                self._next = self.sequence.lease(self.block_size, floor())
+                self._end = self._next + self.block_size
+            start = self._next
+            self._next += count
+            return start
+
+    def discard(self):
+        """Drop the rest of the current block, e.g. after finding one of its ids already taken."""
+        with self._lock:
+            self._next = self._end = 0
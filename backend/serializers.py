@@ -1,26 +1,6 @@
 from rest_framework import serializers
-import json
-import os
-from decimal import Decimal
-
-# Path to the JSON file where invoices will be stored
-INVOICE_FILE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'invoices.json')
-
-
-def read_invoices_from_file():
-    """Read invoices from the JSON file."""
-    try:
-        with open(INVOICE_FILE_PATH, 'r') as f:
-            contents = f.read()
-            return json.loads(contents) if contents else []  # Return an empty list if file is empty
-    except FileNotFoundError:
-        return []  # Return empty list if the file doesn't exist
-
-
-def write_invoices_to_file(invoices):
-    """Write the list of invoices back to the JSON file."""
-    with open(INVOICE_FILE_PATH, 'w') as f:
-        json.dump(invoices, f, indent=4)
+from . import money
+from .store import get_store
 
 
 class InvoiceSerializer(serializers.Serializer):
@@ -31,12 +11,10 @@ class InvoiceSerializer(serializers.Serializer):
 
     def calculate_total_amount(self, details):
         """Calculate total amount based on details (unit_price * quantity)."""
-        total_amount = Decimal(0)
-        for item in details:
-            unit_price = item.get('unit_price', 0)
-            quantity = item.get('quantity', 0)
-            total_amount += Decimal(unit_price) * Decimal(quantity)
-        return total_amount
+        total_cents = sum(
+            money.line_total(item.get('quantity', 0), item.get('unit_price', 0)) for item in details
+        )
+        return money.from_cents(total_cents)
 
     def create(self, validated_data):
         """Custom method to create an invoice."""
@@ -44,16 +22,8 @@ class InvoiceSerializer(serializers.Serializer):
         total_amount = self.calculate_total_amount(details)
         validated_data['total_amount'] = total_amount  # Set the calculated total amount
 
-        # Generate a new invoice with a unique ID (based on the existing number of invoices)
-        invoices = read_invoices_from_file()
-        new_invoice = {
-            'id': len(invoices) + 1,
-            **validated_data  # Add other validated fields like invoice_number, customer_name, etc.
-        }
-
-        # Save the new invoice
-        invoices.append(new_invoice)
-        write_invoices_to_file(invoices)
+        # Save the new invoice; the store assigns a unique ID
+        new_invoice = get_store().create(validated_data)
 
         return new_invoice
 
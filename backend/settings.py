@@ -38,6 +38,7 @@ INSTALLED_APPS = [
 
 MIDDLEWARE = [
     'corsheaders.middleware.CorsMiddleware',  # CORS middleware should be at the top
+    'backend.middleware.MetricsMiddleware',  # Times everything below it (see /api/metrics/)
     'django.middleware.common.CommonMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
@@ -68,7 +69,104 @@ TEMPLATES = [
 
 WSGI_APPLICATION = 'backend.wsgi.application'
 
-# Database settings would go here
+# Database settings
+# Only used when INVOICE_STORAGE_BACKEND = 'sqlite' (run `python manage.py migrate` first).
+# WAL lets readers proceed while a write is in progress, IMMEDIATE transactions take the
+# write lock up front instead of failing on upgrade, and connections are kept between requests.
+DATABASES = {
+    'default': {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': BASE_DIR / 'db.sqlite3',
+        'CONN_MAX_AGE': 600,
+        'CONN_HEALTH_CHECKS': True,
+        'OPTIONS': {
+            'init_command': 'PRAGMA journal_mode=WAL; PRAGMA synchronous=NORMAL;',
+            'transaction_mode': 'IMMEDIATE',
+            'timeout': 20,
+        },
+    }
+}
+
+# Invoice storage
+# 'json': invoices are kept in a JSON file and cached in-process by backend.store.InvoiceStore
+# 'sqlite': invoices are stored in the Invoice/InvoiceDetail tables (backend.sqlite_store);
+#           copy existing data over with `python manage.py import_invoices`
+INVOICE_STORAGE_BACKEND = 'json'
+INVOICE_FILE_PATH = BASE_DIR / 'backend' / 'invoices.json'
+
+# Append one JSON line per mutation to a journal instead of rewriting the whole file,
+# and fold the journal back into invoices.json once it holds this many records
+INVOICE_STORE_JOURNAL = False
+INVOICE_JOURNAL_PATH = None  # Defaults to '<INVOICE_FILE_PATH>.journal'
+INVOICE_JOURNAL_COMPACT_THRESHOLD = 1000
+
+# Writes are serialized through one writer thread per process and a lock file shared by all
+# workers; mutations arriving within the window are committed with a single write and fsync
+INVOICE_GROUP_COMMIT_WINDOW = 0.002  # seconds
+INVOICE_GROUP_COMMIT_MAX_BATCH = 256
+INVOICE_STORE_FSYNC = True
+
+# Workers notice each other's writes through a shared generation counter ('<INVOICE_FILE_PATH>.gen');
+# while it is unchanged the invoice files are only stat()ed this often, to catch edits made by hand
+INVOICE_STORE_STAT_INTERVAL = 1.0  # seconds; 0 checks the files on every request
+
+# Also export a memory-mapped columnar snapshot on every snapshot write/compaction
+# ('<INVOICE_FILE_PATH>.columns' by default); workers serve reads from it without parsing the JSON
+INVOICE_COLUMNAR_SNAPSHOT = False
+INVOICE_COLUMNAR_PATH = None
+
+# New invoice ids are leased from a shared sequence ('<INVOICE_FILE_PATH>.seq', or the id_sequence
+# table on SQLite) this many at a time per worker; unused ids of a block are skipped, never reused
+INVOICE_ID_BLOCK_SIZE = 64
+# invoice_number of new invoices, formatted from their id; None uses the numeric id itself
+INVOICE_NUMBER_FORMAT = 'INV{id:06d}'
+
+# GET /api/invoices/ pagination (?limit=&cursor=) and streaming (?stream=1)
+INVOICE_PAGE_MAX_LIMIT = 1000
+INVOICE_STREAM_CHUNK_SIZE = 500
+
+# Largest number of invoices and body size accepted by POST /api/invoices/bulk/
+# (bulk bodies are read directly, so DATA_UPLOAD_MAX_MEMORY_SIZE does not apply to them unless they
+# are sent with an Idempotency-Key, whose fingerprint needs the whole body)
+INVOICE_BULK_MAX_ITEMS = 50000
+INVOICE_BULK_MAX_BYTES = 100 * 1024 * 1024
+
+# Admission control for writes, per worker: at most this many write requests are accepted at once
+# (more get a 503 with Retry-After), and one still queued for the store after the deadline (seconds)
+# is dropped unapplied with a 503 as well
+INVOICE_WRITE_QUEUE_DEPTH = 512
+INVOICE_WRITE_DEADLINE = 10.0
+INVOICE_WRITE_RETRY_AFTER = 1  # seconds
+
+# Responses to writes sent with an Idempotency-Key header are kept this long (seconds), up to this many
+# keys, and shared by all workers through '<INVOICE_FILE_PATH>.idempotency' (next to the database on SQLite)
+INVOICE_IDEMPOTENCY_TTL = 24 * 60 * 60
+INVOICE_IDEMPOTENCY_CACHE_SIZE = 10000
+INVOICE_IDEMPOTENCY_PATH = None
+# A key claimed by a request whose worker died before answering can be reused after this many seconds
+INVOICE_IDEMPOTENCY_PENDING_TTL = 5 * 60
+
+# Load the URLconf and parse the invoice snapshot on a background thread when backend/wsgi_api.py
+# is imported, so a cold start's first request does not pay for it (see settings_api.py)
+INVOICE_PRELOAD = False
+
+# Number of encoded GET responses (per URL) kept until the store next changes; 0 disables the cache
+INVOICE_RESPONSE_CACHE_SIZE = 64
+
+# Request logging in the views is at DEBUG level and sampled: with the 'backend' logger at DEBUG,
+# only this fraction (0..1) of the calls is logged
+INVOICE_LOG_SAMPLE_RATE = 0.01
+
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'handlers': {
+        'console': {'class': 'logging.StreamHandler'},
+    },
+    'loggers': {
+        'backend': {'handlers': ['console'], 'level': 'INFO'},
+    },
+}
 
 # Password validation
 AUTH_PASSWORD_VALIDATORS = [
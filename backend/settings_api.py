@@ -0,0 +1,29 @@
+"""
+Lean settings for the serverless API entry point (backend/wsgi_api.py).
+
+Everything in settings.py applies, minus the apps, middleware and templates
+that only the admin uses: a cold start then imports and sets up just what
+the /api/ endpoints need. The admin is not routed with these settings;
+run it from a full deployment or `python manage.py runserver`.
+"""
+from .settings import *  # noqa: F401,F403
+
+# The backend app only contributes the models (and management commands); the JSON store needs neither
+INSTALLED_APPS = [
+    'corsheaders',
+    *(['backend'] if INVOICE_STORAGE_BACKEND == 'sqlite' else []),  # noqa: F405
+]
+
+MIDDLEWARE = [
+    'corsheaders.middleware.CorsMiddleware',  # CORS middleware should be at the top
+    'backend.middleware.MetricsMiddleware',  # Times everything below it (see /api/metrics/)
+    'django.middleware.common.CommonMiddleware',
+    'django.middleware.security.SecurityMiddleware',
+]
+
+TEMPLATES = []
+
+AUTH_PASSWORD_VALIDATORS = []
+
+# Parse the invoice snapshot on a background thread as soon as the entry point is imported
+INVOICE_PRELOAD = True
@@ -0,0 +1,425 @@
+import asyncio
+import datetime
+from decimal import Decimal
+
+from asgiref.sync import sync_to_async
+from django.db import transaction
+from django.db.models import Exists, F, Max, OuterRef, Q
+
+from . import money
+from .admission import WriteClaim, await_write, check_deadline, current_deadline
+from .encoding import dumps
+from .models import IdSequence, Invoice, InvoiceDetail, RevenueRollup, StoreVersion
+from .search import tokenize
+from .sequence import DEFAULT_ID_BLOCK_SIZE, BlockAllocator, format_invoice_number
+from .store import REPORT_GROUPS
+
+
+def _number_to_api(value):
+    """Return numeric invoice numbers as ints, the way the JSON store keeps the ones it generates."""
+    return int(value) if value.isdigit() and str(int(value)) == value else value
+
+
+def _parse_date(value):
+    if value in (None, ''):
+        return None
+    if isinstance(value, datetime.date):
+        return value
+    try:
+        return datetime.date.fromisoformat(value)
+    except (TypeError, ValueError):
+        raise ValueError('Date must be in YYYY-MM-DD format.')
+
+
+def _decimal(value):
+    return Decimal(str(value)) if value not in (None, '') else Decimal(0)
+
+
+async def _write_before_deadline(write, *args):
+    """Run ``write(*args)`` on the request's thread, unless the request's write deadline passes first.
+
+    While it waits for the thread, the write is abandoned (WriteRejected) as
+    soon as the deadline passes; once started it runs to the end. The
+    thread is the one Django closes the request's connections on, so the
+    persistent connection the write opens is aged out (CONN_MAX_AGE) like
+    any other.
+    """
+    deadline = current_deadline()
+    claim = WriteClaim()
+
+    def run():
+        if not claim.start():
+            return None  # Abandoned; the caller has already been answered
+        check_deadline(deadline)
+        return write(*args)
+
+    return await await_write(asyncio.ensure_future(sync_to_async(run, thread_sensitive=True)()), claim, deadline)
+
+
+def detail_to_dict(detail):
+    return {
+        'id': detail.line_number,
+        'description': detail.description,
+        'quantity': detail.quantity,
+        'unit_price': float(detail.unit_price),
+        'line_total': float(detail.line_total),
+    }
+
+
+def invoice_to_dict(invoice, details):
+    """Build the API invoice dict from an Invoice and its details.
+
+    Only the columns are returned, with numbers as numbers: unlike the JSON
+    store, keys the client added and string quantities or prices are not
+    echoed back.
+    """
+    return {
+        'id': invoice.pk,
+        'invoice_number': _number_to_api(invoice.invoice_number),
+        'customer_name': invoice.customer_name,
+        'date': invoice.date.isoformat() if invoice.date else None,
+        'details': [detail_to_dict(detail) for detail in details],
+        'total_amount': float(invoice.total_amount),
+    }
+
+
+def build_rows(invoices):
+    """Turn API invoice dicts (with ids) into unsaved Invoice and InvoiceDetail rows."""
+    invoice_rows = []
+    detail_rows = {}
+    for invoice in invoices:
+        invoice_rows.append(Invoice(
+            id=invoice['id'],
+            invoice_number=str(invoice.get('invoice_number', invoice['id'])),
+            customer_name=invoice.get('customer_name') or '',
+            date=_parse_date(invoice.get('date')),
+            total_amount=_decimal(invoice.get('total_amount')),
+        ))
+        rows = detail_rows[invoice['id']] = []
+        for idx, detail in enumerate(invoice.get('details') or []):
+            quantity = money.to_quantity(detail.get('quantity') or 0)
+            unit_cents = money.to_cents(detail.get('unit_price') or 0)
+            rows.append(InvoiceDetail(
+                invoice_id=invoice['id'],
+                line_number=int(detail.get('id', idx + 1)),
+                description=detail.get('description') or '',
+                quantity=quantity,
+                unit_price=money.to_decimal(unit_cents),
+                line_total=money.to_decimal(quantity * unit_cents),
+            ))
+    return invoice_rows, detail_rows
+
+
+class SqliteInvoiceStore:
+    """Serves the InvoiceStore interface from the Invoice/InvoiceDetail tables.
+
+    Rows are written with bulk_create and queryset updates inside one
+    transaction per call, and read with prefetch_related('details'), so a
+    page of invoices costs two queries however many details it has.
+    Responses use the JSON store's field names (see invoice_to_dict for
+    where they differ). Every write also
+    applies its change in totals to the RevenueRollup table in the same
+    transaction. New ids come from blocks leased from the IdSequence row.
+    """
+
+    def __init__(self, id_block_size=DEFAULT_ID_BLOCK_SIZE, number_format=None):
+        self._ids = BlockAllocator(IdSequence.objects, id_block_size)
+        self.number_format = number_format
+
+    def _queryset(self):
+        return Invoice.objects.prefetch_related('details').order_by('id')
+
+    def _to_dicts(self, invoices):
+        return [invoice_to_dict(invoice, invoice.details.all()) for invoice in invoices]
+
+    def _rollup_row(self, invoice_id):
+        """Return the fields of a stored invoice that its revenue rollups depend on, or None."""
+        return Invoice.objects.only('customer_name', 'date', 'total_amount').filter(pk=invoice_id).first()
+
+    def __len__(self):
+        return Invoice.objects.count()
+
+    def encode(self, invoices):
+        """Return the JSON bytes of each invoice (rows are re-read per request, so nothing is cached)."""
+        return [dumps(invoice) for invoice in invoices]
+
+    def version(self):
+        """Return the store version, for ETags; see StoreVersion."""
+        return StoreVersion.objects.token()
+
+    # ------------------------------------------------------------------
+    # Reads
+    # ------------------------------------------------------------------
+
+    def all(self):
+        """Return all invoices in id order."""
+        return self._to_dicts(self._queryset())
+
+    def get(self, invoice_id):
+        """Return the invoice with the given id, or None."""
+        try:
+            invoice_id = int(invoice_id)
+        except (TypeError, ValueError):
+            return None
+        invoices = self._to_dicts(self._queryset().filter(pk=invoice_id))
+        return invoices[0] if invoices else None
+
+    def get_by_number(self, invoice_number):
+        """Return the invoice with the given invoice_number, or None."""
+        if invoice_number is None:
+            return None
+        invoices = self._to_dicts(self._queryset().filter(invoice_number=str(invoice_number)))
+        return invoices[0] if invoices else None
+
+    def get_many(self, invoice_ids=(), invoice_numbers=()):
+        """Return the invoices with the given ids and invoice_numbers in the order asked for, in two queries."""
+        invoice_ids = [invoice_id for invoice_id in invoice_ids if isinstance(invoice_id, int)]
+        invoice_numbers = [str(invoice_number) for invoice_number in invoice_numbers]
+        if not invoice_ids and not invoice_numbers:
+            return []
+        rows = list(self._queryset().filter(Q(pk__in=invoice_ids) | Q(invoice_number__in=invoice_numbers)))
+        by_id = {row.pk: row for row in rows}
+        by_number = {row.invoice_number: row for row in rows}
+        found = {}
+        for row in [by_id.get(invoice_id) for invoice_id in invoice_ids] + [by_number.get(n) for n in invoice_numbers]:
+            if row is not None:
+                found.setdefault(row.pk, row)
+        return self._to_dicts(found.values())
+
+    def get_many_encoded(self, invoice_ids=(), invoice_numbers=()):
+        """Like get_many(), but returns the JSON bytes of each invoice instead of the dicts."""
+        return self.encode(self.get_many(invoice_ids, invoice_numbers))
+
+    def page(self, after=None, limit=None, filters=None):
+        """Return ``(invoices, next_cursor)`` like InvoiceStore.page()."""
+        queryset = self._queryset()
+        filters = filters or {}
+        if filters.get('customer') is not None:
+            queryset = queryset.filter(customer_name=filters['customer'])
+        if filters.get('customer_prefix') is not None:
+            queryset = queryset.filter(customer_name__istartswith=filters['customer_prefix'])
+        if filters.get('date_from') is not None:
+            queryset = queryset.filter(date__gte=filters['date_from'])
+        if filters.get('date_to') is not None:
+            queryset = queryset.filter(date__lte=filters['date_to'])
+        if filters.get('min_total') is not None:
+            queryset = queryset.filter(total_amount__gte=_decimal(filters['min_total']))
+        if filters.get('max_total') is not None:
+            queryset = queryset.filter(total_amount__lte=_decimal(filters['max_total']))
+        if after is not None:
+            queryset = queryset.filter(id__gt=after)
+
+        if limit is None:
+            return self._to_dicts(queryset), None
+        invoices = list(queryset[:limit + 1])  # One extra row tells us whether there is a next page
+        next_cursor = invoices[limit - 1].pk if len(invoices) > limit else None
+        return self._to_dicts(invoices[:limit]), next_cursor
+
+    def page_encoded(self, after=None, limit=None, filters=None):
+        """Like page(), but returns the JSON bytes of each invoice instead of the dicts."""
+        invoices, next_cursor = self.page(after, limit, filters)
+        return self.encode(invoices), next_cursor
+
+    def search(self, query, limit=20, offset=0):
+        """Return ``(invoices, total)`` for invoices whose customer name or a detail description
+        contains every query word, in id order."""
+        tokens = set(tokenize(query))
+        if not tokens:
+            return [], 0
+        queryset = self._queryset()
+        for token in tokens:
+            queryset = queryset.filter(
+                Q(customer_name__icontains=token)
+                | Exists(InvoiceDetail.objects.filter(invoice=OuterRef('pk'), description__icontains=token))
+            )
+        return self._to_dicts(queryset[offset:offset + limit]), queryset.count()
+
+    def report(self, group_by=REPORT_GROUPS):
+        """Return ``{group: [{'key', 'invoice_count', 'revenue'}]}`` from the rollup table."""
+        report = {group: [] for group in group_by}
+        for row in RevenueRollup.objects.filter(dimension__in=group_by).order_by('dimension', 'key'):
+            report[row.dimension].append(
+                {'key': row.key, 'invoice_count': row.invoice_count, 'revenue': float(row.revenue)}
+            )
+        return report
+
+    def rebuild_rollups(self):
+        """Recompute the rollup table from the invoice table and return the number of groups."""
+        return RevenueRollup.objects.rebuild()
+
+    def recompute_totals(self):
+        """Recompute every line total and invoice total in SQL, like InvoiceStore.recompute_totals().
+
+        Prices are already two-place decimals here, so quantity * unit_price
+        is exact; three UPDATE statements replace the per-row Decimal path.
+        """
+        with transaction.atomic():
+            line_total = F('quantity') * F('unit_price')
+            changed = set(
+                InvoiceDetail.objects.exclude(line_total=line_total).values_list('invoice_id', flat=True)
+            )
+            before = dict(Invoice.objects.values_list('pk', 'total_amount'))
+            # A queryset update() skips InvoiceDetail.save(), so no per-row total deltas run here
+            InvoiceDetail.objects.update(line_total=line_total)
+            Invoice.objects.all().recalculate_totals()
+            for pk, total in Invoice.objects.values_list('pk', 'total_amount'):
+                if before[pk] != total:
+                    changed.add(pk)
+            RevenueRollup.objects.rebuild()
+            StoreVersion.objects.bump()
+        return {'checked': len(before), 'changed': len(changed), 'skipped': 0}
+
+    # ------------------------------------------------------------------
+    # Writes
+    # ------------------------------------------------------------------
+
+    def create(self, fields):
+        """Assign an id and invoice_number to a new invoice and save it."""
+        return self.create_many([fields])[0]
+
+    def _max_id(self):
+        return Invoice.objects.aggregate(last=Max('id'))['last'] or 0
+
+    def create_many(self, fields_list):
+        """Save many new invoices in one transaction, with a contiguous block of ids."""
+        start = self._ids.allocate(len(fields_list), self._max_id)
+        if Invoice.objects.filter(pk__range=(start, start + len(fields_list) - 1)).exists():
+            # Rows inserted outside the sequence (e.g. by import_invoices); lease past all of them
+            self._ids.discard()
+            start = self._ids.allocate(len(fields_list), self._max_id)
+        invoices = [
+            {'id': start + i, 'invoice_number': format_invoice_number(self.number_format, start + i), **fields}
+            for i, fields in enumerate(fields_list)
+        ]
+        return self.insert(invoices)
+
+    def insert(self, invoices):
+        """Insert invoice dicts that already carry their ids."""
+        invoice_rows, detail_rows = build_rows(invoices)
+        with transaction.atomic():
+            Invoice.objects.bulk_create(invoice_rows, batch_size=500)
+            InvoiceDetail.objects.bulk_create(
+                [row for rows in detail_rows.values() for row in rows], batch_size=500
+            )
+            RevenueRollup.objects.apply(added=invoice_rows)
+            StoreVersion.objects.bump()
+        return [invoice_to_dict(row, detail_rows[row.pk]) for row in invoice_rows]
+
+    def update(self, invoice):
+        """Replace the stored invoice that has the same id."""
+        (invoice_row,), detail_rows = build_rows([invoice])
+        with transaction.atomic():
+            old_row = self._rollup_row(invoice_row.pk)
+            if old_row is None:
+                raise KeyError(invoice['id'])
+            InvoiceDetail.objects.filter(invoice_id=invoice_row.pk).delete()
+            InvoiceDetail.objects.bulk_create(detail_rows[invoice_row.pk], batch_size=500)
+            # Written last, so it replaces whatever the detail delete subtracted
+            Invoice.objects.filter(pk=invoice_row.pk).update(
+                invoice_number=invoice_row.invoice_number,
+                customer_name=invoice_row.customer_name,
+                date=invoice_row.date,
+                total_amount=invoice_row.total_amount,
+            )
+            RevenueRollup.objects.apply(removed=[old_row], added=[invoice_row])
+            StoreVersion.objects.bump()
+        return invoice
+
+    def delete(self, invoice_id):
+        """Remove the invoice with the given id."""
+        with transaction.atomic():
+            invoice = self.get(invoice_id)
+            if invoice is None:
+                raise KeyError(invoice_id)
+            RevenueRollup.objects.apply(removed=[self._rollup_row(invoice_id)])
+            Invoice.objects.filter(pk=invoice_id).delete()
+            StoreVersion.objects.bump()
+        return invoice
+
+    def delete_detail(self, invoice_id, detail_id):
+        """Remove one detail line from an invoice."""
+        with transaction.atomic():
+            old_row = self._rollup_row(invoice_id)
+            if old_row is None:
+                raise KeyError(invoice_id)
+            # Deleting the detail lowers the invoice's total, so its revenue groups change too
+            InvoiceDetail.objects.filter(invoice_id=invoice_id, line_number=detail_id).delete()
+            RevenueRollup.objects.apply(removed=[old_row], added=[self._rollup_row(invoice_id)])
+            StoreVersion.objects.bump()
+            return self.get(invoice_id)
+
+    def patch_details(self, invoice_id, add=(), change=(), remove=()):
+        """Add, change and remove individual details, like InvoiceStore.patch_details().
+
+        Changed rows are saved one by one and removed rows deleted with one
+        query; both adjust the invoice total by their delta (see
+        InvoiceDetail.save), so the other details are never read.
+        """
+        written = []
+        delta = 0  # Change of the total in cents, checked before it is read back through the DecimalField
+        with transaction.atomic():
+            old_row = self._rollup_row(invoice_id)
+            if old_row is None:
+                raise KeyError(invoice_id)
+            ids = [fields['id'] for fields in change] + list(remove)
+            rows = {
+                row.line_number: row
+                for row in InvoiceDetail.objects.filter(invoice_id=invoice_id, line_number__in=ids)
+            }
+            for detail_id in ids:
+                if detail_id not in rows:
+                    raise KeyError(detail_id)
+            # New details are numbered past the highest id before any removal, as on the JSON store
+            if add:
+                last = InvoiceDetail.objects.filter(invoice_id=invoice_id).aggregate(last=Max('line_number'))['last']
+            for fields in change:
+                row = rows[fields['id']]
+                if 'description' in fields:
+                    row.description = fields['description'] or ''
+                if 'quantity' in fields:
+                    row.quantity = money.to_quantity(fields['quantity'] or 0)
+                if 'unit_price' in fields:
+                    row.unit_price = money.to_decimal(money.to_cents(fields['unit_price'] or 0))
+                line = money.check_cents(row.quantity * money.to_cents(row.unit_price))
+                delta += line - money.to_cents(row.line_total)
+                row.save()
+                written.append(row)
+            if remove:
+                delta -= sum(money.to_cents(rows[detail_id].line_total) for detail_id in remove)
+                InvoiceDetail.objects.filter(invoice_id=invoice_id, line_number__in=remove).delete()
+            if add:
+                _, detail_rows = build_rows([{'id': invoice_id, 'details': [
+                    {**fields, 'id': (last or 0) + 1 + offset} for offset, fields in enumerate(add)
+                ]}])
+                delta += sum(money.to_cents(row.line_total) for row in detail_rows[invoice_id])
+                InvoiceDetail.objects.bulk_create_for(Invoice(pk=invoice_id), detail_rows[invoice_id], batch_size=500)
+                written.extend(detail_rows[invoice_id])
+            # Raising rolls back the whole transaction, including the details already written
+            money.check_cents(money.to_cents(old_row.total_amount) + delta)
+            new_row = self._rollup_row(invoice_id)
+            RevenueRollup.objects.apply(removed=[old_row], added=[new_row])
+            StoreVersion.objects.bump()
+        return {'id': new_row.pk, 'total_amount': float(new_row.total_amount),
+                'details': [detail_to_dict(detail) for detail in written], 'removed': list(remove)}
+
+    # Async variants for ASGI views. SQLite admits one writer at a time and the ORM is
+    # synchronous, so these run the write on a worker thread of the default executor,
+    # unless the request's write deadline passed while it waited for one.
+
+    async def acreate(self, fields):
+        return await _write_before_deadline(self.create, fields)
+
+    async def acreate_many(self, fields_list):
+        return await _write_before_deadline(self.create_many, fields_list)
+
+    async def aupdate(self, invoice):
+        return await _write_before_deadline(self.update, invoice)
+
+    async def adelete(self, invoice_id):
+        return await _write_before_deadline(self.delete, invoice_id)
+
+    async def adelete_detail(self, invoice_id, detail_id):
+        return await _write_before_deadline(self.delete_detail, invoice_id, detail_id)
+
+    async def apatch_details(self, invoice_id, add=(), change=(), remove=()):
+        return await _write_before_deadline(self.patch_details, invoice_id, add, change, remove)
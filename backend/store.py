@@ -0,0 +1,1148 @@
+import asyncio
+import bisect
+import logging
+import os
+import queue
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+
+from django.conf import settings
+
+from . import encoding, metrics, money
+from .admission import WriteClaim, await_write, check_deadline, current_deadline, deadline_passed
+from .filelock import FileLock
+from .generation import GenerationCounter
+from .indexes import HashIndex, RollupIndex, SortedIndex
+from .search import InvertedIndex
+from .sequence import DEFAULT_ID_BLOCK_SIZE, BlockAllocator, FileSequence, format_invoice_number
+
+logger = logging.getLogger(__name__)
+
+# Default location of the JSON file where invoices are stored
+DEFAULT_INVOICE_FILE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'invoices.json')
+
+# Number of journal records after which the journal is folded back into the snapshot
+DEFAULT_JOURNAL_COMPACT_THRESHOLD = 1000
+
+# How long (seconds) the writer waits for more mutations to share one commit, and the batch cap
+DEFAULT_GROUP_COMMIT_WINDOW = 0.002
+DEFAULT_GROUP_COMMIT_MAX_BATCH = 256
+
+# While the shared generation counter has not moved, the files are only stat()ed this often (seconds)
+DEFAULT_STAT_INTERVAL = 1.0
+
+# Groupings available from InvoiceStore.report()
+REPORT_GROUPS = ('customer', 'day', 'month')
+
+
+def _encode_record(record):
+    """Encode one journal record as a single JSON line."""
+    return encoding.dumps(record) + b'\n'
+
+
+def _write_temp(path, data, fsync=True, file='snapshot'):
+    """Write data to a new temp file next to path and return the temp file's name.
+
+    ``file`` names the file in the write metrics ('snapshot', 'journal' or 'columns').
+    """
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.' + os.path.basename(path) + '.', suffix='.tmp')
+    try:
+        started = time.perf_counter()
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+            f.flush()
+            if fsync:
+                os.fsync(f.fileno())
+        metrics.record_write(file, time.perf_counter() - started, len(data))
+        # mkstemp creates the file 0600; keep the permissions of the file being replaced
+        try:
+            mode = os.stat(path).st_mode & 0o777
+        except FileNotFoundError:
+            mode = 0o644
+        os.chmod(tmp_path, mode)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+    return tmp_path
+
+
+def _atomic_write(path, data, fsync=True, file='snapshot'):
+    """Replace path with data so readers see either the old or the new file, never a partial one."""
+    os.replace(_write_temp(path, data, fsync, file), path)
+    if fsync and os.name == 'posix':
+        # Make the rename itself durable
+        dir_fd = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY)
+        try:
+            os.fsync(dir_fd)
+        finally:
+            os.close(dir_fd)
+
+
+def version_token(stamp, journal_ino, journal_offset):
+    """Format the state of the store's files (see InvoiceStore._state()) as a version string."""
+    mtime_ns, size, ino = stamp or (0, 0, 0)
+    return '%x.%x.%x.%x.%x' % (mtime_ns, size, ino, journal_ino or 0, journal_offset)
+
+
+def _customer_key(invoice):
+    name = invoice.get('customer_name')
+    return name if isinstance(name, str) else None
+
+
+def _customer_prefix_key(invoice):
+    name = _customer_key(invoice)
+    return name.casefold() if name is not None else None
+
+
+def _date_key(invoice):
+    # ISO dates (YYYY-MM-DD) sort correctly as strings
+    date = invoice.get('date')
+    return date if isinstance(date, str) and date else None
+
+
+def _total_key(invoice):
+    try:
+        return float(invoice.get('total_amount'))
+    except (TypeError, ValueError):
+        return None
+
+
+def _month_key(invoice):
+    date = _date_key(invoice)
+    return date[:7] if date is not None else None
+
+
+def _total_cents(invoice):
+    # Rollups sum integer cents so applying many deltas never drifts the way float sums do
+    total = _total_key(invoice)
+    return round(total * 100) if total is not None else 0
+
+
+class _PendingWrite:
+    """A mutation waiting for the writer thread.
+
+    Synchronous callers block on ``result()``; async callers pass
+    ``on_done``, which the writer thread calls once the mutation is durable.
+    A write still queued at its ``deadline`` (time.monotonic()) is dropped
+    with WriteRejected instead of being applied: the caller stops waiting
+    and abandons it through ``claim``, and the writer skips it.
+    """
+
+    def __init__(self, build, on_done=None, deadline=None):
+        self.build = build
+        self.on_done = on_done
+        self.deadline = deadline
+        self.claim = WriteClaim()
+        self.value = None
+        self.error = None
+        self.done = threading.Event()
+
+    def finish(self):
+        self.done.set()
+        if self.on_done is not None and not self.claim.abandoned:  # An abandoned write's caller is gone
+            self.on_done(self)
+
+    def result(self):
+        self.done.wait()
+        if self.error is not None:
+            raise self.error
+        return self.value
+
+
+def _resolve_future(future, pending):
+    if future.cancelled():
+        return  # The caller went away; the write itself still happened
+    if pending.error is not None:
+        future.set_exception(pending.error)
+    else:
+        future.set_result(pending.value)
+
+
+class InvoiceStore:
+    """Process-resident cache of the invoices JSON file.
+
+    The file is parsed once and kept in dicts keyed by ``id`` and by
+    ``invoice_number``, plus secondary indexes on customer name, date and
+    total_amount, a full-text index over customer names and detail
+    descriptions and revenue rollups per customer, day and month, all
+    updated with every mutation. Every access revalidates against the file's mtime and
+    size, so a change made by another process is picked up without re-parsing
+    the file on every request.
+
+    Every mutation is described by a record (``create``, ``create_many``,
+    ``update``, ``delete`` or ``delete_detail``). Without a journal each record rewrites
+    the whole snapshot file. With ``journal_path`` set, records are appended
+    to that file as JSON lines instead, replayed on top of the snapshot at
+    load time, and folded back into the snapshot by ``compact()`` once more
+    than ``compact_threshold`` of them have accumulated.
+
+    Mutations are handed to a single writer thread. It takes a cross-process
+    file lock, revalidates, applies every mutation that arrived within
+    ``commit_window`` seconds and makes them durable with one write and one
+    fsync. Snapshots are always replaced atomically through a temp file.
+    The ``a``-prefixed write methods queue the same mutations for async
+    callers and await the commit on the event loop.
+    """
+
+    def __init__(self, path, journal_path=None, compact_threshold=DEFAULT_JOURNAL_COMPACT_THRESHOLD,
+                 commit_window=DEFAULT_GROUP_COMMIT_WINDOW, max_batch=DEFAULT_GROUP_COMMIT_MAX_BATCH, fsync=True,
+                 columnar_path=None, stat_interval=DEFAULT_STAT_INTERVAL, id_block_size=DEFAULT_ID_BLOCK_SIZE,
+                 number_format=None):
+        self.path = path
+        self.journal_path = journal_path
+        self.columnar_path = columnar_path
+        self.compact_threshold = compact_threshold
+        self.commit_window = commit_window
+        self.max_batch = max_batch
+        self.fsync = fsync
+        self._lock = threading.RLock()
+        self._file_lock = FileLock(path + '.lock')
+        self.stat_interval = stat_interval
+        self._generation = None
+        self._seen_generation = None
+        self._next_stat = 0.0
+        self._ids = BlockAllocator(FileSequence(path + '.seq'), id_block_size)
+        self.number_format = number_format
+        self._queue = queue.Queue()
+        self._writer = None
+        self._writer_lock = threading.Lock()
+        self._by_id = {}
+        self._by_number = {}
+        self._sorted_ids = []  # Keyset order for pagination
+        self._by_customer = HashIndex(_customer_key)
+        self._by_customer_prefix = SortedIndex(_customer_prefix_key)
+        self._by_date = SortedIndex(_date_key)
+        self._by_total = SortedIndex(_total_key)
+        self._text_index = InvertedIndex()
+        self._rollups = {
+            'customer': RollupIndex(_customer_key, _total_cents),
+            'day': RollupIndex(_date_key, _total_cents),
+            'month': RollupIndex(_month_key, _total_cents),
+        }
+        self._secondary_indexes = [self._by_customer, self._by_customer_prefix, self._by_date, self._by_total,
+                                   self._text_index, *self._rollups.values()]
+        self._encoded = {}  # id -> (invoice, its JSON bytes)
+        self._detail_maps = {}  # id -> (details list, {detail id: position}) of recently patched invoices
+        self._stamp = None
+        self._loaded = False
+        self._journal_ino = None
+        self._journal_offset = 0
+        self._journal_records = 0
+        self._compacting = False
+
+    def __len__(self):
+        with self._lock:
+            self._revalidate()
+            return len(self._by_id)
+
+    # ------------------------------------------------------------------
+    # Loading and revalidation
+    # ------------------------------------------------------------------
+
+    def _file_stamp(self):
+        """Return (mtime_ns, size, inode) of the snapshot file, or None if it does not exist."""
+        try:
+            st = os.stat(self.path)
+        except FileNotFoundError:
+            return None
+        return (st.st_mtime_ns, st.st_size, st.st_ino)
+
+    def _revalidate(self):
+        """Reload the snapshot if it changed on disk, and replay new journal records.
+
+        Writers bump the shared generation counter after every commit, so
+        while it has not moved (and the stat interval has not elapsed) the
+        files are not even stat()ed.
+        """
+        generation = self._read_generation()
+        now = time.monotonic()
+        if self._loaded and generation is not None and generation == self._seen_generation and now < self._next_stat:
+            return
+        # Read the counter before looking at the files: writers bump it after writing them
+        self._seen_generation = generation
+        self._next_stat = now + self.stat_interval
+        stamp = self._file_stamp()
+        if not self._loaded or stamp != self._stamp:
+            self._load(stamp)
+        elif self.journal_path:
+            self._replay_journal()
+
+    def _read_generation(self):
+        """Return the shared generation counter, or None if it cannot be used."""
+        if self._generation is None:
+            try:
+                self._generation = GenerationCounter(self.path + '.gen')
+            except (OSError, ValueError):
+                logger.warning('Cannot map %s.gen; falling back to stat() on every access', self.path)
+                self.stat_interval = 0
+                self._generation = False
+        return self._generation.read() if self._generation else None
+
+    def _bump_generation(self):
+        """Tell other processes the files changed; called with the file lock held, after writing them."""
+        if self._read_generation() is not None:
+            self._seen_generation = self._generation.bump()
+
+    def _state(self):
+        """Return [snapshot stamp, journal inode, journal offset] of the data held in memory."""
+        return [list(self._stamp) if self._stamp else None, self._journal_ino, self._journal_offset]
+
+    def _disk_state(self):
+        """Return what _state() would be after revalidating, using only stat() calls."""
+        stamp = self._file_stamp()
+        if self.journal_path:
+            try:
+                st = os.stat(self.journal_path)
+                return [list(stamp) if stamp else None, st.st_ino, st.st_size]
+            except FileNotFoundError:
+                pass
+        return [list(stamp) if stamp else None, None, 0]
+
+    def _load(self, stamp):
+        try:
+            started = time.perf_counter()
+            with open(self.path, 'rb') as f:
+                contents = f.read()
+            read = time.perf_counter()
+            metrics.record_read('snapshot', read - started, len(contents))
+            invoices = encoding.loads(contents) if contents.strip() else []  # Empty file means no invoices
+            metrics.JSON_DURATION.observe(time.perf_counter() - read, op='decode', source='snapshot')
+        except FileNotFoundError:
+            invoices = []
+
+        self._by_id = {}
+        self._by_number = {}
+        self._encoded = {}
+        self._detail_maps = {}
+        for invoice in invoices:
+            # Keep the first record for a duplicated id, like the old next() scan did
+            if invoice['id'] not in self._by_id:
+                self._by_id[invoice['id']] = invoice
+                self._by_number.setdefault(invoice.get('invoice_number'), invoice)
+
+        # Build the sorted structures in one pass instead of inserting one invoice at a time
+        self._sorted_ids = sorted(self._by_id)
+        for index in self._secondary_indexes:
+            index.rebuild(self._by_id.values())
+
+        # The stamp is taken before reading, so a concurrent write only causes one extra reload
+        self._stamp = stamp
+        self._loaded = True
+
+        self._journal_ino = None
+        self._journal_offset = 0
+        self._journal_records = 0
+        if self.journal_path:
+            self._replay_journal()
+
+    def _replay_journal(self):
+        """Apply journal records appended since the last replay."""
+        try:
+            st = os.stat(self.journal_path)
+        except FileNotFoundError:
+            if self._journal_offset:
+                self._load(self._file_stamp())  # Journal removed behind our back
+            return
+
+        if self._journal_ino is not None and (st.st_ino != self._journal_ino or st.st_size < self._journal_offset):
+            # The journal was compacted by another process; start over from its snapshot
+            self._load(self._file_stamp())
+            return
+        self._journal_ino = st.st_ino
+        if st.st_size == self._journal_offset:
+            return
+
+        started = time.perf_counter()
+        with open(self.journal_path, 'rb') as f:
+            f.seek(self._journal_offset)
+            chunk = f.read(st.st_size - self._journal_offset)
+        metrics.record_read('journal', time.perf_counter() - started, len(chunk))
+
+        # Only consume complete lines; a partial last line is still being written
+        end = chunk.rfind(b'\n') + 1
+        decode_seconds = 0.0
+        for line in chunk[:end].splitlines():
+            if not line.strip():
+                continue
+            started = time.perf_counter()
+            try:
+                record = encoding.loads(line)
+            except ValueError:
+                logger.warning('Skipping corrupt record in %s', self.journal_path)
+                continue
+            finally:
+                decode_seconds += time.perf_counter() - started
+            self._apply(record)
+            self._journal_records += 1
+        self._journal_offset += end
+        if end:
+            metrics.JSON_DURATION.observe(decode_seconds, op='decode', source='journal')
+
+    def _index(self, invoice):
+        invoice_id = invoice['id']
+        if invoice_id not in self._by_id:
+            bisect.insort(self._sorted_ids, invoice_id)  # Ids are allocated in order, so this is usually an append
+        self._by_id[invoice_id] = invoice
+        self._by_number.setdefault(invoice.get('invoice_number'), invoice)
+        for index in self._secondary_indexes:
+            index.add(invoice)
+
+    def _unindex(self, invoice):
+        invoice_id = invoice['id']
+        del self._by_id[invoice_id]
+        del self._sorted_ids[bisect.bisect_left(self._sorted_ids, invoice_id)]
+        self._unindex_fields(invoice)
+
+    def _unindex_fields(self, invoice):
+        """Drop an invoice from every index except the id ones."""
+        number = invoice.get('invoice_number')
+        if self._by_number.get(number) is invoice:
+            del self._by_number[number]
+        self._encoded.pop(invoice['id'], None)
+        self._detail_maps.pop(invoice['id'], None)
+        for index in self._secondary_indexes:
+            index.remove(invoice)
+
+    def _detail_map(self, invoice):
+        """Return ``(details, {detail id: position})`` for an invoice, reusing the map from its last patch."""
+        details = invoice.get('details') or []
+        cached = self._detail_maps.get(invoice['id'])
+        if cached is not None and cached[0] is details:
+            return cached
+        positions = {}
+        for position, detail in enumerate(details):
+            positions.setdefault(detail.get('id'), position)
+        return details, positions
+
+    # ------------------------------------------------------------------
+    # Mutation records
+    # ------------------------------------------------------------------
+
+    def _apply(self, record):
+        """Apply one mutation record to the in-memory indexes.
+
+        Records set state rather than describe changes, so replaying the same
+        journal twice (e.g. after a crash during compaction) converges on the
+        same result.
+        """
+        op = record['op']
+        if op in ('create', 'update'):
+            invoice = record['invoice']
+            old = self._by_id.get(invoice['id'])
+            if old is not None:
+                self._unindex_fields(old)
+            self._index(invoice)  # Reassigning the key keeps the record's position in the file
+            return invoice
+        if op == 'create_many':
+            return [self._apply({'op': 'create', 'invoice': invoice}) for invoice in record['invoices']]
+        if op == 'update_many':
+            invoices = record['invoices']
+            if len(invoices) * 8 < len(self._by_id):
+                return [self._apply({'op': 'update', 'invoice': invoice}) for invoice in invoices]
+            # Most of the store changes: swap the records in and rebuild the sorted structures once, like _load()
+            for invoice in invoices:
+                invoice_id = invoice['id']
+                old = self._by_id.get(invoice_id)
+                if old is None:
+                    bisect.insort(self._sorted_ids, invoice_id)
+                elif self._by_number.get(old.get('invoice_number')) is old:
+                    del self._by_number[old.get('invoice_number')]
+                self._encoded.pop(invoice_id, None)
+                self._by_id[invoice_id] = invoice
+                self._by_number.setdefault(invoice.get('invoice_number'), invoice)
+            for index in self._secondary_indexes:
+                index.rebuild(self._by_id.values())
+            return invoices
+        if op == 'delete':
+            invoice = self._by_id.get(record['id'])
+            if invoice is not None:
+                self._unindex(invoice)
+            return invoice
+        if op == 'patch_details':
+            invoice = self._by_id.get(record['id'])
+            if invoice is None:
+                return None
+            details, positions = self._detail_map(invoice)
+            details = list(details)
+            replaced = []
+            for detail in record['details']:
+                position = positions.get(detail['id'])
+                if position is None:
+                    positions[detail['id']] = len(details)
+                    details.append(detail)
+                else:
+                    replaced.append(details[position])
+                    details[position] = detail
+            removed_ids = set(record['removed'])
+            if removed_ids:
+                replaced.extend(d for d in details if d.get('id') in removed_ids)
+                details = [d for d in details if d.get('id') not in removed_ids]
+                positions = {}
+                for position, detail in enumerate(details):
+                    positions.setdefault(detail.get('id'), position)
+            patched = {**invoice, 'details': details, 'total_amount': record['total_amount']}
+
+            # Only the changed details are re-tokenized; the other indexes key on invoice fields
+            self._by_id[patched['id']] = patched
+            number = patched.get('invoice_number')
+            if self._by_number.get(number) is invoice:
+                self._by_number[number] = patched
+            self._encoded.pop(patched['id'], None)
+            for index in self._secondary_indexes:
+                if index is self._text_index:
+                    index.update_details(patched['id'], replaced, record['details'])
+                else:
+                    index.remove(invoice)
+                    index.add(patched)
+            self._detail_maps[patched['id']] = (details, positions)
+            return {key: record[key] for key in ('id', 'total_amount', 'details', 'removed')}
+        if op == 'delete_detail':
+            invoice = self._by_id.get(record['id'])
+            if invoice is not None:
+                details = [d for d in invoice.get('details', []) if d.get('id') != record['detail_id']]
+                # Journals written before the total was recorded keep the old total
+                total = record.get('total_amount', invoice.get('total_amount'))
+                invoice = self._apply({'op': 'update', 'invoice': {**invoice, 'details': details,
+                                                                   'total_amount': total}})
+            return invoice
+        raise ValueError(f'Unknown store operation: {op}')
+
+    def _submit(self, build):
+        """Queue a mutation for the writer thread and wait until it is durable.
+
+        ``build`` runs on the writer thread with both locks held and the store
+        revalidated, and returns the record to commit (or raises, e.g.
+        KeyError, which is re-raised here).
+        """
+        pending = _PendingWrite(build, deadline=current_deadline())
+        self._enqueue(pending)
+        if pending.deadline is not None:
+            # Don't wait past the deadline on a writer stuck on the file lock or an fsync
+            in_time = pending.done.wait(max(0.0, pending.deadline - time.monotonic()))
+            if not in_time and pending.claim.abandon():
+                raise deadline_passed()
+        return pending.result()
+
+    async def _asubmit(self, build):
+        """Like _submit(), but awaits the writer thread instead of blocking a thread on it.
+
+        Any number of coroutines can wait on the single writer thread, so an
+        ASGI worker serves concurrent writes without a thread per request.
+        """
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        pending = _PendingWrite(
+            build, on_done=lambda pending: loop.call_soon_threadsafe(_resolve_future, future, pending),
+            deadline=current_deadline(),
+        )
+        self._enqueue(pending)
+        return await await_write(future, pending.claim, pending.deadline)
+
+    def _enqueue(self, pending):
+        if self._writer is None:
+            with self._writer_lock:
+                if self._writer is None:
+                    self._writer = threading.Thread(target=self._run_writer, name='invoice-store-writer', daemon=True)
+                    self._writer.start()
+        self._queue.put(pending)
+
+    def _run_writer(self):
+        """Group commit: everything queued within one commit window shares a single write and fsync."""
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + self.commit_window
+            while len(batch) < self.max_batch:
+                try:
+                    timeout = deadline - time.monotonic()
+                    batch.append(self._queue.get(timeout=timeout) if timeout > 0 else self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            self._commit_batch(batch)
+
+    @contextmanager
+    def _write_locks(self):
+        """Hold the thread lock and then the lock file, recording how long each took to get."""
+        started = time.perf_counter()
+        with self._lock:
+            acquired = time.perf_counter()
+            metrics.LOCK_WAIT.observe(acquired - started, lock='thread')
+            with self._file_lock:
+                metrics.LOCK_WAIT.observe(time.perf_counter() - acquired, lock='file')
+                yield
+
+    def _commit_batch(self, batch):
+        committed = []
+        try:
+            with self._write_locks():
+                # Pick up whatever other processes committed before we took the lock
+                self._revalidate()
+                records = []
+                for pending in batch:
+                    if not pending.claim.start():
+                        continue  # Its caller gave up at the deadline and was answered already
+                    try:
+                        check_deadline(pending.deadline)  # Give up on writes that waited too long, unapplied
+                        record = pending.build()
+                        pending.value = self._apply(record)
+                    except Exception as e:
+                        pending.error = e
+                        continue
+                    records.append(record)
+                    committed.append(pending)
+
+                if records:
+                    try:
+                        if self.journal_path:
+                            self._append_journal(records)
+                        else:
+                            self._flush()
+                        self._bump_generation()
+                    except Exception:
+                        # Memory may now disagree with the file, so force a reload next time,
+                        # and let other processes look at whatever part of the write landed
+                        self._loaded = False
+                        self._bump_generation()
+                        raise
+        except Exception as e:
+            for pending in committed:
+                pending.error = e
+        finally:
+            for pending in batch:
+                pending.finish()
+
+    def _append_journal(self, records):
+        started = time.perf_counter()
+        data = b''.join(_encode_record(record) for record in records)
+        written = time.perf_counter()
+        metrics.JSON_DURATION.observe(written - started, op='encode', source='journal')
+        # Reopen per batch so a journal replaced by compaction is never written through a stale handle
+        with open(self.journal_path, 'ab') as f:
+            f.write(data)
+            f.flush()
+            if self.fsync:
+                os.fsync(f.fileno())
+            st = os.fstat(f.fileno())
+        metrics.record_write('journal', time.perf_counter() - written, len(data))
+        if self._journal_ino in (None, st.st_ino) and st.st_size == self._journal_offset + len(data):
+            self._journal_ino = st.st_ino
+            self._journal_offset = st.st_size
+            self._journal_records += len(records)
+        else:
+            # The file lock should prevent this; fall back to a full reload just in case
+            self._loaded = False
+
+        if self._journal_records > self.compact_threshold and not self._compacting:
+            self._compacting = True
+            # Not a daemon, so a worker shutting down finishes the swap instead of leaving a temp file
+            threading.Thread(target=self._background_compact, name='invoice-journal-compact', daemon=False).start()
+
+    def _flush(self):
+        """Atomically replace the snapshot with the current store and remember the new stamp."""
+        _atomic_write(self.path, self._encode_snapshot(self._by_id.values()), self.fsync)
+        self._stamp = self._file_stamp()
+        self._export_columns()
+
+    def _encode_snapshot(self, invoices):
+        # Compact JSON spliced from the cached per-invoice encodings: a snapshot rewrite
+        # after a mutation only re-encodes the invoices that changed
+        with metrics.JSON_DURATION.time(op='encode', source='snapshot'):
+            return b'[' + b','.join(self.encode(invoices)) + b']'
+
+    def _export_columns(self):
+        """Rewrite the columnar snapshot (if configured) from memory; called with both locks held.
+
+        A failure only costs other workers their mapped reads, so it is
+        logged rather than failing the write that triggered it.
+        """
+        if not self.columnar_path:
+            return
+        from .columnar import encode_columnar
+        try:
+            invoices = [self._by_id[invoice_id] for invoice_id in self._sorted_ids]
+            data = encode_columnar(
+                self._state(), invoices, self.encode(invoices),
+                self._by_customer_prefix._ids, self._by_date._ids, self._by_total._ids,
+                {group: rollup.groups() for group, rollup in self._rollups.items()},
+            )
+            # Derived from the snapshot, which is already durable, so skip the fsync
+            _atomic_write(self.columnar_path, data, fsync=False, file='columns')
+        except Exception:
+            logger.exception('Exporting the columnar snapshot %s failed', self.columnar_path)
+
+    def export_columns(self):
+        """Write the columnar snapshot for the current state of the store."""
+        with self._write_locks():
+            self._revalidate()
+            self._export_columns()
+            self._bump_generation()  # Lets mapped readers notice the new file
+
+    # ------------------------------------------------------------------
+    # Compaction
+    # ------------------------------------------------------------------
+
+    def _background_compact(self):
+        try:
+            self.compact()
+        except Exception:
+            logger.exception('Compacting %s failed', self.journal_path)
+        finally:
+            self._compacting = False
+
+    def compact(self):
+        """Fold the journal into a new snapshot.
+
+        The snapshot is encoded outside the locks, so writers are only held up
+        while the files are swapped. Records appended meanwhile are carried
+        over into the new, shorter journal.
+        """
+        if not self.journal_path:
+            return
+        with self._lock:
+            self._revalidate()
+            if not self._journal_offset:
+                return  # Nothing to fold in
+            invoices = list(self._by_id.values())
+            stamp = self._stamp
+            journal_ino = self._journal_ino
+            offset = self._journal_offset
+
+        tmp_path = _write_temp(self.path, self._encode_snapshot(invoices), self.fsync)
+        try:
+            with self._write_locks():
+                self._revalidate()
+                if self._stamp != stamp or self._journal_ino != journal_ino:
+                    return  # Another process compacted first
+                started = time.perf_counter()
+                with open(self.journal_path, 'rb') as f:
+                    f.seek(offset)
+                    tail = f.read(self._journal_offset - offset)
+                metrics.record_read('journal', time.perf_counter() - started, len(tail))
+
+                # A crash between these two renames replays already-folded records, which is harmless
+                os.replace(tmp_path, self.path)
+                _atomic_write(self.journal_path, tail, self.fsync, file='journal')
+
+                self._stamp = self._file_stamp()
+                self._journal_ino = os.stat(self.journal_path).st_ino
+                self._journal_offset = len(tail)
+                self._journal_records = tail.count(b'\n')
+                self._export_columns()
+                self._bump_generation()
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    # ------------------------------------------------------------------
+    # Reads
+    # ------------------------------------------------------------------
+
+    def encode(self, invoices):
+        """Return the JSON bytes of each invoice, reusing the encoding cached since its last change.
+
+        Entries are keyed by id and checked by identity, since every mutation
+        stores a new dict, so a stale encoding can never be returned.
+        """
+        encoded = []
+        started = time.perf_counter()
+        misses = 0
+        for invoice in invoices:
+            entry = self._encoded.get(invoice['id'])
+            if entry is None or entry[0] is not invoice:
+                entry = self._encoded[invoice['id']] = (invoice, encoding.dumps(invoice))
+                misses += 1
+            encoded.append(entry[1])
+        if misses:
+            metrics.JSON_DURATION.observe(time.perf_counter() - started, op='encode', source='invoice')
+        return encoded
+
+    def version(self):
+        """Return a token that changes with every committed mutation, for ETags.
+
+        Built from the snapshot file's identity and how much of the journal
+        has been applied, so every worker reports the same token for the
+        same data, and checking it costs a stat() rather than a read.
+        """
+        with self._lock:
+            self._revalidate()
+            return version_token(*self._state())
+
+    def page_encoded(self, after=None, limit=None, filters=None):
+        """Like page(), but returns the JSON bytes of each invoice instead of the dicts."""
+        invoices, next_cursor = self.page(after, limit, filters)
+        return self.encode(invoices), next_cursor
+
+    def all(self):
+        """Return all invoices in file order."""
+        with self._lock:
+            self._revalidate()
+            return list(self._by_id.values())
+
+    def get(self, invoice_id):
+        """Return the invoice with the given id, or None."""
+        with self._lock:
+            self._revalidate()
+            return self._by_id.get(invoice_id)
+
+    def get_by_number(self, invoice_number):
+        """Return the invoice with the given invoice_number, or None."""
+        with self._lock:
+            self._revalidate()
+            return self._lookup_number(invoice_number)
+
+    def _lookup_number(self, invoice_number):
+        invoice = self._by_number.get(invoice_number)
+        if invoice is None and isinstance(invoice_number, str) and invoice_number.isdigit():
+            # Generated invoice numbers are ints, but arrive as strings from URLs and query strings
+            invoice = self._by_number.get(int(invoice_number))
+        return invoice
+
+    def get_many(self, invoice_ids=(), invoice_numbers=()):
+        """Return the invoices with the given ids and invoice_numbers, in the order asked for.
+
+        Each key costs one hash lookup. Unknown keys are skipped, and an
+        invoice asked for twice is returned once.
+        """
+        with self._lock:
+            self._revalidate()
+            found = {}
+            for invoice_id in invoice_ids:
+                invoice = self._by_id.get(invoice_id)
+                if invoice is not None:
+                    found.setdefault(invoice_id, invoice)
+            for invoice_number in invoice_numbers:
+                invoice = self._lookup_number(invoice_number)
+                if invoice is not None:
+                    found.setdefault(invoice['id'], invoice)
+            return list(found.values())
+
+    def get_many_encoded(self, invoice_ids=(), invoice_numbers=()):
+        """Like get_many(), but returns the JSON bytes of each invoice instead of the dicts."""
+        return self.encode(self.get_many(invoice_ids, invoice_numbers))
+
+    def page(self, after=None, limit=None, filters=None):
+        """Return up to ``limit`` invoices with an id greater than ``after``, in id order.
+
+        ``filters`` may hold any of ``customer`` (exact name),
+        ``customer_prefix`` (case-insensitive), ``date_from``/``date_to``
+        (ISO dates, inclusive) and ``min_total``/``max_total`` (inclusive).
+
+        Returns ``(invoices, next_cursor)``; ``next_cursor`` is the id to pass
+        as ``after`` for the following page, or None on the last page.
+        """
+        with self._lock:
+            self._revalidate()
+            ids = self._sorted_ids if not filters else sorted(self._filter_ids(filters))
+            start = 0 if after is None else bisect.bisect_right(ids, after)
+            end = len(ids) if limit is None else min(start + limit, len(ids))
+            invoices = [self._by_id[invoice_id] for invoice_id in ids[start:end]]
+            next_cursor = ids[end - 1] if end < len(ids) and invoices else None
+            return invoices, next_cursor
+
+    def search(self, query, limit=20, offset=0):
+        """Full-text search over customer names and detail descriptions.
+
+        Returns ``(invoices, total)``: one ranked page of invoices and the
+        total number of matches.
+        """
+        with self._lock:
+            self._revalidate()
+            ranked, total = self._text_index.search(query, offset + limit)
+            return [self._by_id[invoice_id] for invoice_id, _ in ranked[offset:]], total
+
+    def report(self, group_by=REPORT_GROUPS):
+        """Return ``{group: [{'key', 'invoice_count', 'revenue'}]}`` for each requested grouping.
+
+        Served from the revenue rollups, so the cost depends on the number of
+        groups, not the number of invoices.
+        """
+        with self._lock:
+            self._revalidate()
+            return {
+                group: [
+                    {'key': k, 'invoice_count': count, 'revenue': cents / 100}
+                    for k, count, cents in self._rollups[group].groups()
+                ]
+                for group in group_by
+            }
+
+    def rebuild_rollups(self):
+        """Recompute the revenue rollups from the invoices and return the number of groups."""
+        with self._lock:
+            self._revalidate()
+            for rollup in self._rollups.values():
+                rollup.rebuild(self._by_id.values())
+            return sum(len(rollup) for rollup in self._rollups.values())
+
+    def _filter_ids(self, filters):
+        """Return the set of ids matching every filter, starting from the most selective index."""
+        candidates = []
+        if filters.get('customer') is not None:
+            candidates.append(self._by_customer.lookup(filters['customer']))
+        if filters.get('customer_prefix') is not None:
+            candidates.append(self._by_customer_prefix.prefix(filters['customer_prefix'].casefold()))
+        if filters.get('date_from') is not None or filters.get('date_to') is not None:
+            candidates.append(self._by_date.range(filters.get('date_from'), filters.get('date_to')))
+        if filters.get('min_total') is not None or filters.get('max_total') is not None:
+            candidates.append(self._by_total.range(filters.get('min_total'), filters.get('max_total')))
+        if not candidates:
+            return set(self._by_id)
+
+        candidates.sort(key=len)
+        ids = set(candidates[0])
+        for other in candidates[1:]:
+            if not ids:
+                break
+            ids.intersection_update(other)
+        return ids
+
+    # ------------------------------------------------------------------
+    # Writes
+    # ------------------------------------------------------------------
+
+    def _allocate_ids(self, count):
+        """Return the first of ``count`` consecutive new ids; called by builds, with the locks held."""
+        def floor():
+            return self._sorted_ids[-1] if self._sorted_ids else 0
+        start = self._ids.allocate(count, floor)
+        if any(invoice_id in self._by_id for invoice_id in range(start, start + count)):
+            # Only ids written outside the sequence (e.g. by hand) can collide; lease past all of them
+            self._ids.discard()
+            start = self._ids.allocate(count, floor)
+        return start
+
+    def _new_invoice(self, invoice_id, fields):
+        return {'id': invoice_id, 'invoice_number': format_invoice_number(self.number_format, invoice_id), **fields}
+
+    def _build_create(self, fields):
+        def build():
+            return {'op': 'create', 'invoice': self._new_invoice(self._allocate_ids(1), fields)}
+        return build
+
+    def _build_create_many(self, fields_list):
+        def build():
+            start = self._allocate_ids(len(fields_list))
+            return {'op': 'create_many', 'invoices': [
+                self._new_invoice(start + i, fields) for i, fields in enumerate(fields_list)
+            ]}
+        return build
+
+    def _build_update(self, invoice):
+        def build():
+            if invoice['id'] not in self._by_id:
+                raise KeyError(invoice['id'])
+            return {'op': 'update', 'invoice': invoice}
+        return build
+
+    def _build_delete(self, invoice_id):
+        def build():
+            if invoice_id not in self._by_id:
+                raise KeyError(invoice_id)
+            return {'op': 'delete', 'id': invoice_id}
+        return build
+
+    def _build_delete_detail(self, invoice_id, detail_id):
+        def build():
+            invoice = self._by_id.get(invoice_id)
+            if invoice is None:
+                raise KeyError(invoice_id)
+            # Lower the total by the removed lines, as patch_details does, so the rollups follow
+            removed = sum(money.detail_total(d) for d in invoice.get('details', []) if d.get('id') == detail_id)
+            total = money.to_cents(invoice.get('total_amount') or 0) - removed
+            return {'op': 'delete_detail', 'id': invoice_id, 'detail_id': detail_id,
+                    'total_amount': money.from_cents(total)}
+        return build
+
+    def _build_patch_details(self, invoice_id, add, change, remove):
+        def build():
+            invoice = self._by_id.get(invoice_id)
+            if invoice is None:
+                raise KeyError(invoice_id)
+            details, positions = self._detail_map(invoice)
+            delta = 0
+            written = []
+            for fields in change:
+                old = details[positions[fields['id']]]  # KeyError for an unknown detail id
+                detail = {**old, **fields}
+                cents = money.check_cents(money.detail_total(detail))
+                delta += cents - money.detail_total(old)
+                written.append({**detail, 'line_total': money.from_cents(cents)})
+            for detail_id in remove:
+                delta -= money.detail_total(details[positions[detail_id]])
+            # Numbered past the highest id before the removals, so a removed id is not handed out again
+            next_id = max((i for i in positions if isinstance(i, int)), default=0) + 1
+            for offset, fields in enumerate(add):
+                cents = money.detail_total(fields)
+                delta += cents
+                written.append({**fields, 'id': next_id + offset, 'line_total': money.from_cents(cents)})
+            total = money.check_cents(money.to_cents(invoice.get('total_amount') or 0) + delta)
+            return {'op': 'patch_details', 'id': invoice_id, 'details': written, 'removed': list(remove),
+                    'total_amount': money.from_cents(total)}
+        return build
+
+    def _build_recompute_totals(self, summary):
+        def build():
+            # Flatten every line item so the multiply-and-sum runs as one batch over all invoices
+            invoices, quantities, unit_cents, counts = [], [], [], []
+            for invoice in self._by_id.values():
+                details = invoice.get('details') or []
+                try:
+                    parsed = [
+                        (money.to_quantity(detail.get('quantity') or 0), money.to_cents(detail.get('unit_price') or 0))
+                        for detail in details
+                    ]
+                except (AttributeError, TypeError, ValueError):
+                    summary['skipped'] += 1
+                    continue
+                invoices.append(invoice)
+                for quantity, unit in parsed:
+                    quantities.append(quantity)
+                    unit_cents.append(unit)
+                counts.append(len(parsed))
+            lines, totals = money.batch_totals(quantities, unit_cents, counts)
+
+            changed = []
+            position = 0
+            for invoice, total in zip(invoices, totals):
+                details = []
+                for detail in invoice.get('details') or []:
+                    details.append({
+                        **detail,
+                        'quantity': quantities[position],
+                        'unit_price': money.from_cents(unit_cents[position]),
+                        'line_total': money.from_cents(lines[position]),
+                    })
+                    position += 1
+                fixed = {**invoice, 'details': details, 'total_amount': money.from_cents(total)}
+                if fixed != invoice:
+                    changed.append(fixed)
+            summary['checked'] = len(invoices)
+            summary['changed'] = len(changed)
+            return {'op': 'update_many', 'invoices': changed}
+        return build
+
+    def patch_details(self, invoice_id, add=(), change=(), remove=()):
+        """Add, change and remove individual details of one invoice.
+
+        ``change`` items carry the ``id`` of the detail and the fields to
+        set; ``remove`` is a list of detail ids. The total is adjusted by
+        the change in the affected line totals, and only the affected
+        details are written to the journal. Returns ``{'id', 'total_amount',
+        'details', 'removed'}`` with just the written details, so a large
+        invoice is never copied out. Raises KeyError for an unknown invoice
+        or detail id, and ValueError for a line or invoice total out of
+        range (money.MAX_CENTS).
+        """
+        return self._submit(self._build_patch_details(invoice_id, add, change, remove))
+
+    def recompute_totals(self):
+        """Recompute every line total and invoice total in integer cents and save the ones that differ.
+
+        Quantities are stored as ints and prices as floats afterwards.
+        Invoices whose details cannot be parsed are left alone. Returns
+        ``{'checked', 'changed', 'skipped'}`` counts.
+        """
+        summary = {'checked': 0, 'changed': 0, 'skipped': 0}
+        self._submit(self._build_recompute_totals(summary))
+        return summary
+
+    def create(self, fields):
+        """Assign an id and invoice_number to a new invoice and save it."""
+        return self._submit(self._build_create(fields))
+
+    def create_many(self, fields_list):
+        """Save many new invoices in one commit, with a contiguous block of ids."""
+        return self._submit(self._build_create_many(fields_list))
+
+    def update(self, invoice):
+        """Replace the stored invoice that has the same id."""
+        return self._submit(self._build_update(invoice))
+
+    def delete(self, invoice_id):
+        """Remove the invoice with the given id."""
+        return self._submit(self._build_delete(invoice_id))
+
+    def delete_detail(self, invoice_id, detail_id):
+        """Remove one detail line from an invoice."""
+        return self._submit(self._build_delete_detail(invoice_id, detail_id))
+
+    # Async variants for ASGI views: same semantics, awaited rather than blocking
+
+    async def acreate(self, fields):
+        return await self._asubmit(self._build_create(fields))
+
+    async def acreate_many(self, fields_list):
+        return await self._asubmit(self._build_create_many(fields_list))
+
+    async def aupdate(self, invoice):
+        return await self._asubmit(self._build_update(invoice))
+
+    async def adelete(self, invoice_id):
+        return await self._asubmit(self._build_delete(invoice_id))
+
+    async def adelete_detail(self, invoice_id, detail_id):
+        return await self._asubmit(self._build_delete_detail(invoice_id, detail_id))
+
+    async def apatch_details(self, invoice_id, add=(), change=(), remove=()):
+        return await self._asubmit(self._build_patch_details(invoice_id, add, change, remove))
+
+
+_stores = {}
+_stores_lock = threading.Lock()
+
+
+def get_json_store():
+    """Return the shared InvoiceStore for the configured invoice file.
+
+    With INVOICE_COLUMNAR_SNAPSHOT on, it is wrapped in a MappedInvoiceStore
+    that serves reads from the memory-mapped columnar snapshot.
+    """
+    path = str(getattr(settings, 'INVOICE_FILE_PATH', DEFAULT_INVOICE_FILE_PATH))
+    store = _stores.get(path)
+    if store is None:
+        with _stores_lock:
+            store = _stores.get(path)
+            if store is None:
+                journal_path = None
+                if getattr(settings, 'INVOICE_STORE_JOURNAL', False):
+                    journal_path = str(getattr(settings, 'INVOICE_JOURNAL_PATH', None) or path + '.journal')
+                columnar_path = None
+                if getattr(settings, 'INVOICE_COLUMNAR_SNAPSHOT', False):
+                    columnar_path = str(getattr(settings, 'INVOICE_COLUMNAR_PATH', None) or path + '.columns')
+                store = InvoiceStore(
+                    path,
+                    journal_path=journal_path,
+                    compact_threshold=getattr(settings, 'INVOICE_JOURNAL_COMPACT_THRESHOLD',
+                                              DEFAULT_JOURNAL_COMPACT_THRESHOLD),
+                    commit_window=getattr(settings, 'INVOICE_GROUP_COMMIT_WINDOW', DEFAULT_GROUP_COMMIT_WINDOW),
+                    max_batch=getattr(settings, 'INVOICE_GROUP_COMMIT_MAX_BATCH', DEFAULT_GROUP_COMMIT_MAX_BATCH),
+                    fsync=getattr(settings, 'INVOICE_STORE_FSYNC', True),
+                    columnar_path=columnar_path,
+                    stat_interval=getattr(settings, 'INVOICE_STORE_STAT_INTERVAL', DEFAULT_STAT_INTERVAL),
+                    id_block_size=getattr(settings, 'INVOICE_ID_BLOCK_SIZE', DEFAULT_ID_BLOCK_SIZE),
+                    number_format=getattr(settings, 'INVOICE_NUMBER_FORMAT', None),
+                )
+                if columnar_path:
+                    from .columnar import MappedInvoiceStore
+                    store = MappedInvoiceStore(store)
+                _stores[path] = store
+    return store
+
+
+def get_store():
+    """Return the invoice store selected by INVOICE_STORAGE_BACKEND ('json' or 'sqlite')."""
+    backend = getattr(settings, 'INVOICE_STORAGE_BACKEND', 'json')
+    if backend == 'json':
+        return get_json_store()
+    if backend == 'sqlite':
+        store = _stores.get('sqlite')
+        if store is None:
+            from .sqlite_store import SqliteInvoiceStore  # Models can only be imported once apps are loaded
+            store = _stores.setdefault('sqlite', SqliteInvoiceStore(
+                id_block_size=getattr(settings, 'INVOICE_ID_BLOCK_SIZE', DEFAULT_ID_BLOCK_SIZE),
+                number_format=getattr(settings, 'INVOICE_NUMBER_FORMAT', None),
+            ))
+        return store
+    raise ValueError(f'Unknown INVOICE_STORAGE_BACKEND: {backend!r}')
@@ -14,22 +14,50 @@ Including another URLconf
     1. Import the include() function: from django.urls import include, path
     2. Add a URL to urlpatterns:  path('blog/', include('blog.urls'))
 """
+from django.apps import apps
 from django.urls import path
 from . import views  # Import your views
-from django.contrib import admin
 
 urlpatterns = [
-    path('admin/', admin.site.urls),
-
     # URL for getting all invoices (GET method)
     path('api/invoices/', views.get_invoices, name='get_invoices'),
 
+    # URL for getting one invoice by id (GET method)
+    path('api/invoices/<int:invoice_id>/', views.get_invoice, name='get_invoice'),
+
+    # URL for getting one invoice by its invoice_number (GET method)
+    path('api/invoices/number/<str:invoice_number>/', views.get_invoice_by_number, name='get_invoice_by_number'),
+
+    # URL for exporting invoices as CSV or NDJSON (GET method, ?format=)
+    path('api/invoices/export/', views.export_invoices, name='export_invoices'),
+
+    # URL for full-text search over invoices (GET method, ?q=)
+    path('api/invoices/search/', views.search_invoices, name='search_invoices'),
+
+    # URL for revenue and invoice counts per customer, day and month (GET method, ?group_by=)
+    path('api/invoices/reports/', views.get_reports, name='get_reports'),
+
     # URL for creating a new invoice (POST method)
     path('api/invoices/create/', views.create_invoice, name='create_invoice'),
 
+    # URL for creating many invoices at once (POST method, JSON array or NDJSON body)
+    path('api/invoices/bulk/', views.bulk_create_invoices, name='bulk_create_invoices'),
+
     # URL for updating an existing invoice (PUT method)
     path('api/invoices/update/', views.update_invoice, name='update_invoice'),
 
+    # URL for adding, changing or removing individual details of an invoice (PATCH method)
+    path('api/invoices/<int:invoice_id>/details/', views.patch_invoice_details, name='patch_invoice_details'),
+
+    # URL for request latency and store I/O metrics in the Prometheus text format (GET method)
+    path('api/metrics/', views.get_metrics, name='get_metrics'),
+
     # URL for deleting an invoice (DELETE method)
     path('api/invoices/delete/', views.delete_invoice, name='delete_invoice'),
 ]
+
+# The API-only settings (backend/settings_api.py) leave the admin out, so only import it when installed
+if apps.is_installed('django.contrib.admin'):
+    from django.contrib import admin
+
+    urlpatterns.insert(0, path('admin/', admin.site.urls))
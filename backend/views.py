@@ -1,22 +1,341 @@
+import csv
 import json
+import copy
 import asyncio
-from django.http import JsonResponse
+import datetime
+import functools
+import hashlib
+import logging
+import re
+from django.conf import settings
+from django.core.exceptions import RequestDataTooBig
+from django.core.handlers.asgi import ASGIRequest
+from django.http import HttpResponse, JsonResponse, StreamingHttpResponse
+from django.utils.cache import get_conditional_response
 from django.views.decorators.csrf import csrf_exempt
-from .serializers import InvoiceSerializer, read_invoices_from_file, write_invoices_to_file
-from asgiref.sync import sync_to_async  # Import for async compatibility with sync functions
-import os
+from . import metrics, money
+from .admission import (DEFAULT_WRITE_DEADLINE, DEFAULT_WRITE_QUEUE_DEPTH, DEFAULT_WRITE_RETRY_AFTER, WriteRejected,
+                        end_deadline, start_deadline, write_admission)
+from .encoding import ResponseCache, dumps
+from .idempotency import MAX_KEY_LENGTH, REPLAYS, get_idempotency_cache
+from .logs import log_sampled
+from .store import REPORT_GROUPS, get_store
+
+# Encoded bodies of recent GET responses, reused until the store changes
+response_cache = ResponseCache(getattr(settings, 'INVOICE_RESPONSE_CACHE_SIZE', 64))
+
+logger = logging.getLogger(__name__)
+
+metrics.REGISTRY.gauge('invoice_store_invoices', 'Invoices in the store.', lambda: len(get_store()))
+
+
+def etag_from_store_version(view):
+    """Give GET responses a strong ETag derived from the store version, and cache their bodies.
+
+    The version is read before the view runs, so a request whose
+    If-None-Match already holds the current ETag gets a 304 without any
+    invoice being read or serialized. Otherwise the body cached for the same
+    URL at the same version is served as is. The ETag covers the whole
+    store, so any mutation invalidates every cached response.
+    """
+    @functools.wraps(view)
+    async def wrapper(request, *args, **kwargs):
+        version = await asyncio.to_thread(get_store().version)
+        etag = '"%s"' % version
+        response = get_conditional_response(request, etag=etag)
+        if response is None:
+            body = response_cache.get(request.get_full_path(), version)
+            if body is not None:
+                response = HttpResponse(body, content_type='application/json')
+            else:
+                response = await view(request, *args, **kwargs)
+                if response.status_code == 200 and not response.streaming:
+                    response_cache.set(request.get_full_path(), version, response.content)
+        if response.status_code in (200, 304):
+            response['ETag'] = etag
+        return response
+    return wrapper
+
+
+def request_fingerprint(request):
+    """Hash of what an Idempotency-Key promises stays the same: method, path and body.
+
+    The body is read through request.body, which Django keeps, so the view
+    can still read it afterwards. Raises RequestDataTooBig for bodies over
+    DATA_UPLOAD_MAX_MEMORY_SIZE.
+    """
+    digest = hashlib.sha256(f'{request.method} {request.get_full_path()}\n'.encode())
+    digest.update(request.body)
+    return digest.hexdigest()
+
+
+def idempotent(view):
+    """Replay the saved response when a write is retried with the same Idempotency-Key header.
+
+    The first response with a status below 500 (other than 409 and 429,
+    which a retry may well get past) is saved with the key, so a retry
+    after a timeout returns the original result, marked with an
+    Idempotent-Replayed header, without touching the store. Reusing a key
+    for a different request is a 422; retrying while the original is still
+    running, on any worker, is a 409.
+    """
+    @functools.wraps(view)
+    async def wrapper(request, *args, **kwargs):
+        key = request.headers.get('Idempotency-Key')
+        if key is None or request.method not in ('POST', 'PUT', 'PATCH', 'DELETE'):
+            return await view(request, *args, **kwargs)
+        if not key or len(key) > MAX_KEY_LENGTH:
+            return JsonResponse({
+                'status': 'error',
+                'message': f'Idempotency-Key must be 1 to {MAX_KEY_LENGTH} characters.'
+            }, status=400)
 
-INVOICE_FILE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'invoices.json')
+        cache = get_idempotency_cache()
+        try:
+            fingerprint = await asyncio.to_thread(request_fingerprint, request)
+        except RequestDataTooBig:
+            return JsonResponse({
+                'status': 'error',
+                'message': f'Requests with an Idempotency-Key must not exceed '
+                           f'{settings.DATA_UPLOAD_MAX_MEMORY_SIZE} bytes.'
+            }, status=413)
+        saved = await asyncio.to_thread(cache.get, key)
+        if saved is None:
+            # Claim the key in the shared file, unless a request on any worker got to it first
+            saved = await asyncio.to_thread(cache.begin, key, fingerprint)
+        if saved is not None:
+            saved_fingerprint, status, content_type, body = saved
+            if saved_fingerprint != fingerprint:
+                return JsonResponse({
+                    'status': 'error',
+                    'message': 'Idempotency-Key was already used for a different request.'
+                }, status=422)
+            if status is None:
+                return JsonResponse({
+                    'status': 'error',
+                    'message': 'A request with this Idempotency-Key is still being processed.'
+                }, status=409)
+            REPLAYS.inc(view=view.__name__)
+            response = HttpResponse(body, status=status, content_type=content_type)
+            response['Idempotent-Replayed'] = 'true'
+            return response
 
-# Async function to serialize JSON data
-async def async_json_dumps(data, indent=4):
-    """Offload the blocking JSON serialization to a separate thread."""
-    return await asyncio.to_thread(json.dumps, data, indent=indent)
+        try:
+            response = await view(request, *args, **kwargs)
+            if response.status_code < 500 and response.status_code not in (409, 429) and not response.streaming:
+                try:
+                    await asyncio.to_thread(cache.set, key, fingerprint, response.status_code,
+                                            response['Content-Type'], response.content)
+                except OSError:
+                    # The write itself went through; failing the request now would invite a duplicate retry
+                    logger.exception('Saving the response for Idempotency-Key %r failed', key)
+        finally:
+            try:
+                await asyncio.to_thread(cache.end, key)
+            except OSError:
+                logger.exception('Releasing Idempotency-Key %r failed', key)
+        return response
+    return wrapper
 
-# Async function to handle reading invoices from file
-async def async_read_invoices():
-    return await asyncio.to_thread(read_invoices_from_file)
 
+def overloaded_response():
+    """503 for a write turned away by admission control, telling the client when to retry."""
+    response = JsonResponse({
+        'status': 'error',
+        'message': 'Too many writes in progress. Please retry shortly.'
+    }, status=503)
+    response['Retry-After'] = str(getattr(settings, 'INVOICE_WRITE_RETRY_AFTER', DEFAULT_WRITE_RETRY_AFTER))
+    return response
+
+
+def admit_write(view):
+    """Bound the writes a worker takes on: reject with a 503 at once when INVOICE_WRITE_QUEUE_DEPTH are in.
+
+    Admitted writes get INVOICE_WRITE_DEADLINE seconds to reach the store;
+    one still queued after that is dropped unapplied (the store raises
+    WriteRejected, which the view answers with a 503 as well). Reads never
+    pass through here, so they stay responsive while writes are shed.
+    Apply it outside @idempotent, so a rejected write is turned away before
+    its body is read.
+    """
+    @functools.wraps(view)
+    async def wrapper(request, *args, **kwargs):
+        if request.method not in ('POST', 'PUT', 'PATCH', 'DELETE'):
+            return await view(request, *args, **kwargs)
+        if not write_admission.admit(getattr(settings, 'INVOICE_WRITE_QUEUE_DEPTH', DEFAULT_WRITE_QUEUE_DEPTH)):
+            return overloaded_response()
+        token = start_deadline(getattr(settings, 'INVOICE_WRITE_DEADLINE', DEFAULT_WRITE_DEADLINE))
+        try:
+            return await view(request, *args, **kwargs)
+        finally:
+            end_deadline(token)
+            write_admission.release()
+    return wrapper
+
+
+def invoices_response(encoded, message, **extra):
+    """Build a success response whose 'data' is a list of already-encoded invoices.
+
+    Equivalent to JsonResponse({'status', 'message', 'data', **extra}), but
+    each invoice is spliced in from the store's encoding cache (or mapped
+    snapshot) instead of going through the encoder again.
+    """
+    body = [b'{"status":"success","message":', dumps(message), b',"data":[', b','.join(encoded), b']']
+    for key, value in extra.items():
+        body += [b',', dumps(key), b':', dumps(value)]
+    body.append(b'}')
+    return HttpResponse(b''.join(body), content_type='application/json')
+
+
+def invoice_response(encoded, message):
+    """Build a success response whose 'data' is the one encoded invoice in ``encoded``, or a 404."""
+    if not encoded:
+        return JsonResponse({
+            'status': 'error',
+            'message': 'Invoice not found.'
+        }, status=404)
+    body = b'{"status":"success","message":' + dumps(message) + b',"data":' + encoded[0] + b'}'
+    return HttpResponse(body, content_type='application/json')
+
+
+def parse_lookup_params(request):
+    """Read the comma-separated ?ids= and ?invoice_numbers= query parameters."""
+    invoice_ids = [int(value) for value in request.GET.get('ids', '').split(',') if value.strip()]
+    invoice_numbers = [value.strip() for value in request.GET.get('invoice_numbers', '').split(',') if value.strip()]
+    if len(invoice_ids) + len(invoice_numbers) > getattr(settings, 'INVOICE_PAGE_MAX_LIMIT', 1000):
+        raise ValueError
+    return invoice_ids, invoice_numbers
+
+
+def parse_page_params(request):
+    """Read the ?limit= and ?cursor= query parameters (both optional)."""
+    limit = request.GET.get('limit')
+    cursor = request.GET.get('cursor')
+    if limit is not None:
+        limit = int(limit)
+        if limit < 1:
+            raise ValueError('limit must be a positive integer.')
+        limit = min(limit, getattr(settings, 'INVOICE_PAGE_MAX_LIMIT', 1000))
+    if cursor is not None:
+        cursor = int(cursor)  # The cursor is the id of the last invoice on the previous page
+    return limit, cursor
+
+
+def parse_filter_params(request):
+    """Read the optional filter query parameters into a dict for InvoiceStore.page()."""
+    filters = {}
+    for name in ('customer', 'customer_prefix'):
+        if request.GET.get(name):
+            filters[name] = request.GET[name]
+    for name in ('date_from', 'date_to'):
+        if request.GET.get(name):
+            filters[name] = datetime.date.fromisoformat(request.GET[name]).isoformat()
+    for name in ('min_total', 'max_total'):
+        if request.GET.get(name):
+            filters[name] = float(request.GET[name])
+    return filters
+
+
+async def iterate_in_thread(iterator):
+    """Drive a blocking iterator from the event loop, producing each item on a worker thread."""
+    done = object()
+    while (item := await asyncio.to_thread(next, iterator, done)) is not done:
+        yield item
+
+
+def streaming_response(request, chunks, **kwargs):
+    """Return a StreamingHttpResponse that sends the blocking generator ``chunks`` as it is produced.
+
+    Django buffers the whole body when the iterator does not match the
+    server: a sync iterator under ASGI is read with one list() call, and an
+    async one under WSGI likewise. So ASGI requests get an async generator
+    that fetches each chunk on a worker thread, and WSGI ones the generator
+    itself.
+    """
+    if isinstance(request, ASGIRequest):
+        chunks = iterate_in_thread(chunks)
+    return StreamingHttpResponse(chunks, **kwargs)
+
+
+def stream_invoices(cursor=None, limit=None, filters=None):
+    """Yield the invoice list response as JSON text, one chunk of invoices at a time.
+
+    Invoices are fetched from the store by keyset in chunks, so memory use
+    does not depend on the total number of invoices.
+    """
+    store = get_store()
+    chunk_size = getattr(settings, 'INVOICE_STREAM_CHUNK_SIZE', 500)
+    yield b'{"status":"success","message":"Invoices retrieved successfully.","data":['
+
+    sent = 0
+    while limit is None or sent < limit:
+        size = chunk_size if limit is None else min(chunk_size, limit - sent)
+        encoded, cursor = store.page_encoded(cursor, size, filters)
+        if encoded:
+            yield (b',' if sent else b'') + b','.join(encoded)
+            sent += len(encoded)
+        if cursor is None:
+            break
+
+    if limit is None:
+        yield b']}'
+    else:
+        yield b'],"next_cursor":' + dumps(cursor) + b'}'
+
+
+# GET method to list all invoices
+# Optional query parameters:
+#   ?limit=N&cursor=ID  return at most N invoices with an id greater than ID, plus the next cursor
+#   ?stream=1           stream the JSON array instead of building the whole response in memory
+#   ?customer=NAME, ?customer_prefix=PREFIX (case-insensitive)
+#   ?date_from=YYYY-MM-DD&date_to=YYYY-MM-DD, ?min_total=X&max_total=Y (inclusive)
+#   ?ids=1,2,3 and/or ?invoice_numbers=INV001,INV002  return just those invoices, looked up by key
+# Responses carry an ETag; send it back as If-None-Match to get 304 Not Modified when nothing changed
+@etag_from_store_version
+async def get_invoices(request):
+    try:
+        if 'ids' in request.GET or 'invoice_numbers' in request.GET:
+            try:
+                invoice_ids, invoice_numbers = parse_lookup_params(request)
+            except ValueError:
+                return JsonResponse({
+                    'status': 'error',
+                    'message': 'ids must be comma-separated integers, and at most '
+                               f'{getattr(settings, "INVOICE_PAGE_MAX_LIMIT", 1000)} keys may be requested.'
+                }, status=400)
+            encoded = await asyncio.to_thread(get_store().get_many_encoded, invoice_ids, invoice_numbers)
+            return await asyncio.to_thread(invoices_response, encoded, 'Invoices retrieved successfully.')
+
+        try:
+            limit, cursor = parse_page_params(request)
+        except ValueError:
+            return JsonResponse({
+                'status': 'error',
+                'message': 'limit and cursor must be integers.'
+            }, status=400)
+
+        try:
+            filters = parse_filter_params(request)
+        except ValueError:
+            return JsonResponse({
+                'status': 'error',
+                'message': 'Dates must be YYYY-MM-DD and totals must be numeric.'
+            }, status=400)
+
+        if request.GET.get('stream') in ('1', 'true'):
+            return streaming_response(request, stream_invoices(cursor, limit, filters), content_type='application/json')
+
+        encoded, next_cursor = await asyncio.to_thread(get_store().page_encoded, cursor, limit, filters)
+        if limit is None and cursor is None and not filters:
+            return await asyncio.to_thread(invoices_response, encoded, 'Invoices retrieved successfully.')
+        return await asyncio.to_thread(
+            invoices_response, encoded, 'Invoices retrieved successfully.', next_cursor=next_cursor
+        )
+    except Exception as e:
+        return JsonResponse({
+            'status': 'error',
+            'message': str(e)
+        }, status=500)
 
 
 
@@ -25,30 +344,185 @@ async def async_read_invoices():
 
 
 
+# Columns of the CSV export: the invoice fields repeated on every row, then one detail per row
+EXPORT_CSV_COLUMNS = ('invoice_id', 'invoice_number', 'customer_name', 'date', 'total_amount',
+                      'detail_id', 'description', 'quantity', 'unit_price', 'line_total')
 
-def read_invoices_from_file():
-    """Read invoices from the file synchronously."""
+EXPORT_FORMATS = {
+    'csv': ('text/csv; charset=utf-8', 'invoices.csv'),
+    'ndjson': ('application/x-ndjson', 'invoices.ndjson'),
+}
+
+
+class _Echo:
+    """File-like object whose write() returns what it was given, so csv.writer can build rows lazily."""
+
+    def write(self, value):
+        return value
+
+
+def export_rows(invoice):
+    """Flatten an invoice into CSV rows, one per detail (one row with empty detail columns if it has none)."""
+    head = [invoice.get('id'), invoice.get('invoice_number'), invoice.get('customer_name'), invoice.get('date'),
+            invoice.get('total_amount')]
+    details = invoice.get('details') or [{}]
+    return [head + [detail.get('id'), detail.get('description'), detail.get('quantity'), detail.get('unit_price'),
+                    detail.get('line_total')]
+            for detail in details]
+
+
+def stream_export(export_format, filters=None):
+    """Yield every invoice matching ``filters`` as CSV or NDJSON, one chunk of invoices at a time.
+
+    Like stream_invoices(), invoices are fetched from the store by keyset in
+    chunks and each chunk is encoded and sent before the next is read (under
+    ASGI too, see streaming_response()), so memory use does not depend on
+    the size of the export.
+    """
+    store = get_store()
+    chunk_size = getattr(settings, 'INVOICE_STREAM_CHUNK_SIZE', 500)
+    writer = csv.writer(_Echo())
+    if export_format == 'csv':
+        yield writer.writerow(EXPORT_CSV_COLUMNS).encode('utf-8')
+
+    cursor = None
+    while True:
+        if export_format == 'csv':
+            invoices, cursor = store.page(cursor, chunk_size, filters)
+            if invoices:
+                yield ''.join(writer.writerow(row) for invoice in invoices
+                              for row in export_rows(invoice)).encode('utf-8')
+        else:
+            encoded, cursor = store.page_encoded(cursor, chunk_size, filters)
+            if encoded:
+                yield b'\n'.join(encoded) + b'\n'
+        if cursor is None:
+            break
+
+
+# GET method to export invoices for accounting
+# ?format=csv (default) gives one row per detail, with the invoice fields repeated on each row;
+# ?format=ndjson gives one invoice per line, as in the list response
+# Accepts the same customer, date and total filters as the list; the file is streamed, never built in memory
+async def export_invoices(request):
     try:
-        with open(INVOICE_FILE_PATH, 'r') as f:
-            return json.load(f)
-    except FileNotFoundError:
-        return []  # Return an empty list if the file does not exist
+        export_format = request.GET.get('format', 'csv')
+        if export_format not in EXPORT_FORMATS:
+            return JsonResponse({
+                'status': 'error',
+                'message': 'format must be csv or ndjson.'
+            }, status=400)
 
-def write_invoices_to_file(invoices):
-    """Write invoices to the file synchronously."""
-    with open(INVOICE_FILE_PATH, 'w') as f:
-        json.dump(invoices, f, indent=4)
+        try:
+            filters = parse_filter_params(request)
+        except ValueError:
+            return JsonResponse({
+                'status': 'error',
+                'message': 'Dates must be YYYY-MM-DD and totals must be numeric.'
+            }, status=400)
 
+        content_type, filename = EXPORT_FORMATS[export_format]
+        response = streaming_response(request, stream_export(export_format, filters), content_type=content_type)
+        response['Content-Disposition'] = f'attachment; filename="{filename}"'
+        return response
+    except Exception as e:
+        return JsonResponse({
+            'status': 'error',
+            'message': str(e)
+        }, status=500)
 
 
-# GET method to list all invoices
-async def get_invoices(request):
+
+
+
+# GET method to retrieve one invoice by id
+@etag_from_store_version
+async def get_invoice(request, invoice_id):
+    try:
+        encoded = await asyncio.to_thread(get_store().get_many_encoded, [invoice_id])
+        return invoice_response(encoded, 'Invoice retrieved successfully.')
+    except Exception as e:
+        return JsonResponse({
+            'status': 'error',
+            'message': str(e)
+        }, status=500)
+
+
+# GET method to retrieve one invoice by its invoice_number
+@etag_from_store_version
+async def get_invoice_by_number(request, invoice_number):
+    try:
+        encoded = await asyncio.to_thread(get_store().get_many_encoded, (), [invoice_number])
+        return invoice_response(encoded, 'Invoice retrieved successfully.')
+    except Exception as e:
+        return JsonResponse({
+            'status': 'error',
+            'message': str(e)
+        }, status=500)
+
+
+def search_encoded(query, limit, offset):
+    """Run a search and encode the matching invoices; blocking, so the views call it on a worker thread."""
+    store = get_store()
+    invoices, total = store.search(query, limit, offset)
+    return store.encode(invoices), total
+
+
+# GET method for full-text search over line-item descriptions and customer names
+# ?q=TEXT returns invoices containing every word, best matches first; page with ?limit=&offset=
+@etag_from_store_version
+async def search_invoices(request):
     try:
-        invoices = await async_read_invoices()
+        query = request.GET.get('q', '').strip()
+        if not query:
+            return JsonResponse({
+                'status': 'error',
+                'message': 'Query parameter q is required.'
+            }, status=400)
+
+        try:
+            limit = min(int(request.GET.get('limit', 20)), getattr(settings, 'INVOICE_PAGE_MAX_LIMIT', 1000))
+            offset = int(request.GET.get('offset', 0))
+            if limit < 1 or offset < 0:
+                raise ValueError
+        except ValueError:
+            return JsonResponse({
+                'status': 'error',
+                'message': 'limit must be a positive integer and offset a non-negative integer.'
+            }, status=400)
+
+        encoded, total = await asyncio.to_thread(search_encoded, query, limit, offset)
+        return await asyncio.to_thread(
+            invoices_response, encoded, 'Search completed successfully.',
+            total=total, next_offset=offset + limit if offset + limit < total else None
+        )
+    except Exception as e:
+        return JsonResponse({
+            'status': 'error',
+            'message': str(e)
+        }, status=500)
+
+
+
+
+# GET method for revenue and invoice counts per customer, day and month
+# ?group_by=customer,month limits the response to the listed groupings
+@etag_from_store_version
+async def get_reports(request):
+    try:
+        group_by = [group for group in request.GET.get('group_by', '').split(',') if group] or list(REPORT_GROUPS)
+        unknown = [group for group in group_by if group not in REPORT_GROUPS]
+        if unknown:
+            return JsonResponse({
+                'status': 'error',
+                'message': f'group_by must be a comma-separated list of {", ".join(REPORT_GROUPS)}.'
+            }, status=400)
+
+        report = await asyncio.to_thread(get_store().report, group_by)
         return JsonResponse({
             'status': 'success',
-            'message': 'Invoices retrieved successfully.',
-            'data': invoices
+            'message': 'Report generated successfully.',
+            'data': report
         })
     except Exception as e:
         return JsonResponse({
@@ -57,90 +531,113 @@ async def get_invoices(request):
         }, status=500)
 
 
+async def get_metrics(request):
+    """Request latency and store I/O metrics of this worker, in the Prometheus text format."""
+    body = await asyncio.to_thread(metrics.REGISTRY.render)
+    return HttpResponse(body, content_type=metrics.CONTENT_TYPE)
+
 
 
 
+ISO_DATE = re.compile(r'\d{4}-\d{2}-\d{2}')
 
 
+def check_date(value):
+    """Return ``value`` if it is a YYYY-MM-DD date or left empty; raise ValueError otherwise.
+
+    Both stores key reports and the columnar date index on this string, so
+    nothing else may reach them.
+    """
+    if value in (None, ''):
+        return value
+    try:
+        if not ISO_DATE.fullmatch(value):
+            raise ValueError
+        datetime.date.fromisoformat(value)
+    except (TypeError, ValueError):
+        raise ValueError('Date must be in YYYY-MM-DD format.')
+    return value
+
+
+def prepare_invoice(data):
+    """Validate a new invoice payload and compute its totals.
+
+    Returns the fields to store (the store assigns id and invoice_number).
+    Raises ValueError with a message suitable for the client.
+    """
+    if not isinstance(data, dict):
+        raise ValueError('Invoice must be a JSON object.')
+
+    # Validate the data manually
+    customer_name = data.get('customer_name')
+    details = data.get('details')
+
+    if not customer_name:
+        raise ValueError('Customer name is required.')
+
+    if not details or not isinstance(details, list) or len(details) == 0:
+        raise ValueError('Details are required and must be a non-empty list.')
+
+    # Calculate total amount by multiplying count with price for each product in the details
+    total_cents = 0
+    details_with_ids = []
+
+    for idx, detail in enumerate(details):
+        if not isinstance(detail, dict):
+            raise ValueError('Each detail must be a JSON object.')
+
+        # Calculate the amount for this particular detail, in integer cents
+        try:
+            line_cents = money.detail_total(detail)
+        except (TypeError, ValueError):
+            raise ValueError('Invalid value for count or price. Must be numeric.')
+        money.check_detail(detail, line_cents)
+        total_cents += line_cents
+
+        # Add an ID to the detail (for example, a unique index)
+        details_with_ids.append({**detail, 'id': idx + 1, 'line_total': money.from_cents(line_cents)})
+
+    money.check_cents(total_cents)
+
+    return {
+        'customer_name': customer_name,
+        'date': check_date(data.get('date')),  # Use provided date or handle default
+        'details': details_with_ids,
+        'total_amount': money.from_cents(total_cents)  # Add the total amount to the invoice
+    }
+
 
 # POST method to create a new invoice
 @csrf_exempt
-def create_invoice(request):
+@admit_write
+@idempotent
+async def create_invoice(request):
     if request.method == 'POST':
         try:
-            print("shubham")
-
             # Parse the incoming JSON request data
             data = json.loads(request.body)
 
-            # Validate the data manually
-            customer_name = data.get('customer_name')
-            details = data.get('details')
-
-            if not customer_name:
+            try:
+                fields = prepare_invoice(data)
+            except ValueError as e:
                 return JsonResponse({
                     'status': 'error',
-                    'message': 'Customer name is required.'
+                    'message': str(e)
                 }, status=400)
 
-            if not details or not isinstance(details, list) or len(details) == 0:
+            # Save the new invoice; the store assigns its id and invoice_number
+            try:
+                new_invoice = await get_store().acreate(fields)
+            except WriteRejected:
+                return overloaded_response()
+            except ValueError as e:
+                # Raised by stores that validate column types
                 return JsonResponse({
                     'status': 'error',
-                    'message': 'Details are required and must be a non-empty list.'
+                    'message': str(e)
                 }, status=400)
-
-            # Read the current invoices from the file
-            if os.path.exists(INVOICE_FILE_PATH):
-                with open(INVOICE_FILE_PATH, 'r') as f:
-                    invoices = json.load(f)
-            else:
-                invoices = []
-
-            # Calculate total amount by multiplying count with price for each product in the details
-            total_amount = 0
-            details_with_ids = []
-
-            print(data)
-            for idx, detail in enumerate(details):
-                # Ensure 'count' and 'price' are present
-                count = detail.get('quantity', 0)
-                price = detail.get('unit_price', 0)
-
-                # Convert 'count' to an integer and 'price' to a float
-                try:
-                    count = int(count) if count != '' else 0  # Convert count to integer (default to 0 if empty)
-                    price = float(price) if price != '' else 0.0  # Convert price to float (default to 0.0 if empty)
-                except ValueError:
-                    return JsonResponse({
-                        'status': 'error',
-                        'message': 'Invalid value for count or price. Must be numeric.'
-                    }, status=400)
-
-                print(detail, count, price)
-
-                # Calculate the amount for this particular detail
-                detail_amount = count * price
-                total_amount += detail_amount
-
-                # Add an ID to the detail (for example, a unique index)
-                details_with_ids.append({**detail, 'id': idx + 1})
-
-            # Prepare the new invoice to append to the invoices list
-            new_invoice = {
-                'id': len(invoices) + 1,  # Generate a new unique ID
-                'invoice_number': len(invoices) + 1,
-                'customer_name': customer_name,
-                'date': data.get('date'),  # Use provided date or handle default
-                'details': details_with_ids,
-                'total_amount': total_amount  # Add the total amount to the invoice
-            }
-
-            # Append the new invoice to the existing list
-            invoices.append(new_invoice)
-
-            # Write the updated invoices list back to the file
-            with open(INVOICE_FILE_PATH, 'w') as f:
-                json.dump(invoices, f, indent=4)
+            log_sampled(logger, logging.DEBUG, 'create_invoice', invoice_id=new_invoice['id'],
+                        details=len(new_invoice['details']), total_amount=new_invoice['total_amount'])
 
             # Return a successful response
             return JsonResponse({
@@ -159,12 +656,119 @@ def create_invoice(request):
         'status': 'error',
         'message': 'Only POST requests are allowed.'
     }, status=405)
-    
+
+
+def parse_bulk_body(request):
+    """Split a bulk request body into (index, parsed item or None, error message or None) tuples.
+
+    Accepts a JSON array, or NDJSON (one invoice per line). NDJSON sent as
+    application/x-ndjson is read line by line from the request stream, so
+    the raw body is never held in memory as a whole.
+    """
+    if request.content_type in ('application/x-ndjson', 'application/jsonl'):
+        lines = request
+    else:
+        body = request.read()
+        try:
+            items = json.loads(body)
+        except ValueError:
+            items = None
+        if isinstance(items, list):
+            return [(idx, item, None) for idx, item in enumerate(items)]
+        lines = body.splitlines()
+
+    parsed = []
+    for line in lines:
+        if not line.strip():
+            continue
+        try:
+            parsed.append((len(parsed), json.loads(line), None))
+        except ValueError:
+            parsed.append((len(parsed), None, 'Invalid JSON data.'))
+    return parsed
+
+
+# POST method to create many invoices at once (JSON array or NDJSON body)
+# Every valid invoice is saved in a single write with a contiguous block of ids;
+# invalid ones are reported in 'errors' by their position in the request
+@csrf_exempt
+@admit_write
+@idempotent
+async def bulk_create_invoices(request):
+    if request.method != 'POST':
+        return JsonResponse({
+            'status': 'error',
+            'message': 'Only POST requests are allowed.'
+        }, status=405)
+
+    # The body is read directly rather than through request.body, so enforce our own size limit
+    max_bytes = getattr(settings, 'INVOICE_BULK_MAX_BYTES', 100 * 1024 * 1024)
+    if int(request.META.get('CONTENT_LENGTH') or 0) > max_bytes:
+        return JsonResponse({
+            'status': 'error',
+            'message': f'Request body must not exceed {max_bytes} bytes.'
+        }, status=413)
+
+    items = await asyncio.to_thread(parse_bulk_body, request)
+
+    max_items = getattr(settings, 'INVOICE_BULK_MAX_ITEMS', 50000)
+    if len(items) > max_items:
+        return JsonResponse({
+            'status': 'error',
+            'message': f'At most {max_items} invoices can be created per request.'
+        }, status=413)
+
+    # Validate everything and compute all totals in one pass before touching the store
+    valid = []
+    errors = []
+    for idx, item, error in items:
+        if error is None:
+            try:
+                valid.append((idx, prepare_invoice(item)))
+                continue
+            except ValueError as e:
+                error = str(e)
+        errors.append({'index': idx, 'message': error})
+
+    if not valid:
+        return JsonResponse({
+            'status': 'error',
+            'message': 'No valid invoices to create.',
+            'errors': errors
+        }, status=400)
+
+    try:
+        created = await get_store().acreate_many([fields for _, fields in valid])
+    except WriteRejected:
+        return overloaded_response()
+    except ValueError as e:
+        return JsonResponse({
+            'status': 'error',
+            'message': str(e)
+        }, status=400)
+    except Exception as e:
+        return JsonResponse({
+            'status': 'error',
+            'message': str(e)
+        }, status=500)
+
+    return JsonResponse({
+        'status': 'success',
+        'message': f'{len(created)} invoices created, {len(errors)} failed.',
+        'data': [
+            {'index': idx, 'id': invoice['id'], 'invoice_number': invoice['invoice_number']}
+            for (idx, _), invoice in zip(valid, created)
+        ],
+        'errors': errors
+    })
+
 
 
 # PUT method to update an existing invoice
 @csrf_exempt  # If you need to disable CSRF for testing
-def update_invoice(request):
+@admit_write
+@idempotent
+async def update_invoice(request):
     try:
         if request.method != 'PUT':
             return JsonResponse({
@@ -185,47 +789,45 @@ def update_invoice(request):
                     # Leave the value as-is if it's not a JSON string
                     pass
 
-        print("update", data)
-
-        # Read the existing invoices from the file
-        invoices = read_invoices_from_file()
+        store = get_store()
 
         # Find the invoice with the given ID
-        invoice = next((inv for inv in invoices if inv['id'] == data['id']), None)
+        invoice = await asyncio.to_thread(store.get, data['id'])
         if not invoice:
             return JsonResponse({
                 'status': 'error',
                 'message': 'Invoice not found.'
             }, status=404)
 
+        # Work on a copy so the cached invoice only changes once the update is saved
+        invoice = copy.deepcopy(invoice)
+
         # Update or add fields from the incoming data
         details = data.get("details", [])
-        total_amount = 0
+        total_cents = 0
         details_with_ids = []
 
         for idx, detail in enumerate(details):
-            # Ensure 'count' and 'price' are present
-            count = detail.get('quantity', 0)
-            price = detail.get('unit_price', 0)
-
-            # Convert 'count' to an integer and 'price' to a float
+            # Calculate the amount for this particular detail, in integer cents
             try:
-                count = int(count) if count != '' else 0  # Convert count to integer (default to 0 if empty)
-                price = float(price) if price != '' else 0.0  # Convert price to float (default to 0.0 if empty)
-            except ValueError:
+                line_cents = money.detail_total(detail)
+            except (TypeError, ValueError):
                 return JsonResponse({
                     'status': 'error',
                     'message': 'Invalid value for count or price. Must be numeric.'
                 }, status=400)
+            try:
+                money.check_detail(detail, line_cents)
+            except ValueError as e:
+                return JsonResponse({
+                    'status': 'error',
+                    'message': str(e)
+                }, status=400)
 
-            print(detail, count, price)
-
-            # Calculate the amount for this particular detail
-            detail_amount = count * price
-            total_amount += detail_amount
+            total_cents += line_cents
 
             # Add an ID to the detail (for example, a unique index)
-            details_with_ids.append({**detail, 'id': idx + 1})
+            details_with_ids.append({**detail, 'id': idx + 1, 'line_total': money.from_cents(line_cents)})
 
         # Update the invoice's details with the new data
         if "details" in data:
@@ -251,6 +853,18 @@ def update_invoice(request):
 
             # Update the invoice details
             invoice["details"] = updated_details
+        else:
+            # The stored details stay, so their total does too (the report rollups are adjusted by it)
+            total_cents = sum(money.detail_total(detail) for detail in invoice.get('details', []))
+
+        if 'date' in data:
+            try:
+                check_date(data['date'])
+            except ValueError as e:
+                return JsonResponse({
+                    'status': 'error',
+                    'message': str(e)
+                }, status=400)
 
         # Update other fields from the incoming data (excluding "details")
         for key, value in data.items():
@@ -258,10 +872,18 @@ def update_invoice(request):
                 invoice[key] = value
 
         # Update the total amount of the invoice
-        invoice['total_amount'] = total_amount
+        try:
+            invoice['total_amount'] = money.from_cents(money.check_cents(total_cents))
+        except ValueError as e:
+            return JsonResponse({
+                'status': 'error',
+                'message': str(e)
+            }, status=400)
 
-        # Write the updated invoices list back to the file
-        write_invoices_to_file(invoices)
+        # Save the updated invoice
+        await store.aupdate(invoice)
+        log_sampled(logger, logging.DEBUG, 'update_invoice', invoice_id=invoice['id'],
+                    details=len(invoice.get('details', [])), total_amount=invoice.get('total_amount'))
 
         return JsonResponse({
             'status': 'success',
@@ -275,6 +897,9 @@ def update_invoice(request):
             'message': 'Invalid JSON data.'
         }, status=400)
 
+    except WriteRejected:
+        return overloaded_response()
+
     except Exception as e:
         return JsonResponse({
             'status': 'error',
@@ -282,9 +907,98 @@ def update_invoice(request):
         }, status=500)
 
 
+def parse_detail_patch(data):
+    """Validate a details PATCH body and return its (add, change, remove) lists.
+
+    ``add`` holds new details, ``update`` partial details with their ``id``
+    and ``remove`` detail ids. Line totals are always computed, never taken
+    from the request. Raises ValueError with a message for the client.
+    """
+    if not isinstance(data, dict):
+        raise ValueError('Request body must be a JSON object.')
+    add, change, remove = data.get('add') or [], data.get('update') or [], data.get('remove') or []
+    if not all(isinstance(items, list) for items in (add, change, remove)):
+        raise ValueError("'add', 'update' and 'remove' must be lists.")
+    if not all(isinstance(detail, dict) for detail in add + change):
+        raise ValueError('Each detail must be a JSON object.')
+    if not all('id' in detail for detail in change):
+        raise ValueError("Each detail in 'update' needs its 'id'.")
+    ids = [detail['id'] for detail in change] + remove
+    if len(set(map(str, ids))) != len(ids):
+        raise ValueError('A detail id may only appear once per request.')
+
+    add = [{k: v for k, v in detail.items() if k not in ('id', 'line_total')} for detail in add]
+    change = [{k: v for k, v in detail.items() if k != 'line_total'} for detail in change]
+    try:
+        lines = [money.detail_total(detail) for detail in add]
+        # Changed details are only complete once merged in the store, which checks their totals
+        for detail in change:
+            money.detail_total({'quantity': detail.get('quantity', 0), 'unit_price': detail.get('unit_price', 0)})
+    except (TypeError, ValueError):
+        raise ValueError('Invalid value for count or price. Must be numeric.')
+    for detail, cents in zip(add, lines):
+        money.check_detail(detail, cents)
+    for detail in change:
+        money.check_detail(detail, 0)
+    return add, change, remove
+
+
+# PATCH method to add, change or remove individual details of an invoice
+@csrf_exempt
+@admit_write
+@idempotent
+async def patch_invoice_details(request, invoice_id):
+    if request.method != 'PATCH':
+        return JsonResponse({
+            'status': 'error',
+            'message': 'Only PATCH requests are allowed.'
+        }, status=405)
+
+    try:
+        add, change, remove = parse_detail_patch(json.loads(request.body))
+    except json.JSONDecodeError:
+        return JsonResponse({
+            'status': 'error',
+            'message': 'Invalid JSON data.'
+        }, status=400)
+    except ValueError as e:
+        return JsonResponse({
+            'status': 'error',
+            'message': str(e)
+        }, status=400)
+
+    try:
+        invoice = await get_store().apatch_details(invoice_id, add, change, remove)
+    except WriteRejected:
+        return overloaded_response()
+    except KeyError:
+        return JsonResponse({
+            'status': 'error',
+            'message': 'Invoice or detail not found.'
+        }, status=404)
+    except money.OutOfRange as e:
+        return JsonResponse({
+            'status': 'error',
+            'message': str(e)
+        }, status=400)
+    except (TypeError, ValueError):
+        return JsonResponse({
+            'status': 'error',
+            'message': 'Invalid value for count or price. Must be numeric.'
+        }, status=400)
+
+    return JsonResponse({
+        'status': 'success',
+        'message': 'Invoice details updated successfully.',
+        'data': invoice
+    })
+
+
 # DELETE method to delete an invoice
 @csrf_exempt  # If you need to disable CSRF for testing
-def delete_invoice(request):
+@admit_write
+@idempotent
+async def delete_invoice(request):
     try:
         if request.method != 'DELETE':
             return JsonResponse({
@@ -301,22 +1015,36 @@ def delete_invoice(request):
                 'message': 'Invalid JSON data.'
             }, status=400)
 
-        # Read the existing invoices from the file
-        invoices = read_invoices_from_file()
+        store = get_store()
 
-        # Extract necessary fields from the request
-        invoice_id = data.get('invoice_id')
+        # Extract necessary fields from the request. 'id' and 'invoice_number' say which one they
+        # carry; the older 'invoice_id' field carries either, from when invoice numbers equalled ids
+        invoice_id = data.get('id')
+        invoice_number = data.get('invoice_number')
+        legacy_id = data.get('invoice_id')
         detail_id = data.get('detail_id')
-        print(invoice_id,detail_id)
 
-        if not invoice_id:
+        if invoice_id is None and invoice_number is None and not legacy_id:
             return JsonResponse({
                 'status': 'error',
                 'message': 'Invoice ID is required.'
             }, status=400)
 
-        # Find the invoice with the given ID
-        invoice = next((inv for inv in invoices if inv['invoice_number'] == invoice_id), None)
+        if invoice_id is not None:
+            invoice = await asyncio.to_thread(store.get, invoice_id)
+        elif invoice_number is not None:
+            invoice = await asyncio.to_thread(store.get_by_number, invoice_number)
+        else:
+            by_id = await asyncio.to_thread(store.get, legacy_id)
+            by_number = await asyncio.to_thread(store.get_by_number, legacy_id)
+            if by_id and by_number and by_id['id'] != by_number['id']:
+                # On rows whose number no longer matches their id, refuse to guess which one was meant
+                return JsonResponse({
+                    'status': 'error',
+                    'message': f'invoice_id {legacy_id!r} is the id of one invoice and the number of another; '
+                               'send "id" or "invoice_number" instead.'
+                }, status=400)
+            invoice = by_id or by_number
         if not invoice:
             return JsonResponse({
                 'status': 'error',
@@ -325,28 +1053,28 @@ def delete_invoice(request):
 
         if detail_id is None:
             # If detail_id is not provided, delete the entire invoice
-            invoices.remove(invoice)
+            await store.adelete(invoice['id'])
             message = 'Invoice deleted successfully.'
         else:
             # If detail_id is provided, delete the specific detail
             details = invoice.get('details', [])
-            updated_details = [d for d in details if d.get('id') != detail_id]
-            if len(details) == len(updated_details):
+            if not any(d.get('id') == detail_id for d in details):
                 return JsonResponse({
                     'status': 'error',
                     'message': 'Detail not found in the invoice.'
                 }, status=404)
-            invoice['details'] = updated_details
+            await store.adelete_detail(invoice['id'], detail_id)
             message = 'Detail deleted successfully.'
-
-        # Write the updated invoices list back to the file
-        write_invoices_to_file(invoices)
+        log_sampled(logger, logging.DEBUG, 'delete_invoice', invoice_id=invoice['id'], detail_id=detail_id)
 
         return JsonResponse({
             'status': 'success',
             'message': message
         })
 
+    except WriteRejected:
+        return overloaded_response()
+
     except Exception as e:
         return JsonResponse({
             'status': 'error',
@@ -0,0 +1,45 @@
+"""
+WSGI entry point for the serverless (Vercel) deployment.
+
+Like backend/wsgi.py, but with the API-only settings (backend/settings_api.py).
+With INVOICE_PRELOAD on, importing it also starts loading the URLconf, the
+views and the invoice snapshot on a background thread, so that work overlaps
+the rest of the cold start instead of delaying the first request. A request
+that arrives before it is done waits on the store's lock; the snapshot is
+never parsed twice.
+
+Run `python manage.py coldstart` to see what importing this module costs.
+"""
+
+import logging
+import os
+import threading
+
+from django.conf import settings
+from django.core.wsgi import get_wsgi_application
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'backend.settings_api')
+
+application = get_wsgi_application()
+handler = application  # Assign application to handler for Vercel compatibility
+
+logger = logging.getLogger(__name__)
+
+
+def preload():
+    """Import the URLconf (and with it the views and the store), then load the JSON store."""
+    try:
+        from django.urls import get_resolver
+        from .store import get_store
+
+        get_resolver().url_patterns
+        if getattr(settings, 'INVOICE_STORAGE_BACKEND', 'json') == 'json':
+            len(get_store())  # Parses and indexes the snapshot
+    except Exception:
+        logger.exception('Preloading the invoice store failed; the first request will load it')
+
+
+# INVOICE_PRELOAD=0 in the environment turns the thread off without a settings change
+# (`coldstart` does, since -X importtime cannot attribute imports made by two threads)
+if getattr(settings, 'INVOICE_PRELOAD', False) and os.environ.get('INVOICE_PRELOAD') != '0':
+    threading.Thread(target=preload, name='invoice-preload', daemon=True).start()